@@ -0,0 +1,134 @@
+"""Monitors of running run123_lapw calculations, they stop SCF cycles that diverge or stall."""
+from __future__ import annotations
+
+import math
+import shlex
+
+from aiida.engine.processes.calcjobs.monitors import CalcJobMonitorResult
+from aiida_wien2k.calculations.run123_lapw import MONITOR_EXTRA
+from aiida_wien2k.parsers.scf123 import _EXTRACTORS, _iter_scf_history
+
+# SCF file of the running stage, relative to the remote working directory: the scratch directory that
+# `configs/codes/run123_lapw.yml` links as `case/case`, or the case directory itself
+SCF_FILES = ('case/case/case.scf', 'case/case.scf')
+
+# inode and size of the first existing of the SCF files {fnames} and its bytes from the byte {start} (1-based), at
+# most {max_bytes}
+_TAIL_COMMAND = (
+    'for f in {fnames} \'\'; do [ -f "$f" ] && break; done; '
+    'if [ -n "$f" ]; then set -- $(ls -iL "$f"); echo "$1 $(wc -c < "$f")"; '
+    'tail -c +{start} "$f" | head -c {max_bytes}; else echo \'0 0\'; fi'
+)
+
+
+def _initial_state(inode='0'):
+    """Return the monitor state at the start of the SCF file `inode`."""
+    return {
+        'inode': inode,
+        'offset': 0,
+        'iteration': 0,
+        'min_dis': None,
+        'best_dis': None,
+        'best_iteration': 0,
+        'recent_dis': [],
+    }
+
+
+def _read_new_lines(transport, workdir, fnames, offset, max_bytes):
+    """Return the inode and the size of the remote SCF file and the lines written after the byte `offset`.
+
+    Only the lines before the last ':ITE' line are returned: the iteration it opens is still running. The returned
+    lines thus always end with a complete iteration (or are empty) and the next read starts at the ':ITE' line. The
+    window of `max_bytes` bytes is doubled until it contains the start of the next iteration if one iteration does
+    not fit."""
+    iteration = _EXTRACTORS[':ITE']
+    while True:
+        command = _TAIL_COMMAND.format(
+            fnames=' '.join(shlex.quote(fname) for fname in fnames), start=offset + 1, max_bytes=max_bytes
+        )
+        retval, stdout, stderr = transport.exec_command_wait(command, workdir=workdir)
+        if retval != 0:
+            raise OSError(f'reading the remote SCF file {fnames} failed: {stderr}')
+
+        header, _, chunk = stdout.partition('\n')
+        inode, size = header.split()
+        lines = chunk.splitlines(keepends=True)
+        if lines and not lines[-1].endswith('\n'):
+            lines.pop()  # cut by `max_bytes`
+        last = next((index for index in reversed(range(len(lines))) if iteration.match(lines[index])), 0)
+        if last or int(size) - offset <= max_bytes:
+            return inode, int(size), lines[:last]
+        max_bytes *= 2
+
+
+def monitor_scf(  # noqa: PLR0913
+    node,
+    transport,
+    divergence_factor: float = 10.0,
+    divergence_window: int = 5,
+    stagnation_cycles: int = 30,
+    stagnation_improvement: float = 0.1,
+    max_bytes: int = 2**20,
+    scf_file: str | None = None,
+) -> CalcJobMonitorResult | None:
+    """Stop the SCF cycle of a running run123_lapw calculation if it diverges or stalls.
+
+    Only the bytes of the remote SCF file appended since the last poll are read, the byte offset and the
+    charge distance history of the monitor are kept in the `MONITOR_EXTRA` extra of the `node`. A new file (another
+    inode, or a smaller file than at the last poll) belongs to the next precision stage and restarts the monitor.
+    The SCF cycle
+
+    - diverges if the charge distances of the last `divergence_window` iterations all exceed `divergence_factor` times
+      the smallest charge distance of the stage,
+    - stalls if the charge distance did not drop by a fraction `stagnation_improvement` for `stagnation_cycles`
+      iterations.
+
+    The SCF file is `scf_file`, relative to the remote working directory, by default the first existing of `SCF_FILES`.
+    The calculation is killed and the parser salvages the last complete iteration and returns `ERROR_SCF_DIVERGED` or
+    `ERROR_SCF_STALLED`.
+
+    Usage, in the inputs of `Wien2kRun123Lapw`::
+
+        'monitors': {'scf': Dict({'entry_point': 'wien2k.scf', 'kwargs': {'stagnation_cycles': 20}})}
+    """
+    state = node.base.extras.get(MONITOR_EXTRA, None) or _initial_state()
+    workdir = node.get_remote_workdir()
+    fnames = SCF_FILES if scf_file is None else (scf_file,)
+    inode, size, lines = _read_new_lines(transport, workdir, fnames, state['offset'], max_bytes)
+    if inode != state['inode'] or size < state['offset']:  # next stage
+        state = _initial_state(inode)
+        inode, size, lines = _read_new_lines(transport, workdir, fnames, 0, max_bytes)
+
+    state['offset'] += sum(len(line.encode()) for line in lines)
+    message = None
+    for record in _iter_scf_history(lines):
+        dis = record['DisCharge']
+        state['iteration'] = record['Iter']
+        if math.isnan(dis):
+            continue
+        state['min_dis'] = dis if state['min_dis'] is None else min(dis, state['min_dis'])
+        state['recent_dis'] = [*state['recent_dis'], dis][-divergence_window:]
+        if state['best_dis'] is None or dis < (1.0 - stagnation_improvement) * state['best_dis']:
+            state['best_dis'], state['best_iteration'] = dis, record['Iter']
+
+        if len(state['recent_dis']) == divergence_window and min(state['recent_dis']) > (
+            divergence_factor * state['min_dis']
+        ):
+            state['stopped'] = 'ERROR_SCF_DIVERGED'
+            message = (
+                f'SCF cycle diverged: charge distance {dis} in iteration {record["Iter"]}, '
+                f'the minimum was {state["min_dis"]}'
+            )
+            break
+        if record['Iter'] - state['best_iteration'] >= stagnation_cycles:
+            state['stopped'] = 'ERROR_SCF_STALLED'
+            message = (
+                f'SCF cycle stalled: charge distance {dis} in iteration {record["Iter"]}, '
+                f'{state["best_dis"]} in iteration {state["best_iteration"]}'
+            )
+            break
+
+    node.base.extras.set(MONITOR_EXTRA, state)
+    if message is None:
+        return None
+    return CalcJobMonitorResult(message=message, override_exit_code=False)
@@ -0,0 +1,248 @@
+"""Estimate the resources of a run123_lapw calculation from the size of the structure and of the basis set."""
+from __future__ import annotations
+
+import functools
+import math
+import typing as t
+
+import numpy as np
+from aiida.orm import QueryBuilder
+from aiida_wien2k.calculations.run123_lapw import SYMPREC, Wien2kRun123LapwNode, _structure_arrays
+
+# default RKmax and k-point density (number of k-points in the full Brillouin zone times the volume of the primitive
+# cell [bohr^3]) of the final prec3k stage of run123_lapw
+DEFAULT_RKMAX = 10.0
+DEFAULT_KPOINT_DENSITY = 1.2e7
+
+# RMT [bohr] of the smallest sphere: half the shortest interatomic distance, at most `MAX_RMT`
+MAX_RMT = 2.35
+
+# local orbitals per atom, a typical count with semicore states
+LOCAL_ORBITALS_PER_ATOM = 18
+
+# memory [MB] of lapw1 for every MPI rank on top of the Hamiltonian, overlap and eigenvector matrices
+BASE_MEMORY_MB = 200.0
+
+# parallel efficiency of lapw1/lapw2 for every doubling of the MPI ranks of a k-point group
+MPI_EFFICIENCY = 0.85
+
+# safety factor and minimum [s] of the requested wall time
+WALLTIME_SAFETY = 1.5
+MIN_WALLCLOCK_SECONDS = 1800
+
+# reference run the default time coefficients are calibrated on: bcc iodine (a = 7.754003 bohr, RMT 2.35) and its
+# mean wall time [s] per SCF cycle of the prec3k stage on one core
+_REFERENCE_LATTICE_BOHR = 7.754003
+_REFERENCE_CYCLE_SECONDS = {'lapw0': 11.764, 'lapw1': 38.112, 'lapw2': 10.31, 'other': 0.442}
+
+
+class ResourceEstimate(t.NamedTuple):
+    """Estimated size and cost of one SCF cycle of a calculation on one core."""
+
+    matrix_size: int  # dimension of the lapw1 Hamiltonian: plane waves and local orbitals
+    memory_mb: float  # memory of lapw1 for one k-point [MB]
+    num_kpoints: int  # number of irreducible k-points
+    num_atoms: int  # number of atoms in the primitive cell
+    cycle_seconds: dict  # wall time per SCF cycle [s] of lapw0, lapw1, lapw2 and the other programs
+
+
+def _primitive_cell(structure, symprec=SYMPREC):
+    """Return the primitive cell [bohr] (one lattice vector per row), fractional positions and kind indices of an
+    AiiDA StructureData. The structure is used as is if spglib finds no primitive cell."""
+    import spglib
+    from ase.units import Bohr
+
+    cell, scaled, types, _ = _structure_arrays(structure)
+    try:
+        primitive = spglib.standardize_cell((cell, scaled, types), to_primitive=True, symprec=symprec)
+    except getattr(spglib, 'SpglibError', ()):  # raised instead of returning None with the new error handling
+        primitive = None
+    if primitive is not None:
+        cell, scaled, types = primitive
+    return np.asarray(cell) / Bohr, np.asarray(scaled), np.asarray(types)
+
+
+def _min_distance(cell, scaled):
+    """Return the shortest distance between two atoms of a periodic cell, including the periodic images."""
+    images = np.array(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1])).reshape(3, -1).T
+    distance = np.inf
+    for position in scaled:  # one atom at a time to bound the memory for large cells
+        distances = np.linalg.norm((scaled[:, np.newaxis, :] - position + images) @ cell, axis=-1)
+        distance = min(distance, distances[distances > 1e-8].min())
+    return distance
+
+
+def _num_irreducible_kpoints(cell, scaled, types, kpoint_density, symprec=SYMPREC):
+    """Return the number of irreducible k-points of the Gamma-centred mesh with `kpoint_density`."""
+    import spglib
+
+    reciprocal = np.linalg.norm(np.linalg.inv(cell), axis=0)  # lengths of the reciprocal lattice vectors / 2 pi
+    volume = abs(np.linalg.det(cell))
+    spacing = (np.prod(reciprocal) * volume / kpoint_density) ** (1.0 / 3.0)
+    mesh = np.maximum(np.rint(reciprocal / spacing), 1).astype(int)
+    mapping, _ = spglib.get_ir_reciprocal_mesh(mesh, (cell, scaled, types), symprec=symprec)
+    return len(np.unique(mapping))
+
+
+def _cost(matrix_size, num_kpoints, num_atoms):
+    """Return the cost model of every program of an SCF cycle, the wall time is the cost times a coefficient."""
+    return {
+        'lapw0': float(matrix_size),  # FFT and multipoles, scales with the plane waves of the density
+        'lapw1': float(num_kpoints) * matrix_size**3,  # diagonalization
+        'lapw2': float(num_kpoints) * matrix_size**2,  # density from the eigenvectors
+        'other': float(num_atoms),  # lcore, mixer
+    }
+
+
+def _basis(structure, rkmax=DEFAULT_RKMAX, kpoint_density=DEFAULT_KPOINT_DENSITY):
+    """Return the matrix size, number of irreducible k-points and number of atoms of the primitive cell."""
+    cell, scaled, types = _primitive_cell(structure)
+    volume = abs(np.linalg.det(cell))
+    kmax = rkmax / min(0.5 * _min_distance(cell, scaled), MAX_RMT)
+    matrix_size = int(volume * kmax**3 / (6.0 * math.pi**2)) + LOCAL_ORBITALS_PER_ATOM * len(types)
+    return matrix_size, _num_irreducible_kpoints(cell, scaled, types, kpoint_density), len(types)
+
+
+@functools.lru_cache(maxsize=None)
+def _default_coefficients():
+    """Return the time coefficients of the programs calibrated on the reference run."""
+    from aiida.orm import StructureData
+    from ase.units import Bohr
+
+    reference = StructureData(cell=(np.eye(3) * _REFERENCE_LATTICE_BOHR * Bohr).tolist())
+    reference.append_atom(position=(0.0, 0.0, 0.0), symbols='I')
+    reference.append_atom(position=(np.ones(3) * _REFERENCE_LATTICE_BOHR * Bohr / 2).tolist(), symbols='I')
+    cost = _cost(*_basis(reference, rkmax=DEFAULT_RKMAX, kpoint_density=DEFAULT_KPOINT_DENSITY))
+    return {program: seconds / cost[program] for program, seconds in _REFERENCE_CYCLE_SECONDS.items()}
+
+
+def estimate(structure, rkmax=DEFAULT_RKMAX, kpoint_density=DEFAULT_KPOINT_DENSITY, coefficients=None):
+    """Estimate the lapw1 matrix size and memory, the number of irreducible k-points and the wall time per SCF cycle
+    on one core of a calculation of an AiiDA StructureData.
+
+    The matrix size is the number of plane waves V Kmax^3 / (6 pi^2) of the primitive cell, with Kmax = RKmax / RMT,
+    plus the local orbitals. The memory is that of the complex Hamiltonian, overlap and eigenvector matrices of one
+    k-point. The wall time of every program is its cost model times a coefficient, see `calibrate`.
+
+    coefficients: time coefficient of every program, by default calibrated on a reference run
+    """
+    matrix_size, num_kpoints, num_atoms = _basis(structure, rkmax=rkmax, kpoint_density=kpoint_density)
+    coefficients = coefficients or _default_coefficients()
+    cost = _cost(matrix_size, num_kpoints, num_atoms)
+    return ResourceEstimate(
+        matrix_size=matrix_size,
+        memory_mb=3 * 16 * matrix_size**2 / 1024**2,
+        num_kpoints=num_kpoints,
+        num_atoms=num_atoms,
+        cycle_seconds={program: coefficients[program] * cost[program] for program in cost},
+    )
+
+
+def calibrate(computer=None, rkmax=DEFAULT_RKMAX, kpoint_density=DEFAULT_KPOINT_DENSITY, limit=50):
+    """Return the time coefficients of the programs calibrated on the dayfile timings of the last `limit` finished
+    calculations with an `aiida_structure` input, on `computer` if given. The coefficient of every program is the
+    median ratio of its wall time per prec3k cycle and of its cost. Programs without history keep the default.
+    The timings of parallel runs are converted to one core with the MPI ranks of the job."""
+    builder = QueryBuilder().append(
+        Wien2kRun123LapwNode,
+        filters={'attributes.exit_status': 0, **({'dbcomputer_id': computer.pk} if computer is not None else {})},
+        tag='calc',
+        project='*',
+    )
+    builder.order_by({'calc': {'ctime': 'desc'}}).limit(limit)
+
+    ratios = {program: [] for program in _REFERENCE_CYCLE_SECONDS}
+    for (node,) in builder.iterall():
+        if 'aiida_structure' not in node.inputs or 'dayfile_timings_summary' not in node.outputs:
+            continue
+        summary = node.outputs.dayfile_timings_summary.get_dict().get('prec3k')
+        if not summary or not summary['num_cycles']:
+            continue
+        resources = node.get_option('resources') or {}
+        cores = resources.get('num_machines', 1) * resources.get('num_mpiprocs_per_machine', 1)
+        cost = _cost(*_basis(node.inputs.aiida_structure, rkmax=rkmax, kpoint_density=kpoint_density))
+        seconds = {program: 0.0 for program in ratios}
+        for program, wall_seconds in summary['wall_seconds'].items():
+            seconds[program if program in seconds else 'other'] += wall_seconds * cores / summary['num_cycles']
+        for program, ratio in ratios.items():
+            if seconds[program] > 0:
+                ratio.append(seconds[program] / cost[program])
+
+    coefficients = dict(_default_coefficients())
+    coefficients.update({program: float(np.median(ratio)) for program, ratio in ratios.items() if ratio})
+    return coefficients
+
+
+def estimate_options(  # noqa: PLR0913
+    structure,
+    cores_per_machine,
+    memory_mb_per_machine,
+    max_machines=1,
+    max_wallclock_seconds=86400,
+    max_cycles=40,
+    rkmax=DEFAULT_RKMAX,
+    kpoint_density=DEFAULT_KPOINT_DENSITY,
+    coefficients=None,
+):
+    """Return the `resources`, `max_wallclock_seconds`, `max_memory_kb` and parallel layout options of a
+    `Wien2kRun123Lapw` calculation of an AiiDA StructureData, together with its `ResourceEstimate`.
+
+    Every k-point group gets the fewest MPI ranks such that lapw1 fits into the memory of its cores. A small
+    calculation gets the fewest k-point groups on one machine that finish `max_cycles` SCF cycles within
+    `MIN_WALLCLOCK_SECONDS`. Otherwise the k-point groups fill the machines, with more MPI ranks each if there are
+    fewer k-points than cores, and the calculation gets the fewest machines (at most `max_machines`) that finish
+    `max_cycles` SCF cycles within `max_wallclock_seconds`.
+    """
+    estimate_ = estimate(structure, rkmax=rkmax, kpoint_density=kpoint_density, coefficients=coefficients)
+    memory_per_core = memory_mb_per_machine / cores_per_machine
+
+    def walltime(num_machines, kgroups_per_machine, mpiprocs_per_kgroup):
+        """Return the estimated wall time [s] of the SCF cycles on `num_machines` machines."""
+        kgroups = num_machines * kgroups_per_machine
+        kpoint_fraction = math.ceil(estimate_.num_kpoints / kgroups) / estimate_.num_kpoints
+        speedup = mpiprocs_per_kgroup * MPI_EFFICIENCY ** math.log2(mpiprocs_per_kgroup)
+        seconds = estimate_.cycle_seconds
+        cycle = (
+            seconds['lapw0'] / (num_machines * kgroups_per_machine * mpiprocs_per_kgroup)
+            + (seconds['lapw1'] + seconds['lapw2']) * kpoint_fraction / speedup
+            + seconds['other']
+        )
+        return max_cycles * cycle * WALLTIME_SAFETY
+
+    # MPI ranks per k-point group: powers of two dividing the cores of a machine
+    divisors = [2**n for n in range(int(math.log2(cores_per_machine)) + 1) if cores_per_machine % 2**n == 0]
+    mpiprocs_per_kgroup = next(
+        (m for m in divisors if estimate_.memory_mb / m + BASE_MEMORY_MB <= memory_per_core), divisors[-1]
+    )
+    max_kgroups = min(cores_per_machine // mpiprocs_per_kgroup, estimate_.num_kpoints)
+    kgroups_per_machine = next(
+        (k for k in range(1, max_kgroups + 1) if walltime(1, k, mpiprocs_per_kgroup) <= MIN_WALLCLOCK_SECONDS), None
+    )
+    if kgroups_per_machine is None:  # fill the machines
+        while (
+            cores_per_machine // mpiprocs_per_kgroup > estimate_.num_kpoints and mpiprocs_per_kgroup * 2 in divisors
+        ):  # more k-point groups than k-points
+            mpiprocs_per_kgroup *= 2
+        kgroups_per_machine = cores_per_machine // mpiprocs_per_kgroup
+
+    num_machines = next(
+        (
+            n
+            for n in range(1, max_machines + 1)
+            if walltime(n, kgroups_per_machine, mpiprocs_per_kgroup) <= max_wallclock_seconds
+        ),
+        max_machines,
+    )
+    memory_mb = kgroups_per_machine * (estimate_.memory_mb + mpiprocs_per_kgroup * BASE_MEMORY_MB)
+    seconds = math.ceil(walltime(num_machines, kgroups_per_machine, mpiprocs_per_kgroup) / 60) * 60
+
+    options = {
+        'resources': {
+            'num_machines': num_machines,
+            'num_mpiprocs_per_machine': kgroups_per_machine * mpiprocs_per_kgroup,
+        },
+        'max_wallclock_seconds': int(min(max(seconds, MIN_WALLCLOCK_SECONDS), max_wallclock_seconds)),
+        'max_memory_kb': int(min(memory_mb, memory_mb_per_machine) * 1024),
+        'mpiprocs_per_kgroup': mpiprocs_per_kgroup,
+    }
+    return options, estimate_
@@ -1,10 +1,26 @@
+import hashlib
 import io
+import os
 
 import numpy as np
 from aiida.common import datastructures
+from aiida.common.exceptions import InputValidationError
+from aiida.common.lang import classproperty
+from aiida.common.links import LinkType
 from aiida.engine import CalcJob
-from aiida.orm import AbstractCode, Dict, SinglefileData, StructureData
-from ase.units import Bohr
+from aiida.orm import (
+    AbstractCode,
+    ArrayData,
+    CalcJobNode,
+    Dict,
+    QueryBuilder,
+    RemoteData,
+    SinglefileData,
+    StructureData,
+)
+from aiida.orm.nodes.data.structure import Site
+from aiida.orm.nodes.process.calculation.calcjob import CalcJobNodeCaching
+from aiida.schedulers.datastructures import NodeNumberJobResource
 
 
 def cellconst(mett):
@@ -18,55 +34,299 @@ def cellconst(mett):
     return np.array([aa, bb, cc, alpha, beta, gamma])
 
 
-def write_struct(f, atoms2=None, rmt=None, lattice='P', zza=None):
-    """Adapted from ASE.
-    It writes ASE structure into a WIEN2k struct file as a StringIO
-    file-like object."""
-    atoms = atoms2.copy()
-    atoms.wrap()
+# inequivalent atom of a WIEN2k struct file: first position, MULT, positions of the equivalent atoms, name,
+# nuclear charge and local rotation matrix
+_STRUCT_ATOM = 'ATOM %3i: X=%10.8f Y=%10.8f Z=%10.8f\n          MULT=%2i          ISPLIT= 1\n'
+_STRUCT_EQUIVALENT_ATOM = '          X=%10.8f Y=%10.8f Z=%10.8f\n'
+_STRUCT_ATOM_NAME = (
+    '%-10s NPT=%5i  R0=%9.8f RMT=%10.4f   Z:%10.5f\n'
+    'LOCAL ROT MATRIX:   %10.7f%10.7f%10.7f\n'
+    '                    %10.7f%10.7f%10.7f\n'
+    '                    %10.7f%10.7f%10.7f\n'
+)
+
+# default tolerance [Angstrom] of the symmetry analysis of `aiida_struct2wien2k`
+SYMPREC = 1e-5
+
+# attribute of the generated struct files with the SHA-256 hash of their content
+STRUCT_HASH_ATTRIBUTE = 'sha256'
+
+# suffix of the output files compressed with `compress_outputs`, decompressed by the parser
+COMPRESSED_SUFFIX = '.gz'
+
+# extra of the calculation node with the state of the `monitor_scf` monitor and the exit code it requests
+MONITOR_EXTRA = 'wien2k_scf_monitor'
+
+# decimals of the fractional coordinates and of the lattice vectors [Angstrom] of the structure in the process hash
+HASH_DECIMALS = 6
+
+# options that change neither the results nor the retrieved files of a calculation, they are ignored by the process
+# hash (`minimal_retrieval` and `compress_outputs` change the files of the `retrieved` output)
+HASH_IGNORED_OPTIONS = (
+    'resources',
+    'parser_max_workers',
+    'mpiprocs_per_kgroup',
+    'omp_threads',
+    'kpoint_granularity',
+    'lapw0_parallel',
+    'walltime_stop',
+    'walltime_stop_margin',
+)
+
+# shell function printing the host names of the job, one per line, from the node list of the scheduler
+_MACHINES_HOSTS = (
+    '_wien2k_hosts() { '
+    'if [ -n "${SLURM_JOB_NODELIST}" ]; then scontrol show hostnames "${SLURM_JOB_NODELIST}"; '
+    'elif [ -n "${PBS_NODEFILE}" ]; then sort -u "${PBS_NODEFILE}"; '
+    'else hostname; fi | head -n %i; }'
+)
+
+# file written by the job script watchdog in the working directory of run123_lapw when it stops the SCF cycle
+WALLTIME_STOP_FILE = 'walltime.stop'
+
+# seconds between two checks of the `*.dayfile` by the job script watchdog
+WATCHDOG_POLL_SECONDS = 10
+
+# awk program printing the number of SCF cycles of a WIEN2k `*.dayfile` and the wall time [s] of its longest complete
+# cycle, the sum of the wall times (h:mm:ss.ss after the system time) of the programs of the cycle
+_DAYFILE_CYCLES_AWK = (
+    '/^ *cycle / {n++} '
+    '/^>/ && n {for (i = 2; i < NF; i++) if ($i ~ /^[0-9.]+s$/ && $(i + 1) ~ /:/) '
+    '{k = split($(i + 1), t, ":"); s = 0; for (j = 1; j <= k; j++) s = s * 60 + t[j]; w[n] += s; break}} '
+    'END {m = 0; for (c = 1; c < n; c++) if (w[c] > m) m = w[c]; printf "%d %d\\n", n, m + 0.999}'
+)
+
+# job script lines stopping the watchdog once run123_lapw is done
+_WATCHDOG_STOP = 'kill "${_wien2k_watchdog_pid}" 2> /dev/null; rm -f .stop'
+
+# converged density of a parent calculation that a warm start begins with, run_lapw picks up an existing density
+WARM_START_FILES = ('case.clmsum',)
+
+# directories of the parent calculation the density is copied from, in this order: the case directory, then the
+# scratch directory that `configs/codes/run123_lapw.yml` links as `case/case`. The density of the scratch directory
+# is the most recent one, it is only copied back to the case directory if the job script of the parent reached its
+# end. Missing files are skipped by the engine.
+WARM_START_DIRECTORIES = ('case', 'case/case')
+
+# centring of the conventional cell (first letter of the international symbol) -> WIEN2k lattice type
+_LATTICE_TYPES = {'P': 'P', 'F': 'F', 'I': 'B', 'C': 'CXY', 'B': 'CXZ', 'A': 'CYZ', 'R': 'R'}
+
+# hexagonal (obverse setting) -> rhombohedral fractional coordinates
+_HEX_TO_RHOMBOHEDRAL = np.array([[1.0, -1.0, 0.0], [0.0, 1.0, -1.0], [1.0, 1.0, 1.0]])
+
+# trace of a proper rotation -> order of the rotation
+_ROTATION_ORDERS = {3: 1, 2: 6, 1: 4, 0: 3, -1: 2}
+
+
+def _write_struct(f, lattice, cell, positions, mult, symbols, zza, rmt, rotloc, spacegroup=''):  # noqa: PLR0913
+    """Write a WIEN2k struct file, all atom blocks are formatted in one go.
+    lattice: WIEN2k lattice type, e.g. 'P' or 'CXY'
+    cell: conventional cell [Angstrom], one lattice vector per row
+    positions: fractional positions of all atoms, the MULT equivalent atoms of an inequivalent atom are consecutive
+    mult, symbols, zza, rmt, rotloc: MULT, chemical symbol, nuclear charge, RMT and local rotation matrix
+    of every inequivalent atom
+    spacegroup: space group number and symbol written after the number of inequivalent atoms"""
+    from ase.units import Bohr
+
+    nat = len(mult)
     f.write('ASE generated\n')
-    nat = len(atoms)
-    if rmt is None:
-        rmt = [2.0] * nat
-        f.write(lattice + '   LATTICE,NONEQUIV.ATOMS:%3i\nMODE OF CALC=RELA\n' % nat)
-    cell = atoms.get_cell()
+    f.write('%-4sLATTICE,NONEQUIV.ATOMS:%3i%s\nMODE OF CALC=RELA\n' % (lattice, nat, spacegroup))
     mett = np.dot(cell, np.transpose(cell))
     cell2 = cellconst(mett)
     cell2[0:3] = cell2[0:3] / Bohr
     f.write(('%10.6f' * 6) % tuple(cell2) + '\n')
-    if zza is None:
-        zza = atoms.get_atomic_numbers()
-    for ii in range(nat):
-        f.write('ATOM %3i: ' % (ii + 1))
-        pos = atoms.get_scaled_positions()[ii]
-        f.write('X=%10.8f Y=%10.8f Z=%10.8f\n' % tuple(pos))
-        f.write('          MULT= 1          ISPLIT= 1\n')
-        zz = zza[ii]
-        if zz > 71:
-            ro = 0.000005
-        elif zz > 36:
-            ro = 0.00001
-        elif zz > 18:
-            ro = 0.00005
-        else:
-            ro = 0.0001
-        f.write(
-            '%-10s NPT=%5i  R0=%9.8f RMT=%10.4f   Z:%10.5f\n' % (atoms.get_chemical_symbols()[ii], 781, ro, rmt[ii], zz)
+    zza = np.asarray(zza, dtype=np.float64)
+    ro = np.select([zza > 71, zza > 36, zza > 18], [0.000005, 0.00001, 0.00005], default=0.0001)
+    first = np.concatenate(([0], np.cumsum(mult)[:-1]))
+    f.write(
+        ''.join(
+            _STRUCT_ATOM % (ii + 1, *positions[first[ii]], mult[ii])
+            + ''.join(_STRUCT_EQUIVALENT_ATOM % tuple(pos) for pos in positions[first[ii] + 1 : first[ii] + mult[ii]])
+            + _STRUCT_ATOM_NAME % (symbols[ii], 781, ro[ii], rmt[ii], zza[ii], *np.ravel(rotloc[ii]))
+            for ii in range(nat)
         )
-        f.write('LOCAL ROT MATRIX:    %9.7f %9.7f %9.7f\n' % (1.0, 0.0, 0.0))
-        f.write('                     %9.7f %9.7f %9.7f\n' % (0.0, 1.0, 0.0))
-        f.write('                     %9.7f %9.7f %9.7f\n' % (0.0, 0.0, 1.0))
+    )
     f.write('   0\n')
+
+
+def _atomic_numbers(symbols):
+    """chemical symbols -> atomic numbers"""
+    from aiida.common.constants import elements
+
+    atomic_numbers = {element['symbol']: number for number, element in elements.items()}
+    return [atomic_numbers[symbol] for symbol in symbols]
+
+
+def _structure_arrays(structure):
+    """Return the cell, wrapped fractional positions, kind indices and chemical symbols of the sites of an
+    AiiDA StructureData. Fractional coordinates are computed for all sites at once."""
+    kind_index = {kind.name: index for index, kind in enumerate(structure.kinds)}
+    types = np.array([kind_index[site.kind_name] for site in structure.sites], dtype=np.int64)
+    kind_symbols = [kind.symbol for kind in structure.kinds]
+    symbols = [kind_symbols[index] for index in types]
+    cell = np.array(structure.cell)
+    # Cartesian -> fractional coordinates of all sites, wrapped into the cell along periodic directions
+    positions = np.array([site.position for site in structure.sites]).reshape(len(types), 3)
+    scaled = np.linalg.solve(cell.T, positions.T).T
+    periodic = np.array(structure.pbc)
+    scaled[:, periodic] %= 1.0
+    scaled[:, periodic] %= 1.0  # -1e-17 % 1.0 == 1.0
+    return cell, scaled, types, symbols
+
+
+def write_struct(f, structure, rmt=None, lattice='P', zza=None):
+    """Adapted from ASE.
+    It writes an AiiDA StructureData into a WIEN2k struct file as a StringIO
+    file-like object. Every atom is written as an inequivalent atom (MULT=1)
+    with the identity as local rotation matrix."""
+    cell, scaled, _, symbols = _structure_arrays(structure)
+    nat = len(symbols)
+    if rmt is None:
+        rmt = [2.0] * nat
+    if zza is None:
+        zza = _atomic_numbers(symbols)
+    _write_struct(f, lattice, cell, scaled, [1] * nat, symbols, zza, rmt, [np.eye(3)] * nat)
+    return f  # file-like object
+
+
+def _wien2k_frame(lattice, cell):
+    """Return the conventional lattice vectors (rows) in the Cartesian frame of WIEN2k:
+    b along y for hexagonal and rhombohedral lattices, otherwise a along x and b in the xy plane."""
+    if lattice in ('H', 'R'):
+        aa, cc = np.linalg.norm(cell[0]), np.linalg.norm(cell[2])
+        return np.array([[aa * np.sqrt(3.0) / 2.0, -aa / 2.0, 0.0], [0.0, aa, 0.0], [0.0, 0.0, cc]])
+    _, rr = np.linalg.qr(np.transpose(cell))
+    return (rr * np.sign(np.diag(rr))[:, None]).T
+
+
+def _local_rotation(rotations):
+    """Return the local rotation matrix (rows: local x, y, z axes in global Cartesian coordinates) of a site
+    from the Cartesian operations of its site symmetry group.
+    The local z axis is the axis of the operation of highest order, x the axis of the operation of highest order
+    perpendicular to z (improper operations count with the axis of their proper part). Ties go to the axis
+    closest to the global z (x) axis, so sites whose symmetry axes are the global axes keep the identity."""
+    axes = []
+    for rotation in rotations:
+        proper = rotation * np.linalg.det(rotation)
+        order = _ROTATION_ORDERS[round(np.trace(proper))]
+        if order > 1:
+            values, vectors = np.linalg.eig(proper)
+            axis = np.real(vectors[:, np.argmin(np.abs(values - 1.0))])
+            axes.append((order, axis / np.linalg.norm(axis)))
+
+    def best(candidates, direction):
+        """axis of highest order that is closest to `direction`, with a positive component along it"""
+        signed = []
+        for order, axis in candidates:
+            for component in (np.dot(axis, direction), *axis):  # fix the sign of the axis
+                if abs(component) > 1e-6:
+                    signed.append((order, axis * np.sign(component)))
+                    break
+        if not signed:
+            return None
+        key = lambda item: (item[0], round(abs(np.dot(item[1], direction)), 6), *np.round(item[1], 6))  # noqa: E731
+        return max(signed, key=key)[1]
+
+    zz = best(axes, np.array([0.0, 0.0, 1.0]))
+    if zz is None:
+        zz = np.array([0.0, 0.0, 1.0])
+    xx = best([(order, axis) for order, axis in axes if abs(np.dot(axis, zz)) < 1e-6], np.array([1.0, 0.0, 0.0]))
+    if xx is None:  # project the global x (or y) axis on the plane perpendicular to z
+        for direction in np.eye(3)[:2]:
+            xx = direction - np.dot(direction, zz) * zz
+            if np.linalg.norm(xx) > 1e-6:
+                break
+        xx = xx / np.linalg.norm(xx)
+    rotloc = np.array([xx, np.cross(zz, xx), zz])
+    return np.where(np.abs(rotloc) < 1e-9, 0.0, rotloc)
+
+
+def _struct_symmetry(cell, scaled, types, symprec):
+    """Symmetry analysis of a structure with spglib for its WIEN2k struct file.
+    Return None if no space group is found, otherwise
+    lattice (str): WIEN2k lattice type, 'H' for hexagonal and trigonal P lattices
+    cell (np.ndarray): conventional cell [Angstrom], one lattice vector per row
+    positions (np.ndarray): fractional positions of the atoms in one primitive cell grouped by inequivalent atom
+        (rhombohedral coordinates for the 'R' lattice)
+    orbits (list): (MULT, kind index, local rotation matrix) of every inequivalent atom
+    spacegroup (str): space group number and international symbol"""
+    import spglib
+
+    try:
+        dataset = spglib.get_symmetry_dataset((cell, scaled, types), symprec=symprec)
+    except getattr(spglib, 'SpglibError', ()):  # raised instead of returning None with the new error handling
+        return None
+    if dataset is None:
+        return None
+    centring = dataset.international[0]
+    if centring != 'P' and dataset.number <= 15:
+        # the WIEN2k settings of centred monoclinic lattices differ from spglib, use the primitive cell
+        cell, scaled, types = spglib.standardize_cell((cell, scaled, types), to_primitive=True, symprec=symprec)
+        centring, primitive = 'P', np.arange(len(types))
+    else:
+        cell, scaled, types = dataset.std_lattice, dataset.std_positions, dataset.std_types
+        primitive = dataset.std_mapping_to_primitive
+    # symmetry operations of the idealized cell that is written
+    dataset = spglib.get_symmetry_dataset((cell, scaled, types), symprec=symprec)
+    hexagonal = centring == 'P' and 143 <= dataset.number <= 194
+    lattice = 'H' if hexagonal else _LATTICE_TYPES[centring]
+    # drop the atoms related by centring translations
+    keep = np.sort(np.unique(primitive, return_index=True)[1])
+    equivalent = dataset.equivalent_atoms[keep]
+    frame = np.transpose(_wien2k_frame(lattice, cell))
+    rotations = frame @ dataset.rotations @ np.linalg.inv(frame)
+    groups, orbits = [], []
+    for orbit in dict.fromkeys(equivalent):  # in order of first appearance
+        members = keep[equivalent == orbit]
+        site = scaled[members[0]]
+        shift = np.einsum('nij,j->ni', dataset.rotations, site) + dataset.translations - site
+        on_site = np.all(np.abs(shift - np.round(shift)) < 1e-5, axis=1)
+        groups.append(members)
+        orbits.append((len(members), types[members[0]], _local_rotation(rotations[on_site])))
+    positions = scaled[np.concatenate(groups)]
+    if lattice == 'R':
+        positions = positions @ _HEX_TO_RHOMBOHEDRAL
+    positions = positions % 1.0 % 1.0
+    return lattice, cell, positions, orbits, ' %3i %s' % (dataset.number, dataset.international)
+
+
+def write_symmetric_struct(f, structure, rmt=None, symprec=SYMPREC):
+    """Write an AiiDA StructureData into a WIEN2k struct file with its symmetry.
+    The space group is detected with spglib, the structure is written in its conventional cell with the
+    WIEN2k lattice type of its centring, equivalent atoms are grouped under one ATOM block with their MULT
+    and every inequivalent atom gets the local rotation matrix of its site symmetry. Sites of different
+    kinds are never equivalent. Falls back to `write_struct` if no space group is found.
+    rmt: RMT of every inequivalent atom"""
+    cell, scaled, types, _ = _structure_arrays(structure)
+    symmetry = _struct_symmetry(cell, scaled, types, symprec)
+    if symmetry is None:
+        return write_struct(f, structure, rmt=rmt)
+    lattice, cell, positions, orbits, spacegroup = symmetry
+    symbols = [structure.kinds[kind].symbol for _, kind, _ in orbits]
+    if rmt is None:
+        rmt = [2.0] * len(orbits)
+    _write_struct(
+        f,
+        lattice,
+        cell,
+        positions,
+        [mult for mult, _, _ in orbits],
+        symbols,
+        _atomic_numbers(symbols),
+        rmt,
+        [rotloc for _, _, rotloc in orbits],
+        spacegroup,
+    )
     return f  # file-like object
 
 
 def _cli_options(parameters):
-    """Return command line options for parameters dictionary.
+    """Return command line options for parameters dictionary, sorted by option.
 
     :param dict parameters: dictionary with command line parameters
     """
     options = []
-    for key, value in parameters.items():
+    for key, value in sorted(parameters.items()):
         # Could validate: is key a known command-line option?
         if isinstance(value, bool) and value:
             options.append(f'{key}')
@@ -78,26 +338,208 @@ def _cli_options(parameters):
     return options
 
 
-def aiida_struct2wien2k(aiida_structure):
-    """prepare structure file for WIEN2k"""
-    ase_structure = aiida_structure.get_ase()  # AiiDA -> ASE struct
+def machines_prepend_text(  # noqa: PLR0913
+    num_machines, num_mpiprocs_per_machine, mpiprocs_per_kgroup=1, omp_threads=1, granularity=1, lapw0_parallel=True
+):
+    """Return the job script lines writing the WIEN2k `.machines` file of a parallel run, `None` for a serial run.
+
+    Every machine runs `num_mpiprocs_per_machine // mpiprocs_per_kgroup` k-point groups of `mpiprocs_per_kgroup`
+    MPI ranks each (plain k-point parallel for 1 rank), with `omp_threads` OpenMP threads per rank. With
+    `lapw0_parallel`, lapw0 runs with all MPI ranks of the job. The host names are only known once the job runs,
+    they are taken from the node list of the scheduler (SLURM or PBS, otherwise the host running the job script).
+    The file is written in the working directory of run123_lapw."""
+    if num_machines * num_mpiprocs_per_machine == 1 and omp_threads == 1:
+        return None
+    kgroups = num_mpiprocs_per_machine // mpiprocs_per_kgroup
+    kgroup = '1:${host}' if mpiprocs_per_kgroup == 1 else f'1:${{host}}:{mpiprocs_per_kgroup}'
+    lines = [
+        f'# WIEN2k .machines: {kgroups} k-point groups of {mpiprocs_per_kgroup} MPI ranks on each of '
+        f'{num_machines} machines',
+        _MACHINES_HOSTS % num_machines,
+        'rm -f .machines',
+        f'for host in $(_wien2k_hosts); do for kgroup in $(seq {kgroups}); do echo "{kgroup}" >> .machines; done; done',
+    ]
+    if lapw0_parallel and num_machines * num_mpiprocs_per_machine > 1:
+        lines.append(
+            f'echo "lapw0:$(for host in $(_wien2k_hosts); do printf \'%s:{num_mpiprocs_per_machine} \' "${{host}}"; '
+            'done)" >> .machines'
+        )
+    lines.append(f"printf 'granularity:{granularity}\\nextrafine:1\\n' >> .machines")
+    if omp_threads > 1:
+        lines.append(f"echo 'omp_global:{omp_threads}' >> .machines")
+    return '\n'.join(lines)
+
+
+def walltime_prepend_text(max_wallclock_seconds, margin, poll_seconds=WATCHDOG_POLL_SECONDS):
+    """Return the job script lines starting the watchdog that stops run123_lapw before the wall time limit.
+
+    The watchdog runs in the background and checks the `case.dayfile` every `poll_seconds`. When a new SCF cycle
+    starts such that a further cycle of the length of the longest complete cycle so far would end less than `margin`
+    seconds before `max_wallclock_seconds` (counted from the start of the job script), it creates the `.stop` file of
+    WIEN2k: run_lapw stops at the end of the running cycle, after the mixer wrote the density, which is thus ready to
+    resume from. The watchdog records the stop in `WALLTIME_STOP_FILE` for the parser."""
+    return '\n'.join(
+        [
+            '# stop run123_lapw at the end of an SCF cycle if the next cycle does not fit into the wall time limit',
+            f'rm -f .stop {WALLTIME_STOP_FILE}',
+            '_wien2k_watchdog() {',
+            '  local cycles=0 start=0 longest=0 deadline',
+            f'  while sleep {poll_seconds}; do',
+            '    [ -f case.dayfile ] || continue',
+            f"    set -- $(awk '{_DAYFILE_CYCLES_AWK}' case.dayfile)",
+            '    if [ "$1" != "${cycles}" ]; then cycles=$1; start=${SECONDS}; fi',
+            '    if [ "$2" -gt "${longest}" ]; then longest=$2; fi',
+            f'    deadline=$((start + 2 * longest + {margin}))',
+            f'    if [ "${{longest}}" -gt 0 ] && [ "${{deadline}}" -gt {max_wallclock_seconds} ]; then',
+            '      touch .stop',
+            f'      [ -f {WALLTIME_STOP_FILE} ] || echo "${{SECONDS}} ${{longest}}" > {WALLTIME_STOP_FILE}',
+            '    fi',
+            '  done',
+            '}',
+            '_wien2k_watchdog &',
+            '_wien2k_watchdog_pid=$!',
+        ]
+    )
+
+
+def aiida_struct2wien2k(aiida_structure, symprec=SYMPREC):
+    """prepare structure file for WIEN2k with the symmetry of the structure"""
     # create a file like object for the WIEN2k struct file to avoid writing it to disk
     wien2k_structfile_flo = io.StringIO()
-    # ASE -> WIEN2k, write WIEN2k struct
-    wien2k_structfile_flo = write_struct(f=wien2k_structfile_flo, atoms2=ase_structure)
+    # AiiDA -> WIEN2k, write WIEN2k struct
+    wien2k_structfile_flo = write_symmetric_struct(f=wien2k_structfile_flo, structure=aiida_structure, symprec=symprec)
+    content = bytes(wien2k_structfile_flo.getvalue(), 'utf-8')
     # get proper AiiDA type for a single file (otherwise you cannot return)
     # Here we use bytes file-like object as an input to avoid creating an intermediate file
     # (It happened that the other process can overide such file)
-    wien2k_structfile = SinglefileData(
-        file=io.BytesIO(bytes(wien2k_structfile_flo.getvalue(), 'utf-8')), filename='case.struct'
-    )
+    wien2k_structfile = SinglefileData(file=io.BytesIO(content), filename='case.struct')
+    wien2k_structfile.base.attributes.set(STRUCT_HASH_ATTRIBUTE, hashlib.sha256(content).hexdigest())
 
     return wien2k_structfile  # orm.SinglefileData type
 
 
+def store_struct_file(wien2k_structfile):
+    """Return a stored struct file with the content of `wien2k_structfile` generated by `aiida_struct2wien2k`:
+    an already stored struct file with the same content hash if there is one, otherwise `wien2k_structfile`
+    itself once stored. The lookup is a query on the hash attribute, in the same way as the caching of AiiDA."""
+    builder = QueryBuilder().append(
+        SinglefileData,
+        subclassing=False,
+        filters={
+            f'attributes.{STRUCT_HASH_ATTRIBUTE}': wien2k_structfile.base.attributes.get(STRUCT_HASH_ATTRIBUTE),
+            'attributes.filename': wien2k_structfile.filename,
+        },
+    )
+    stored = builder.first(flat=True)
+    return stored if stored is not None else wien2k_structfile.store()
+
+
+def _validate_machines(job_resource_class, options):
+    """Return an error message if the resources of a parallel run cannot be written into the `.machines` file.
+    Only schedulers that allocate `num_machines` machines with `num_mpiprocs_per_machine` ranks each (e.g. SLURM,
+    PBS) describe the layout of the k-point groups, schedulers with a parallel environment (e.g. SGE) run serially."""
+    if issubclass(job_resource_class, NodeNumberJobResource):
+        return None
+    resources = options.get('resources', {})
+    if (
+        resources.get('tot_num_mpiprocs', 1) > 1
+        or options.get('mpiprocs_per_kgroup', 1) > 1
+        or options.get('omp_threads', 1) > 1
+    ):
+        return (
+            f'the scheduler allocates `{job_resource_class.__name__}` resources without machines, the `.machines` '
+            'file of a parallel run needs `num_machines` and `num_mpiprocs_per_machine`'
+        )
+    return None
+
+
+def validate_inputs(value, _):
+    """Validate the top-level inputs."""
+    computer = getattr(value.get('code'), 'computer', None)
+    if 'parent_folder' in value and computer is not None and value['parent_folder'].computer.uuid != computer.uuid:
+        return 'the `parent_folder` is not on the computer of the `code`, its density cannot be copied'
+    options = value.get('metadata', {}).get('options', {})
+    if computer is not None:
+        error = _validate_machines(computer.get_scheduler().job_resource_class, options)
+        if error is not None:
+            return error
+    num_mpiprocs_per_machine = options.get('resources', {}).get('num_mpiprocs_per_machine')
+    mpiprocs_per_kgroup = options.get('mpiprocs_per_kgroup', 1)
+    if num_mpiprocs_per_machine is not None and num_mpiprocs_per_machine % mpiprocs_per_kgroup:
+        return (
+            f'`num_mpiprocs_per_machine` ({num_mpiprocs_per_machine}) is not a multiple of `mpiprocs_per_kgroup` '
+            f'({mpiprocs_per_kgroup}), the k-point groups cannot fill the machines'
+        )
+
+
+def _canonical_structure(structure, decimals=HASH_DECIMALS):
+    """Return a copy of an AiiDA StructureData in canonical form: lattice vectors and wrapped fractional coordinates
+    rounded to `decimals`, sites sorted by chemical symbol, kind and position."""
+    cell, scaled, types, symbols = _structure_arrays(structure)
+    cell = np.round(cell, decimals) + 0.0  # -0.0 -> 0.0
+    scaled = np.round(scaled, decimals)
+    periodic = np.array(structure.pbc)
+    scaled[:, periodic] %= 1.0
+    scaled += 0.0
+    kind_names = [structure.kinds[index].name for index in types]
+    order = sorted(range(len(types)), key=lambda index: (symbols[index], kind_names[index], *scaled[index]))
+
+    canonical = StructureData(cell=cell.tolist(), pbc=structure.pbc)
+    for kind in sorted(structure.kinds, key=lambda kind: kind.name):
+        canonical.append_kind(kind)
+    for index in order:
+        canonical.append_site(Site(kind_name=kind_names[index], position=(scaled[index] @ cell).tolist()))
+    return canonical
+
+
+def canonical_struct_content(structure):
+    """Return the content of the WIEN2k struct file of an AiiDA StructureData or of a struct file SinglefileData in
+    canonical form, such that a structure and the struct file written from it compare equal.
+    AiiDA structures are written with `write_symmetric_struct` from their `_canonical_structure`. The title line and
+    trailing whitespace are dropped."""
+    if isinstance(structure, StructureData):
+        content = write_symmetric_struct(io.StringIO(), _canonical_structure(structure)).getvalue()
+    else:
+        content = structure.get_content()
+    lines = [line.rstrip() for line in content.splitlines()[1:]]
+    return '\n'.join(lines).rstrip()
+
+
+class Wien2kRun123LapwNodeCaching(CalcJobNodeCaching):
+    """Caching of `Wien2kRun123Lapw` calculations, their hash only depends on what changes their results.
+
+    The `aiida_structure` or `wien2k_structure` input is hashed as the `canonical_struct_content` under the common key
+    'structure', such that equal structures given either way share the hash. The `parameters` input is hashed as the
+    command line options, such that options equal to `False` are ignored."""
+
+    def get_objects_to_hash(self):
+        """Return a list of objects which should be included in the hash."""
+        objects = super().get_objects_to_hash()
+        inputs = objects['inputs']
+        for link in self._node.base.links.get_incoming(link_type=LinkType.INPUT_CALC):
+            if link.link_label in ('aiida_structure', 'wien2k_structure'):
+                inputs.pop(link.link_label)
+                inputs['structure'] = canonical_struct_content(link.node)
+            elif link.link_label == 'parameters':
+                inputs['parameters'] = _cli_options(link.node.get_dict())
+        return objects
+
+
+class Wien2kRun123LapwNode(CalcJobNode):
+    """Node of a `Wien2kRun123Lapw` calculation, with a process hash suited for caching."""
+
+    _CLS_NODE_CACHING = Wien2kRun123LapwNodeCaching
+
+    @classproperty
+    def _hash_ignored_attributes(cls):  # noqa: N805
+        return super()._hash_ignored_attributes + HASH_IGNORED_OPTIONS
+
+
 class Wien2kRun123Lapw(CalcJob):
     """AiiDA calculation plugin to run WIEN2k calculation using run123_lapw."""
 
+    _node_class = Wien2kRun123LapwNode
+
     @classmethod
     def define(cls, spec):
         """Define inputs and outputs of the calculation."""
@@ -113,19 +555,122 @@ class Wien2kRun123Lapw(CalcJob):
             help='WIEN2k input structure file case.struct',
         )
         spec.input('aiida_structure', valid_type=StructureData, required=False, help='AiiDA input structure')
+        spec.input(
+            'parent_folder',
+            valid_type=RemoteData,
+            required=False,
+            help='Remote folder of a converged calculation of a similar structure on the same computer, the SCF '
+            'cycle starts from its density',
+        )
+        spec.inputs.validator = validate_inputs
         spec.inputs['metadata']['options']['resources'].default = {
             'num_machines': 1,
             'num_mpiprocs_per_machine': 1,
         }
         spec.inputs['metadata']['options']['parser_name'].default = 'wien2k-scf123-parser'
+        spec.input(
+            'metadata.options.parser_max_workers',
+            valid_type=int,
+            default=1,
+            help='Number of threads used to parse the precision stages concurrently (1: sequential parsing)',
+        )
+        spec.input(
+            'metadata.options.minimal_retrieval',
+            valid_type=bool,
+            default=False,
+            help='Retrieve the SCF output files only temporarily for parsing, such that the repository only keeps '
+            'case.struct, the error files and the parsed outputs',
+        )
+        spec.input(
+            'metadata.options.compress_outputs',
+            valid_type=bool,
+            default=False,
+            help='Compress the SCF output files with gzip on the remote before they are retrieved, the parser '
+            'decompresses them on the fly. They are compressed in the working directory of run123_lapw, a code '
+            '`append_text` that copies the output files elsewhere has to copy `*.gz` as well',
+        )
+
+        spec.input(
+            'metadata.options.mpiprocs_per_kgroup',
+            valid_type=int,
+            default=1,
+            help='Number of MPI ranks of every k-point group of a parallel run (1: k-point parallel only)',
+        )
+        spec.input(
+            'metadata.options.omp_threads',
+            valid_type=int,
+            default=1,
+            help='Number of OpenMP threads of every MPI rank of a parallel run',
+        )
+        spec.input(
+            'metadata.options.kpoint_granularity',
+            valid_type=int,
+            default=1,
+            help='Granularity of the distribution of the k-points over the k-point groups of a parallel run',
+        )
+        spec.input(
+            'metadata.options.lapw0_parallel',
+            valid_type=bool,
+            default=True,
+            help='Run lapw0 with all MPI ranks of a parallel run',
+        )
+        spec.input(
+            'metadata.options.walltime_stop',
+            valid_type=bool,
+            default=True,
+            help='Stop the SCF cycle at the end of a cycle if the next cycle does not fit into '
+            '`max_wallclock_seconds`, instead of being killed by the scheduler in the middle of a cycle',
+        )
+        spec.input(
+            'metadata.options.walltime_stop_margin',
+            valid_type=int,
+            default=300,
+            help='Seconds kept free before `max_wallclock_seconds` by `walltime_stop`, e.g. to copy the output files',
+        )
 
         spec.output('scf_grep', valid_type=Dict, help='WIEN2k SCF output dictionary')
-        spec.output('aiida_structure_out', valid_type=StructureData, required=True, help='AiiDA output structure')
+        spec.output(
+            'aiida_structure_out',
+            valid_type=StructureData,
+            required=False,
+            help='AiiDA output structure, only if it differs from the input `aiida_structure`',
+        )
+        spec.output(
+            'scf_history', valid_type=ArrayData, required=False, help='WIEN2k SCF quantities of every iteration'
+        )
+        spec.output(
+            'dayfile_timings',
+            valid_type=ArrayData,
+            required=False,
+            help='User/system/wall time and CPU usage of every program in every SCF cycle',
+        )
+        spec.output(
+            'dayfile_timings_summary',
+            valid_type=Dict,
+            required=False,
+            help='Total wall time of every program and mean wall time per SCF cycle',
+        )
         # exit codes
         spec.exit_code(400, 'ERROR_ITER_0', message='Unable to perform even a single SCF iteration.')
         spec.exit_code(
             401, 'ERROR_MISSING_OUTPUT_FILES', message='Calculation did not produce all expected output files.'
         )
+        spec.exit_code(
+            402,
+            'ERROR_SCF_INCOMPLETE',
+            message='The SCF cycle was interrupted, the results of the last complete iteration were salvaged.',
+        )
+        spec.exit_code(
+            405,
+            'ERROR_SCF_STOPPED_WALLTIME',
+            message='The SCF cycle was stopped at the end of a cycle before the wall time limit, it can be resumed.',
+        )
+        spec.exit_code(
+            403, 'ERROR_SCF_DIVERGED', message='The SCF cycle diverged and was stopped by the `wien2k.scf` monitor.'
+        )
+        spec.exit_code(
+            404, 'ERROR_SCF_STALLED', message='The SCF cycle stalled and was stopped by the `wien2k.scf` monitor.'
+        )
         spec.exit_code(302, 'WARNING_QTL_B', message='WARN: QTL-B in the last iteration.')
         spec.exit_code(312, 'WARNING_QTL_B1', message='WARN: QTL-B in the last iteration prec1.')
         spec.exit_code(322, 'WARNING_QTL_B2', message='WARN: QTL-B in the last iteration prec2.')
@@ -156,21 +701,45 @@ class Wien2kRun123Lapw(CalcJob):
         :return: `aiida.common.datastructures.CalcInfo` instance
         """
         codeinfo = datastructures.CodeInfo()
-        if 'parameters' in self.inputs:
-            parameters = _cli_options(self.inputs.parameters.get_dict())  # command line args for init_lapw
-            codeinfo.cmdline_params = parameters  # x exec [parameters]
+        options = self.inputs.metadata.options
+        parameters = self.inputs.parameters.get_dict() if 'parameters' in self.inputs else {}
+        # parallel run: .machines from the allocated resources
+        scheduler = self.node.computer.get_scheduler()
+        error = _validate_machines(scheduler.job_resource_class, options)
+        if error is not None:  # code without computer, not checked by `validate_inputs`
+            raise InputValidationError(error)
+        machines = None
+        if issubclass(scheduler.job_resource_class, NodeNumberJobResource):
+            resources = scheduler.create_job_resource(**options.resources)
+            machines = machines_prepend_text(
+                resources.num_machines,
+                resources.num_mpiprocs_per_machine,
+                mpiprocs_per_kgroup=options.mpiprocs_per_kgroup,
+                omp_threads=options.omp_threads,
+                granularity=options.kpoint_granularity,
+                lapw0_parallel=options.lapw0_parallel,
+            )
+        if machines is not None:
+            parameters = {'-p': True, **parameters}
+        if parameters:
+            codeinfo.cmdline_params = _cli_options(parameters)  # command line args for init_lapw, x exec [parameters]
 
         codeinfo.code_uuid = self.inputs.code.uuid
         codeinfo.stdout_name = 'run123_lapw.log'
 
         # convert AiiDA structure -> WIEN2k
         if 'aiida_structure' in self.inputs:
-            aiida2wien_structfile = aiida_struct2wien2k(self.inputs.aiida_structure)
-            aiida2wien_structfile.store()
+            aiida2wien_structfile = store_struct_file(aiida_struct2wien2k(self.inputs.aiida_structure))
 
         # Prepare a `CalcInfo` to be returned to the engine
         calcinfo = datastructures.CalcInfo()
         calcinfo.codes_info = [codeinfo]
+        prepend_text = [] if machines is None else [machines]
+        append_text = []
+        if options.walltime_stop and options.get('max_wallclock_seconds') is not None:
+            prepend_text.append(walltime_prepend_text(options.max_wallclock_seconds, options.walltime_stop_margin))
+            append_text.append(_WATCHDOG_STOP)
+        calcinfo.prepend_text = '\n'.join(prepend_text) or None
         if 'wien2k_structure' in self.inputs:  # WIEN2k structure is given as input
             calcinfo.local_copy_list = [
                 (
@@ -183,18 +752,41 @@ class Wien2kRun123Lapw(CalcJob):
             calcinfo.local_copy_list = [
                 (aiida2wien_structfile.uuid, aiida2wien_structfile.filename, 'case/case.struct')
             ]  # copy case.struct to the local folder as new.struct
-        calcinfo.remote_copy_list = []  # none
-        calcinfo.retrieve_list = [
+        calcinfo.remote_copy_list = []
+        if 'parent_folder' in self.inputs:  # copy the density, the SCF cycle overwrites it
+            parent_folder = self.inputs.parent_folder
+            calcinfo.remote_copy_list = [
+                (parent_folder.computer.uuid, os.path.join(parent_folder.get_remote_path(), directory, fname), 'case/')
+                for directory in WARM_START_DIRECTORIES
+                for fname in WARM_START_FILES
+            ]
+        # the structure and error files are small, the SCF output files are only needed for parsing
+        retrieve_list = [('case/*.error*'), ('case/case.struct'), f'case/{WALLTIME_STOP_FILE}']
+        parse_list = [
             ('case/*.scf0'),
             ('case/*.scf1'),
             ('case/*.scf2'),
             ('case/*.scfm'),
             ('case/*.scfc'),
-            ('case/*.error*'),
             ('case/*.dayfile'),
             ('case/*.klist'),
             ('case/*.in0'),
-            ('case/case.struct'),
         ]
+        # the cumulative SCF files repeat the per-iteration files, they are only parsed (into `scf_history` if the
+        # run was interrupted) and never stored
+        temporary_list = [('case/*.scf')]
+        if options.compress_outputs:
+            # compress the SCF output files in the working directory of run123_lapw once it is done
+            patterns = temporary_list + parse_list
+            append_text.append(f'gzip -f {" ".join(pattern.split("/")[-1] for pattern in patterns)} 2> /dev/null')
+            parse_list = [pattern + COMPRESSED_SUFFIX for pattern in parse_list]
+            temporary_list = [pattern + COMPRESSED_SUFFIX for pattern in temporary_list]
+        calcinfo.append_text = '\n'.join(append_text) or None
+        if options.minimal_retrieval:
+            calcinfo.retrieve_list = retrieve_list
+            calcinfo.retrieve_temporary_list = parse_list + temporary_list
+        else:
+            calcinfo.retrieve_list = parse_list + retrieve_list
+            calcinfo.retrieve_temporary_list = temporary_list
 
         return calcinfo
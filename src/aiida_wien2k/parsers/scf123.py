@@ -1,100 +1,434 @@
+from __future__ import annotations
+
+import concurrent.futures
+import contextlib
+import cProfile
+import functools
+import gzip
 import io
+import itertools
+import math
+import mmap
+import os
+import pathlib
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+import typing as t
 
 import numpy as np
 from aiida.engine import ExitCode
-from aiida.orm import Dict, StructureData
+from aiida.orm import ArrayData, Dict, StructureData
 from aiida.parsers.parser import Parser
-from aiida.plugins import CalculationFactory
-from ase import Atoms
-from ase.units import Bohr
-from fuzzywuzzy import fuzz
-
-
-def _grep(key, pip):
-    """ "Serach patterns in lines `pip` that start with `key` only last iteration"""
-    for line in pip.splitlines():  # search backward
-        if key == ':ENE':  # total energy [Ry]
-            if line[0 : len(key)] == key:
-                cut = line.rsplit(sep='=', maxsplit=-1)[1]
-                value = float(cut)
-                return value
-        elif key == ':VOL':  # cell folume [Borh3]
-            if line[0 : len(key)] == key:
-                cut = line.rsplit(sep='=', maxsplit=-1)[1]
-                value = float(cut)
-                return value
-        elif key == ':FER':  # Fermi energy [Ry]
-            if line[0 : len(key)] == key:
-                cut = line.rsplit(sep='=', maxsplit=-1)[1]
-                value = float(cut)
-                return value
-        elif key == ':ITE':  # Iteration number
-            if line[0 : len(key)] == key:
-                cut = line.rsplit(sep=':', maxsplit=-1)[-1]
-                cut = cut.rsplit(sep='.', maxsplit=-1)[0]
-                value = int(cut)
-                return value
-        elif key == ':GAP':  # Band gap [eV]
-            if line[0 : len(key)] == key:
-                cut = line.rsplit(sep='=', maxsplit=-1)[-1]
-                cut = cut.rsplit(sep=' eV ', maxsplit=-1)[0]
-                value = float(cut)
-                return value
-        elif key == ':WAR':  # warnings
-            if line[0 : len(key)] == key:
-                value = line
-                return value
-        elif key == 'k mesh':
-            if '(' in line:  # the line contains bracket (nkx nky nkz)
-                cut = line.rsplit(sep='(', maxsplit=-1)[1]  # get 'nkx nky nkz)'
-                cut = cut.rsplit(sep=')', maxsplit=-1)[0]  # get 'nkx nky nkz'
-                cut = cut[:3] + ' ' + cut[3:6] + ' ' + cut[6:]  # convert 182182182 -> 182 182 182
-                value = cut.strip()  # trim white spaces
-                return value
-        elif key == 'FFT mesh':
-            if 'IFFT-parameters' in line:  # the line contains FFT (nkx nky nkz)
-                cut = line.rsplit()[0:3]  # get 'nkx nky nkz'
-                value = cut[0] + ' ' + cut[1] + ' ' + cut[2]  # join values
-                return value
-        elif key == '-TS':  # the entropy contrubution to the free energy (Ry)
-            if '-(T*S)' in line:  # the line contains '  -(T*S)            =  -0.00441718'
-                cut = line.rsplit()  # split by spaces
-                value = cut[2]  # get '-0.00441718'
-                return value
-        elif line[0 : len(key)] == key:  # generic grep option not implemented
-            value = line
-            return value
-
-    return None  # return none if no match found
-
-
-def _grep_all_instances(key, pip):
-    """ "Serach patterns in lines `pip` that start with `key` and return all instances as a list"""
-    value = []  # set up as a list
-    for line in pip.splitlines():  # search backward
-        if key == ':CHA':  # search for Rmt's
-            if line[0 : len(key)] == key:
-                # :CHA001: TOTAL VALENCE CHARGE INSIDE SPHERE   1 =   6.7577    (RMT=  1.5800 )
-                cut = line.rsplit(sep='RMT=', maxsplit=-1)
-                if len(cut) > 1:  # line contains 'RMT='
-                    cut = cut[1]  # get '1.5800 )'
-                    cut = cut.rsplit(sep=')', maxsplit=-1)[0]  # get '1.5800'
-                    value.append(float(cut))
-        elif key == ':POS':  # serach for atom labels
-            if line[0 : len(key)] == key:
-                # :POS001: ATOM    1 X,Y,Z = 0.00000 0.00000 0.00000  MULT= 1  ZZ= 14.000  Si1
-                cut = line[73:75]  # get exact positions (fixed format)
-                value.append(cut.strip())  # remove trailing spaces before appending
-        elif key == ':CINT':  # search for the number of core electrons
-            if line[0 : len(key)] == key:
-                # :CINT001 Core Integral Atom   1    3.99550337
-                cut = line.rsplit(sep='Core Integral Atom', maxsplit=-1)[1]  # get '1    3.99550337'
-                cut = cut.split()[1]  # get '3.99550337'
-                value.append(int(round(float(cut))))
-
-    return value
-
-    return None  # return none if no match found
+from aiida_wien2k.calculations.run123_lapw import (
+    COMPRESSED_SUFFIX,
+    MONITOR_EXTRA,
+    WALLTIME_STOP_FILE,
+    aiida_struct2wien2k,
+)
+
+
+class _Extractor(t.NamedTuple):
+    """Declarative description of a quantity that is extracted from the lines of a WIEN2k output file.
+
+    :param match: bound ``match`` or ``search`` method of a precompiled pattern, applied to every line.
+    :param convert: converts the match object of a matching line into the extracted value.
+    :param multiple: collect all instances in a list, otherwise only the first instance is kept.
+    """
+
+    match: t.Callable[[str], t.Optional[re.Match]]
+    convert: t.Callable[[re.Match], t.Any]
+    multiple: bool = False
+
+
+def _kmesh(match):
+    """Convert the k mesh divisions `(nkxnkynkz)` of a `*.klist` file into 'nkx nky nkz'."""
+    cut = match.group(1)
+    return (cut[:3] + ' ' + cut[3:6] + ' ' + cut[6:]).strip()  # convert 182182182 -> 182 182 182
+
+
+# key -> extractor, every key is searched for in a single pass over a file by `_scan`
+_EXTRACTORS = {
+    # :ENE  : ********** TOTAL ENERGY IN Ry =       -14238.10360884
+    ':ENE': _Extractor(re.compile(r':ENE[^=]*=([^=]*)').match, lambda m: float(m.group(1))),
+    # :VOL  : UNIT CELL VOLUME =     233.10302
+    ':VOL': _Extractor(re.compile(r':VOL[^=]*=([^=]*)').match, lambda m: float(m.group(1))),
+    # :FER  : F E R M I - ENERGY(FERMI-SM.)=   0.3347787693
+    ':FER': _Extractor(re.compile(r':FER[^=]*=([^=]*)').match, lambda m: float(m.group(1))),
+    # :ITE015: 15. ITERATION
+    ':ITE': _Extractor(re.compile(r':ITE.*:([^:.]*)').match, lambda m: int(m.group(1))),
+    # :GAP  :    0.0123 Ry =     0.1677 eV (provisional)
+    ':GAP': _Extractor(re.compile(r':GAP.*=(.*?)(?: eV |$)').match, lambda m: float(m.group(1))),
+    # :WARN : QTL-B value eq.   2.17 in Band of energy   0.84994  ATOM=    1  L=  3
+    ':WAR': _Extractor(re.compile(r':WAR').match, lambda m: m.string),
+    # 1   0   0   0   37  1.0 -7.0  1.5   0 k, div: ( 37 37 37)
+    'k mesh': _Extractor(re.compile(r'\(([^()]*)').search, _kmesh),
+    # 64  64  64      3.00  1 NCON 9  # min IFFT-parameters, enhancement factor, iprint, NCON n
+    'FFT mesh': _Extractor(re.compile(r'IFFT-parameters').search, lambda m: ' '.join(m.string.split()[0:3])),
+    # -(T*S)            =  -0.00441718
+    '-TS': _Extractor(re.compile(r'-\(T\*S\)').search, lambda m: m.string.split()[2]),
+    # :CHA001: TOTAL VALENCE CHARGE INSIDE SPHERE   1 =   6.7577    (RMT=  1.5800 )
+    ':CHA': _Extractor(re.compile(r':CHA.*?RMT=([^)]*)').match, lambda m: float(m.group(1)), multiple=True),
+    # :POS001: ATOM    1 X,Y,Z = 0.00000 0.00000 0.00000  MULT= 1  ZZ= 14.000  Si1
+    ':POS': _Extractor(re.compile(r':POS').match, lambda m: m.string[73:75].strip(), multiple=True),
+    # :CINT001 Core Integral Atom   1    3.99550337
+    ':CINT': _Extractor(
+        re.compile(r':CINT.*?Core Integral Atom(.*)').match,
+        lambda m: int(round(float(m.group(1).split()[1]))),
+        multiple=True,
+    ),
+    # :DIS  :  CHARGE DISTANCE       ( 0.0000007 for atom    1 spin 1)      0.0000007
+    ':DIS': _Extractor(re.compile(r':DIS.*\s(\S+)\s*$').match, lambda m: float(m.group(1))),
+    # convergence of the final and of the intermediate SCF cycles in `*.dayfile`
+    'ec cc fc and str_conv 1 1 1 1': _Extractor(re.compile(r'ec cc fc and str_conv 1 1 1 1').match, lambda m: m.string),
+    'ec cc and fc_conv 1 1 1': _Extractor(re.compile(r'ec cc and fc_conv 1 1 1').match, lambda m: m.string),
+}
+
+
+def _scan(content, keys):
+    """Extract all `keys` from the text `content` in a single pass over its lines.
+
+    The lines are matched against the precompiled patterns of `_EXTRACTORS`. The scan stops as soon as all
+    single-instance keys are found, unless a multiple-instance key is requested.
+
+    Return:
+    found (dict): value of the first instance for each key (list of all instances for multiple-instance keys),
+    `None` if a single-instance key was not found
+    """
+    pending = [(key, _EXTRACTORS[key]) for key in keys]
+    found = {key: [] if extractor.multiple else None for key, extractor in pending}
+    for line in content.splitlines():
+        for key, extractor in pending:
+            match = extractor.match(line)
+            if match is None:
+                continue
+            if extractor.multiple:
+                found[key].append(extractor.convert(match))
+            else:
+                found[key] = extractor.convert(match)
+                pending = [item for item in pending if item[0] != key]
+        if not pending:  # all keys found
+            break
+
+    return found
+
+
+# result key -> key of the quantities recorded for every SCF iteration by `_iter_scf_history`
+_HISTORY_KEYS = {
+    'EtotRyd': ':ENE',
+    'DisCharge': ':DIS',
+    'EfermiRyd': ':FER',
+    'mTSRyd': '-TS',
+    'GapEv': ':GAP',
+}
+
+
+def _iter_scf_history(lines):
+    """Yield one record per SCF iteration found in the `lines` of a WIEN2k `*.scf` file.
+
+    `lines` can be any iterable of lines, e.g. an open file, such that the file is streamed and never held in memory.
+    Iterations start with an ':ITE' line, lines before the first iteration are ignored.
+
+    Yield:
+    record (dict): iteration number 'Iter' and the first instance of each quantity of `_HISTORY_KEYS`
+    in the iteration, `nan` if the quantity is not found
+    """
+    iteration = _EXTRACTORS[':ITE']
+    record = None
+    pending = ()
+    for line in lines:
+        match = iteration.match(line)
+        if match is not None:
+            if record is not None:
+                yield record
+            record = dict.fromkeys(_HISTORY_KEYS, math.nan)
+            record['Iter'] = iteration.convert(match)
+            pending = tuple(_HISTORY_KEYS.items())
+            continue
+        for result_key, key in pending:
+            extractor = _EXTRACTORS[key]
+            match = extractor.match(line)
+            if match is not None:
+                record[result_key] = float(extractor.convert(match))
+                pending = tuple(item for item in pending if item[0] != result_key)
+                break
+
+    if record is not None:
+        yield record
+
+
+def _history_arrays(lines, suffix=''):
+    """Return the SCF history of the `lines` of a WIEN2k `*.scf` file as a dictionary of arrays.
+    Array names are the keys of `_HISTORY_KEYS` and 'Iter' with `suffix`."""
+    columns = {key: [] for key in ('Iter', *_HISTORY_KEYS)}
+    for record in _iter_scf_history(lines):
+        for key, column in columns.items():
+            column.append(record[key])
+
+    history = {f'Iter{suffix}': np.array(columns.pop('Iter'), dtype=np.int64)}
+    for key, column in columns.items():
+        history[f'{key}{suffix}'] = np.array(column, dtype=np.float64)
+
+    return history
+
+
+# >   lapw1        (23:21:16) 31.846u 6.707s 0:38.69 99.6% 0+0k 0+141288io 0pf+0w
+_DAYFILE_TIMING = re.compile(r'>\s+(\S+)[^(]*\(\d+:\d+:\d+\)\s+([\d.]+)u\s+([\d.]+)s\s+([\d:.]+)\s+([\d.]+)%')
+#     cycle 1  (Wed Mar  9 23:21:04 CET 2022)  (100/99 to go)
+_DAYFILE_CYCLE = re.compile(r'\s+cycle\s+\d+')
+
+
+def _elapsed_seconds(elapsed):
+    """Convert the elapsed time '[h:]m:ss.ss' of a `*.dayfile` into seconds."""
+    seconds = 0.0
+    for field in elapsed.split(':'):
+        seconds = seconds * 60.0 + float(field)
+    return seconds
+
+
+def _read_dayfile_timings(lines):
+    """Collect the timings of every program in every SCF cycle from the `lines` of a WIEN2k `*.dayfile`.
+
+    `lines` can be any iterable of lines, e.g. an open file. Programs that run several times in one cycle
+    (e.g. spin up/down) are accumulated. Lines before the first cycle are ignored.
+
+    Return:
+    timings (dict): program -> array of shape (number of cycles, 4) with the user, system and wall time [s]
+    and the CPU usage [%] of the program in each cycle, `nan` for cycles in which the program did not run
+    """
+    cycles = []  # program -> [user, sys, wall, cpu] for each cycle
+    programs = {}  # programs in the order of appearance
+    for line in lines:
+        if _DAYFILE_CYCLE.match(line):
+            cycles.append({})
+            continue
+        match = _DAYFILE_TIMING.match(line)
+        if match is None or not cycles:
+            continue
+        program = match.group(1)
+        user, system, wall = float(match.group(2)), float(match.group(3)), _elapsed_seconds(match.group(4))
+        programs[program] = None
+        if program in cycles[-1]:  # the program ran several times in this cycle
+            timing = cycles[-1][program]
+            timing[0:3] = timing[0] + user, timing[1] + system, timing[2] + wall
+            timing[3] = 100.0 * (timing[0] + timing[1]) / timing[2] if timing[2] > 0 else math.nan
+        else:
+            cycles[-1][program] = [user, system, wall, float(match.group(5))]
+
+    timings = {}
+    for program in programs:
+        timings[program] = np.full((len(cycles), 4), np.nan)
+        for icycle, cycle in enumerate(cycles):
+            if program in cycle:
+                timings[program][icycle] = cycle[program]
+
+    return timings
+
+
+# extension -> start of the line that opens a new SCF iteration, only the last iteration of these files is parsed
+_LAST_BLOCK_DELIMITERS = {
+    'scf0': b':ITE',
+    'scf1': b':ITE',
+    'scf2': b':ITE',
+    'scfm': b':ITE',
+    'scfc': b':ITE',
+    'dayfile': b'    cycle ',
+}
+
+
+def _read_last_block(handle, delimiter, blocksize=65536):
+    """Read the binary file `handle` backward from its end until the last line that starts with `delimiter`.
+
+    The file is read in blocks of `blocksize` bytes, so the cost depends on the size of the last iteration
+    and not on the length of the whole SCF run.
+
+    Return:
+    content (str): text from the last line starting with `delimiter` to the end of the file,
+    the whole file content if there is no such line
+    """
+    marker = b'\n' + delimiter
+    handle.seek(0, io.SEEK_END)
+    position = handle.tell()  # packed repository objects do not return the new position from `seek`
+    blocks = []
+    while position > 0:
+        size = min(blocksize, position)
+        position -= size
+        handle.seek(position)
+        block = handle.read(size)
+        # include the start of the previous block to find a marker that is split across the block boundary
+        window = block + (blocks[-1][: len(marker) - 1] if blocks else b'')
+        blocks.append(block)
+        index = window.rfind(marker)
+        if index >= 0:
+            return b''.join(reversed(blocks))[index + 1 :].decode()
+
+    return b''.join(reversed(blocks)).decode()  # the delimiter is on the first line or not present at all
+
+
+def _iter_stream_lines(handle, blocksize=65536):
+    """Yield the lines of the binary stream `handle` from its start, read in blocks of `blocksize` bytes.
+
+    Only `seek` and `read` are used: packed repository objects can neither be iterated nor read line by line."""
+    handle.seek(0)
+    rest = b''
+    while True:
+        block = handle.read(blocksize)
+        if not block:
+            break
+        lines = (rest + block).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if rest:
+        yield rest
+
+
+def _stream_last_block(handle, delimiter):
+    """Read the binary stream `handle` forward line by line, keeping only the lines from the last line that starts
+    with `delimiter`. For compressed streams, which cannot be read backward.
+
+    Return:
+    content (str): text from the last line starting with `delimiter` to the end of the stream,
+    the whole content if there is no such line
+    """
+    block = []
+    for line in _iter_stream_lines(handle):
+        if line.startswith(delimiter):
+            block = []
+        block.append(line)
+    return b''.join(block).decode()
+
+
+class _RetrievedFiles:
+    """Read access to the files of a retrieved folder for the duration of a single parse.
+
+    The folder is listed once and every file is opened at most once, in binary mode. Files that are stored as plain
+    files in the repository are memory mapped, such that only the byte ranges that are needed are read and decoded.
+    Other files (e.g. packed repository objects) fall back to the seekable binary stream.
+    The files of the local `temporary_folder` (of `retrieve_temporary_list`), if given, are served alongside the files
+    of the retrieved folder.
+    Files compressed with gzip (`*.gz`) are listed under their uncompressed name and decompressed as a stream.
+    Mirrors `list_object_names` and `get_object_content` of `FolderData`. Use as a context manager.
+    Files can be requested from several threads, as long as each file is only consumed by one thread at a time.
+    """
+
+    def __init__(self, folder, temporary_folder=None):
+        self._folder = folder
+        self._temporary_folder = temporary_folder
+        self._openers = None
+        self._files = {}
+        self._stack = contextlib.ExitStack()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._files.clear()
+        self._stack.close()
+
+    def _list(self):
+        """Return file name -> function that opens the file in binary mode, the folders are only listed once."""
+        with self._lock:
+            if self._openers is None:
+                openers = {}
+                if self._temporary_folder is not None:
+                    for path in pathlib.Path(self._temporary_folder).iterdir():
+                        if path.is_file():
+                            openers[path.name] = functools.partial(open, path, 'rb')
+                for fname in self._folder.list_object_names():
+                    openers[fname] = functools.partial(self._folder.open, fname, 'rb')
+                # uncompressed files take precedence over compressed files of the same name
+                self._openers = {
+                    fname[: -len(COMPRESSED_SUFFIX)]: (opener, True)
+                    for fname, opener in openers.items()
+                    if fname.endswith(COMPRESSED_SUFFIX)
+                }
+                self._openers.update(
+                    (fname, (opener, False))
+                    for fname, opener in openers.items()
+                    if not fname.endswith(COMPRESSED_SUFFIX)
+                )
+        return self._openers
+
+    def list_object_names(self):
+        """Return the names of the files retrieved."""
+        return list(self._list())
+
+    def _get(self, fname):
+        """Return the memory map of the file `fname`, or its binary stream if the file cannot be memory mapped
+        (decompressed on the fly for compressed files)."""
+        opener, compressed = self._list()[fname]
+        with self._lock:
+            if fname not in self._files:
+                handle = self._stack.enter_context(opener())
+                if compressed:
+                    data = self._stack.enter_context(gzip.GzipFile(fileobj=handle, mode='rb'))
+                    self._files[fname] = data
+                    return data
+                try:
+                    data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+                except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                    data = handle  # not a plain file or empty file
+                else:
+                    self._stack.callback(data.close)
+                self._files[fname] = data
+            return self._files[fname]
+
+    def get_object_content(self, fname):
+        """Return the decoded content of the file `fname`."""
+        data = self._get(fname)
+        if isinstance(data, mmap.mmap):
+            return data[:].decode()
+        data.seek(0)
+        return data.read().decode()
+
+    def get_last_block(self, fname, delimiter):
+        """Return the decoded content of the file `fname` from the last line that starts with `delimiter`."""
+        data = self._get(fname)
+        if isinstance(data, mmap.mmap):
+            return data[data.rfind(b'\n' + delimiter) + 1 :].decode()  # whole content if not found
+        if isinstance(data, gzip.GzipFile):
+            return _stream_last_block(data, delimiter)
+        return _read_last_block(data, delimiter)
+
+    def iter_lines(self, fname):
+        """Yield the decoded lines of the file `fname` one by one."""
+        data = self._get(fname)
+        if isinstance(data, mmap.mmap):
+            start, size = 0, len(data)
+            while start < size:
+                end = data.find(b'\n', start) + 1 or size
+                yield data[start:end].decode()
+                start = end
+        else:
+            for line in _iter_stream_lines(data):
+                yield line.decode()
+
+
+# families of warnings, as named in the exit codes `WARNING_<family>` of `Wien2kRun123Lapw`
+_WARNING_FAMILIES = re.compile(
+    r'(?P<QTL_B>QTL-B)'  # :WARN : QTL-B value eq.   2.17 in Band of energy   0.84994  ATOM=    1  L=  3
+    r'|(?P<VK_COUL>VK-COUL)'  # :WARN : VK-COUL not well converged: Increase GMAX or decrease NCON
+    r'|(?P<INT>RESULT OF INTEGRATION)'  # :WARN : RESULT OF INTEGRATION SHOULD BE ...
+    r'|(?P<CONVERG>not converged)'  # Warning: SCF not converged (added by the parser)
+)
+
+
+def _classify_warnings(messages):
+    """Classify the warning `messages` of a precision stage into one family of `_WARNING_FAMILIES`.
+
+    A non-converged SCF cycle takes precedence, otherwise the family of the first known message is returned.
+
+    Return:
+    family (str): name of the family, 'OTHER' if none of the messages is known
+    """
+    families = [match.lastgroup for match in map(_WARNING_FAMILIES.search, messages) if match is not None]
+    if 'CONVERG' in families:
+        return 'CONVERG'
+    return families[0] if families else 'OTHER'
 
 
 def check_error_files(files, errending, logger):
@@ -122,9 +456,13 @@ def check_error_files(files, errending, logger):
 
 
 def read_struct(fd, ase=True):
-    """Copied from ASE.
+    """Adapted from ASE.
     WIEN2k -> ASE structure converter.
-    fd: WIEN2k file-like object"""
+    fd: WIEN2k file-like object
+    ase: return ASE Atoms, otherwise the arrays (cell, lattice, pos, atomtype, rmt, mult) where the arrays
+    `pos`, `atomtype` and `rmt` have one entry per atom and `mult` one per inequivalent atom"""
+    from ase.units import Bohr  # ASE is only imported when a structure is read
+
     pip = fd.readlines()
     lattice = pip[1][0:3]
     nat = int(pip[1][27:30])
@@ -151,41 +489,31 @@ def read_struct(fd, ase=True):
         lattice = 'A'
     else:
         raise RuntimeError('TEST needed')
-    pos = np.array([])
-    atomtype = []
-    rmt = []
-    neq = np.zeros(nat)
+    # locate the atom blocks in one pass over the inequivalent atoms:
+    # position, MULT, MULT-1 equivalent positions, name/RMT line, 3 LOCAL ROT MATRIX lines
+    pos_lines = []  # indices of all position lines
+    name_lines = []  # indices of the name line of each inequivalent atom
+    mult = np.empty(nat, dtype=np.int64)
     iline = 4
-    indif = 0
     for iat in range(nat):
-        indifini = indif
-        if len(pos) == 0:
-            pos = np.array([[float(pip[iline][12:22]), float(pip[iline][25:35]), float(pip[iline][38:48])]])
-        else:
-            pos = np.append(
-                pos,
-                np.array([[float(pip[iline][12:22]), float(pip[iline][25:35]), float(pip[iline][38:48])]]),
-                axis=0,
-            )
-        indif += 1
-        iline += 1
-        neq[iat] = int(pip[iline][15:17])
-        iline += 1
-        for ieq in range(1, int(neq[iat])):
-            pos = np.append(
-                pos,
-                np.array([[float(pip[iline][12:22]), float(pip[iline][25:35]), float(pip[iline][38:48])]]),
-                axis=0,
-            )
-            indif += 1
-            iline += 1
-        for i in range(indif - indifini):
-            atomtype.append(pip[iline][0:2].replace(' ', ''))
-            rmt.append(float(pip[iline][43:48]))
+        mult[iat] = int(pip[iline + 1][15:17])
+        pos_lines.append(iline)
+        pos_lines.extend(range(iline + 2, iline + mult[iat] + 1))
+        iline += mult[iat] + 1
+        name_lines.append(iline)
         iline += 4
+    # convert the fixed-width columns of all positions at once
+    pos = np.array(
+        [pip[i][j : j + 10] for i in pos_lines for j in (12, 25, 38)],
+        dtype=np.float64,
+    ).reshape(len(pos_lines), 3)
+    atomtype = np.repeat([pip[i][0:2].replace(' ', '') for i in name_lines], mult)
+    rmt = np.repeat(np.array([pip[i][43:48] for i in name_lines], dtype=np.float64), mult)
     if ase:
+        from ase import Atoms
+
         cell2 = coorsys(cell)
-        atoms = Atoms(atomtype, pos, pbc=True)
+        atoms = Atoms(atomtype.tolist(), pos, pbc=True)
         atoms.set_cell(cell2, scale_atoms=True)
         cell2 = np.dot(c2p(lattice), cell2)
         if lattice == 'R':
@@ -194,7 +522,27 @@ def read_struct(fd, ase=True):
             atoms.set_cell(cell2)
         return atoms
     else:
-        return cell, lattice, pos, atomtype, rmt
+        return cell, lattice, pos, atomtype, rmt, mult
+
+
+# tolerance of `same_struct` on the lattice constants [Angstrom, degree] and fractional positions
+STRUCT_ATOL = 1e-5
+
+
+def same_struct(content, other, atol=STRUCT_ATOL):
+    """Return whether two WIEN2k struct files describe the same structure within `atol`: the same lattice type and
+    lattice constants, and the same atoms at the same fractional positions regardless of their order."""
+    (cell1, lattice1, pos1, atomtype1, _, _), (cell2, lattice2, pos2, atomtype2, _, _) = (
+        read_struct(io.StringIO(text), ase=False) for text in (content, other)
+    )
+    if lattice1 != lattice2 or len(atomtype1) != len(atomtype2) or not np.allclose(cell1, cell2, rtol=0, atol=atol):
+        return False
+    # sort the atoms by type and rounded position, the order of equivalent atoms is arbitrary
+    order1, order2 = (
+        np.lexsort((*np.round(pos, 4).T % 1.0, atomtype)) for pos, atomtype in ((pos1, atomtype1), (pos2, atomtype2))
+    )
+    shift = pos1[order1] - pos2[order2]
+    return bool(np.all(atomtype1[order1] == atomtype2[order2]) and np.all(np.abs(shift - np.round(shift)) <= atol))
 
 
 def coorsys(latconst):
@@ -245,410 +593,460 @@ def c2p(lattice):
     return cell
 
 
-DiffCalculation = CalculationFactory('wien2k-run123_lapw')
+class _Stage(t.NamedTuple):
+    """Files and results of one precision stage of `run123_lapw`.
+
+    :param prec: prefix of the output files of the stage, e.g. 'prec3k'.
+    :param required: the stage must be complete, otherwise it is skipped if its files are missing.
+    :param files: extensions of the output files expected for the stage.
+    :param results: `(extension, key, result key, required)` of the quantities stored in the `scf_grep` output.
+    :param warnings: result key of the list of warnings of the stage.
+    :param converged: key of the line in `*.dayfile` that signals a converged SCF cycle.
+    """
+
+    prec: str
+    required: bool
+    files: t.Tuple[str, ...]
+    results: t.Tuple[t.Tuple[str, str, str, bool], ...]
+    warnings: str
+    converged: str
+
+
+_SCF_FILES = ('scf0', 'scf1', 'scf2', 'scfm', 'scfc')
+
+_STAGES = (
+    _Stage(
+        prec='prec3k',
+        required=True,
+        files=(*_SCF_FILES, 'dayfile', 'klist', 'in0'),
+        results=(
+            ('scf0', ':VOL', 'VolBohr3', True),
+            ('scf2', ':FER', 'EfermiRyd', True),
+            ('scf2', ':GAP', 'GapEv', False),
+            ('scf2', ':CHA', 'Rmt', True),
+            ('scf2', ':POS', 'atom_labels', True),
+            ('scf2', '-TS', 'mTSRyd', False),
+            ('scfm', ':ENE', 'EtotRyd', True),
+            ('scfm', ':CINT', 'num_core_el', True),
+            ('klist', 'k mesh', 'kmesh3k', True),
+            ('in0', 'FFT mesh', 'fftmesh3k', True),
+        ),
+        warnings='Warning_last',
+        converged='ec cc fc and str_conv 1 1 1 1',
+    ),
+    _Stage(
+        prec='prec3',
+        required=False,
+        files=(*_SCF_FILES, 'dayfile', 'klist'),
+        results=(
+            ('scfm', ':ENE', 'EtotRyd_prec3', True),
+            ('scfm', ':CINT', 'num_core_el_prec3', True),
+            ('klist', 'k mesh', 'kmesh3', False),
+        ),
+        warnings='Warning_last_prec3',
+        converged='ec cc and fc_conv 1 1 1',
+    ),
+    _Stage(
+        prec='prec2',
+        required=False,
+        files=(*_SCF_FILES, 'dayfile'),
+        results=(
+            ('scfm', ':ENE', 'EtotRyd_prec2', True),
+            ('scfm', ':CINT', 'num_core_el_prec2', True),
+        ),
+        warnings='Warning_last_prec2',
+        converged='ec cc and fc_conv 1 1 1',
+    ),
+    _Stage(
+        prec='prec1',
+        required=False,
+        files=(*_SCF_FILES, 'dayfile'),
+        results=(
+            ('scfm', ':ENE', 'EtotRyd_prec1', True),
+            ('scfm', ':CINT', 'num_core_el_prec1', True),
+        ),
+        warnings='Warning_last_prec1',
+        converged='ec cc and fc_conv 1 1 1',
+    ),
+)
+
+
+class _IncompleteStageError(RuntimeError):
+    """A required result is missing from the output files of a stage, e.g. because the run was interrupted."""
+
+
+# `*.scf` files searched for the SCF history of an interrupted run: the running stage, then the finished stages
+_SALVAGE_FILES = ('case.scf', *(f'{stage.prec}.scf' for stage in _STAGES))
+
+
+class _StageOutput(t.NamedTuple):
+    """Results of the parsing of one precision stage, merged into the parser outputs in the order of `_STAGES`."""
+
+    res: dict
+    converged: bool
+    history: dict
+    timings: dict
+    timings_summary: dict
+
+
+# extra of the calculation node with the wall time [s] of every phase of the parser
+SPANS_EXTRA = 'wien2k_parser_spans'
+
+# extra of the calculation node with the profile of the parser, see `PROFILE_ENV`
+PROFILE_EXTRA = 'wien2k_parser_profile'
+
+# environment variable enabling the profiling of the parser, a comma-separated list of 'cprofile' and 'tracemalloc'
+PROFILE_ENV = 'AIIDA_WIEN2K_PARSER_PROFILE'
+
+# number of functions (cProfile) and source lines (tracemalloc) in the profile
+PROFILE_TOP = 30
+
+
+@contextlib.contextmanager
+def _profile(modes, top=PROFILE_TOP):
+    """Profile the block with cProfile and/or tracemalloc, depending on the `modes`.
+
+    cProfile only profiles the calling thread, stages parsed in other threads (`parser_max_workers`) are missed.
+
+    Yield:
+    report (dict): filled once the block exits, 'cprofile' the `top` functions by cumulative time and 'tracemalloc'
+    the peak memory [MB] and the `top` source lines by allocated memory
+    """
+    report = {}
+    profiler = cProfile.Profile() if 'cprofile' in modes else None
+    trace = 'tracemalloc' in modes and not tracemalloc.is_tracing()
+    if trace:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield report
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+            report['cprofile'] = stream.getvalue()
+        if trace:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            report['tracemalloc'] = {
+                'peak_mb': peak / 2**20,
+                'top': [str(statistic) for statistic in snapshot.statistics('lineno')[:top]],
+            }
 
 
 class Wien2kScf123Parser(Parser):
+    def __init__(self, node):
+        super().__init__(node)
+        self._spans = {}
+        self._spans_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _span(self, name):
+        """Add the wall time of the block to the span `name`, spans of the same name (e.g. in a loop) add up."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._spans_lock:
+                self._spans[name] = self._spans.get(name, 0.0) + seconds
+            self.logger.debug(f'{name}: {seconds * 1e3:.3f} ms')
+
     def parse(self, **kwargs):
         """
         Parse outputs, store results in database.
 
+        The wall times of the phases of the parser are stored in the `SPANS_EXTRA` extra of the calculation node, the
+        profile requested with the `PROFILE_ENV` environment variable in the `PROFILE_EXTRA` extra.
+
         :returns: non-zero exit code, if parsing fails
         """
+        modes = {mode.strip() for mode in os.environ.get(PROFILE_ENV, '').split(',') if mode.strip()}
+        unknown = modes - {'cprofile', 'tracemalloc'}
+        if unknown:
+            self.logger.warning(f"Unknown profiling modes {sorted(unknown)} in '{PROFILE_ENV}'")
 
-        # PREC 3k
-        # ~~~~~~~~
+        self._spans = {}
+        report = {}
+        try:
+            with _profile(modes) as report, self._span('parse'):
+                return self._parse(**kwargs)
+        finally:
+            self.node.base.extras.set(SPANS_EXTRA, self._spans)
+            if report:
+                self.node.base.extras.set(PROFILE_EXTRA, report)
+                for mode, profile in report.items():
+                    self.logger.debug(f'{mode} profile:\n{profile}')
 
-        self.logger.info('Parsing prec 3k files:')
+    def _parse(self, **kwargs):
+        """Parse the outputs, see `parse`."""
+        # the bulky SCF output files are only in the temporary folder with `minimal_retrieval`
+        with _RetrievedFiles(self.retrieved, kwargs.get('retrieved_temporary_folder')) as files:
+            with self._span('list_files'):
+                files_retrieved = files.list_object_names()
 
-        # check error_prec3k files and write to logger if any of them are not empty
-        err_files_not_empty = check_error_files(files=self.retrieved, errending='.error_prec3k', logger=self.logger)
-        if err_files_not_empty:
-            raise  # non-empty error_prec3k file(s) found
-
-        # all file to be processed
-        output_fnames = [
-            'prec3k.scf0',
-            'prec3k.scf1',
-            'prec3k.scf2',
-            'prec3k.scfm',
-            'prec3k.scfc',
-            'prec3k.dayfile',
-            'prec3k.klist',
-            'prec3k.in0',
-            'case.struct',
-        ]
+            # Check that folder content is as expected for the final stage
+            output_fnames = [f'{_STAGES[0].prec}.{ext}' for ext in _STAGES[0].files] + ['case.struct']
+            # Note: set(A) <= set(B) checks whether A is a subset of B
+            if not set(output_fnames) <= set(files_retrieved):
+                self.logger.error(f"Found files '{files_retrieved}', expected to find '{output_fnames}'")
+                exit_code = self._salvage(files) or self._stop_exit_code(files_retrieved)
+                return exit_code or self.exit_codes.ERROR_MISSING_OUTPUT_FILES
 
-        # Check that folder content is as expected
-        files_retrieved = self.retrieved.list_object_names()
-        # Note: set(A) <= set(B) checks whether A is a subset of B
-        if not set(output_fnames) <= set(files_retrieved):
-            self.logger.error(f"Found files '{files_retrieved}', expected to find '{output_fnames}'")
-            return self.exit_codes.ERROR_MISSING_OUTPUT_FILES
-
-        # get output AiiDA structure
-        output_fname = 'case.struct'
-        # generate a file-like object
-        wien2k_structfile_flo = io.StringIO(self.retrieved.get_object_content(output_fname))
-        # need *.struct file name for ASE to recognize WIEN2k
-        wien2k_structfile_flo.filename = output_fname
-        ase_struct_out = read_struct(wien2k_structfile_flo)  # WIEN2k struct -> ASE
-        aiida_structure_out = StructureData(ase=ase_struct_out)  # ASE struct -> AiiDA
-        aiida_structure_out.store()  # save structure in the AiiDA database
-
-        # get output data
-        res = Dict()
-
-        # :VOL
-        output_fname = 'prec3k.scf0'
-        self.logger.info(f"Parsing '{output_fname}'")
-        file_content = self.retrieved.get_object_content(output_fname)
-        vollist = _grep(key=':VOL', pip=file_content)  # get all volumes in SCF run
-        if vollist:
-            res['VolBohr3'] = vollist
-        else:
-            raise  # Cell volume not found
-
-        # :ITE
-        res['Iter'] = []
-        output_fname = 'prec3k.scf0'
-        self.logger.info(f"Parsing '{output_fname}'")
-        file_content = self.retrieved.get_object_content(output_fname)
-        iterlist = _grep(key=':ITE', pip=file_content)  # get all iteration in SCF run
-        if iterlist:
-            res['Iter'].append(iterlist)
-
-        # :FER, :GAP, :CHA, :POS, -TS
-        output_fname = 'prec3k.scf2'
-        self.logger.info(f"Parsing '{output_fname}'")
-        file_content = self.retrieved.get_object_content(output_fname)
-        eflist = _grep(key=':FER', pip=file_content)  # get Fermi ene in SCF run
-        if eflist:
-            res['EfermiRyd'] = eflist
-        else:
-            raise  # Efermi not found
-        gaplist = _grep(key=':GAP', pip=file_content)  # get band gap
-        if gaplist:
-            res['GapEv'] = gaplist
-        rmtlist = _grep_all_instances(key=':CHA', pip=file_content)  # get RMTs
-        if rmtlist:
-            res['Rmt'] = rmtlist
-        else:
-            raise  # Rmt's not found
-        atomlablelist = _grep_all_instances(key=':POS', pip=file_content)  # get RMTs
-        if atomlablelist:
-            res['atom_labels'] = atomlablelist
-        else:
-            raise  # atom labels not found
-        tslist = _grep(key='-TS', pip=file_content)  # get Fermi ene in SCF run
-        if tslist:
-            res['mTSRyd'] = tslist
-
-        # :ENE,:CINT
-        output_fname = 'prec3k.scfm'
-        self.logger.info(f"Parsing '{output_fname}'")
-        file_content = self.retrieved.get_object_content(output_fname)
-        enelist = _grep(key=':ENE', pip=file_content)  # get all energies in SCF run
-        if enelist:  # check if energy list is not empty
-            res['EtotRyd'] = enelist
-        else:
-            raise  # Etot not found
-        # get number of core electrons
-        numcoreellist = _grep_all_instances(key=':CINT', pip=file_content)
-        if numcoreellist:
-            res['num_core_el'] = numcoreellist
-        else:
-            raise  # number of core electrons not found
-
-        # k mesh
-        output_fname = 'prec3k.klist'
-        self.logger.info(f"Parsing '{output_fname}'")
-        file_content = self.retrieved.get_object_content(output_fname)
-        kmesh3k = _grep(key='k mesh', pip=file_content)  # get k mesh
-        if kmesh3k:  # check if the k mesh is not empty
-            res['kmesh3k'] = kmesh3k
-        else:
-            raise  # k mesh not found
-
-        # FFT mesh
-        output_fname = 'prec3k.in0'
-        self.logger.info(f"Parsing '{output_fname}'")
-        file_content = self.retrieved.get_object_content(output_fname)
-        fftmesh3k = _grep(key='FFT mesh', pip=file_content)  # get k mesh
-        if fftmesh3k:  # check if the k mesh is not empty
-            res['fftmesh3k'] = fftmesh3k
-        else:
-            raise  # FFT mesh not found
-
-        # :WAR
-        res['Warning_last'] = []  # allocate list
-        for output_fname in [
-            'prec3k.scf0',
-            'prec3k.scf1',
-            'prec3k.scf2',
-            'prec3k.scfm',
-            'prec3k.scfc',
-        ]:
-            self.logger.info(f"Parsing '{output_fname}'")
-            file_content = self.retrieved.get_object_content(output_fname)
-            warngmsg = _grep(key=':WAR', pip=file_content)  # get all warnings
-            if warngmsg:  # check if warnings list is not empty
-                res['Warning_last'].append(warngmsg)  # get last message if there are multiple lines
-        # Convergence check will be done at the end
-
-        # PREC 3
-        # ~~~~~~
-
-        self.logger.info('Parsing prec 3 files:')
-
-        # check error_prec3 files and write to logger if any of them are not empty
-        err_files_not_empty = check_error_files(files=self.retrieved, errending='.error_prec3', logger=self.logger)
-        if not err_files_not_empty:  # no error files
-            # all file to be processed
-            output_fnames = [
-                'prec3.scf0',
-                'prec3.scf1',
-                'prec3.scf2',
-                'prec3.scfm',
-                'prec3.scfc',
-                'prec3.dayfile',
-                'prec3.klist',
-            ]
+            # get output data, the stages are independent and can be parsed concurrently
+            max_workers = self.node.get_option('parser_max_workers') or 1
 
-            # Check that folder content is as expected
-            files_retrieved = self.retrieved.list_object_names()
-            # Note: set(A) <= set(B) checks whether A is a subset of B
-            if set(output_fnames) <= set(files_retrieved):  # all expected output files are in place
-                # :ENE, :CINT
-                output_fname = 'prec3.scfm'
-                self.logger.info(f"Parsing '{output_fname}'")
-                file_content = self.retrieved.get_object_content(output_fname)
-                enelist = _grep(key=':ENE', pip=file_content)  # get all energies in SCF run
-                if enelist:  # check if energy list is not empty
-                    res['EtotRyd_prec3'] = enelist
-                else:
-                    raise  # prec3: Etot not found
-                # get number of core electrons
-                numcoreellist = _grep_all_instances(key=':CINT', pip=file_content)
-                if numcoreellist:
-                    res['num_core_el_prec3'] = numcoreellist
-                else:
-                    raise  # prec3: number of core electrons not found
-
-                # :ITE
-                output_fname = 'prec3.scf0'
-                self.logger.info(f"Parsing '{output_fname}'")
-                file_content = self.retrieved.get_object_content(output_fname)
-                iterlist = _grep(key=':ITE', pip=file_content)  # get all iteration in SCF run
-                if iterlist:
-                    res['Iter'].append(iterlist)
-
-                # k mesh
-                output_fname = 'prec3.klist'
-                self.logger.info(f"Parsing '{output_fname}'")
-                file_content = self.retrieved.get_object_content(output_fname)
-                kmesh3 = _grep(key='k mesh', pip=file_content)  # get k mesh
-                if kmesh3:  # check if the k mesh is not empty
-                    res['kmesh3'] = kmesh3
-
-                # :WAR
-                res['Warning_last_prec3'] = []  # allocate list
-                for output_fname in [
-                    'prec3.scf0',
-                    'prec3.scf1',
-                    'prec3.scf2',
-                    'prec3.scfm',
-                    'prec3.scfc',
-                ]:
-                    self.logger.info(f"Parsing '{output_fname}'")
-                    file_content = self.retrieved.get_object_content(output_fname)
-                    warngmsg = _grep(key=':WAR', pip=file_content)  # get all warnings
-                    if warngmsg:  # check if warnings list is not empty
-                        res['Warning_last_prec3'].append(warngmsg)  # get last message if there are multiple lines
-
-                # Check if calculation is converged
-                output_fname = 'prec3.dayfile'
-                self.logger.info(f"Parsing '{output_fname}'")
-                file_content = self.retrieved.get_object_content(output_fname)
-                converged = _grep(
-                    key='ec cc and fc_conv 1 1 1', pip=file_content
-                )  # check if the line present in log file
-                if not converged:  # if line not found
-                    res['Warning_last_prec3'].append('Warning: SCF prec3 not converged')
-
-        # PREC 2
-        # ~~~~~~
-
-        self.logger.info('Parsing prec 2 files:')
-
-        # check error_prec2 files and write to logger if any of them are not empty
-        err_files_not_empty = check_error_files(files=self.retrieved, errending='.error_prec2', logger=self.logger)
-        if not err_files_not_empty:  # no error files
-            # all file to be processed
-            output_fnames = [
-                'prec2.scf0',
-                'prec2.scf1',
-                'prec2.scf2',
-                'prec2.scfm',
-                'prec2.scfc',
-                'prec2.dayfile',
-            ]
+            def parse_stage(stage):
+                with self._span(f'stage:{stage.prec}'):
+                    return self._parse_stage(stage, files)
 
-            # Check that folder content is as expected
-            files_retrieved = self.retrieved.list_object_names()
-            # Note: set(A) <= set(B) checks whether A is a subset of B
-            if set(output_fnames) <= set(files_retrieved):  # all expected output files are in place
-                # :ENE, :CINT
-                output_fname = 'prec2.scfm'
-                self.logger.info(f"Parsing '{output_fname}'")
-                file_content = self.retrieved.get_object_content(output_fname)
-                enelist = _grep(key=':ENE', pip=file_content)  # get all energies in SCF run
-                if enelist:  # check if energy list is not empty
-                    res['EtotRyd_prec2'] = enelist
-                else:
-                    raise  # prec2: Etot not found
-                # get number of core electrons
-                numcoreellist = _grep_all_instances(key=':CINT', pip=file_content)
-                if numcoreellist:
-                    res['num_core_el_prec2'] = numcoreellist
+            try:
+                if max_workers > 1:
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                        stage_outputs = list(executor.map(parse_stage, _STAGES))
                 else:
-                    raise  # prec2: number of core electrons not found
-
-                # :ITE
-                output_fname = 'prec2.scf0'
-                self.logger.info(f"Parsing '{output_fname}'")
-                file_content = self.retrieved.get_object_content(output_fname)
-                iterlist = _grep(key=':ITE', pip=file_content)  # get all iteration in SCF run
-                if iterlist:
-                    res['Iter'].append(iterlist)
-
-                # :WAR
-                res['Warning_last_prec2'] = []  # allocate list
-                for output_fname in [
-                    'prec2.scf0',
-                    'prec2.scf1',
-                    'prec2.scf2',
-                    'prec2.scfm',
-                    'prec2.scfc',
-                ]:
-                    self.logger.info(f"Parsing '{output_fname}'")
-                    file_content = self.retrieved.get_object_content(output_fname)
-                    warngmsg = _grep(key=':WAR', pip=file_content)  # get all warnings
-                    if warngmsg:  # check if warnings list is not empty
-                        res['Warning_last_prec2'].append(warngmsg)  # get last message if there are multiple lines
-
-                # Check if calculation is converged
-                output_fname = 'prec2.dayfile'
-                self.logger.info(f"Parsing '{output_fname}'")
-                file_content = self.retrieved.get_object_content(output_fname)
-                converged = _grep(
-                    key='ec cc and fc_conv 1 1 1', pip=file_content
-                )  # check if the line present in log file
-                if not converged:  # if line not found
-                    res['Warning_last_prec2'].append('Warning: SCF prec2 not converged')
-
-        # PREC 1
-        # ~~~~~~
-
-        self.logger.info('Parsing prec 1 files:')
-
-        # check error_prec1 files and write to logger if any of them are not empty
-        err_files_not_empty = check_error_files(files=self.retrieved, errending='.error_prec1', logger=self.logger)
-        if not err_files_not_empty:  # no error files
-            # all file to be processed
-            output_fnames = [
-                'prec1.scf0',
-                'prec1.scf1',
-                'prec1.scf2',
-                'prec1.scfm',
-                'prec1.scfc',
-                'prec1.dayfile',
-            ]
+                    stage_outputs = [parse_stage(stage) for stage in _STAGES]
+            except _IncompleteStageError as exception:
+                self.logger.error(str(exception))
+                exit_code = self._salvage(files)
+                if exit_code is None:
+                    raise
+                return exit_code
 
-            # Check that folder content is as expected
-            files_retrieved = self.retrieved.list_object_names()
-            # Note: set(A) <= set(B) checks whether A is a subset of B
-            if set(output_fnames) <= set(files_retrieved):  # all expected output files are in place
-                # :ENE, :CINT
-                output_fname = 'prec1.scfm'
-                self.logger.info(f"Parsing '{output_fname}'")
-                file_content = self.retrieved.get_object_content(output_fname)
-                enelist = _grep(key=':ENE', pip=file_content)  # get all energies in SCF run
-                if enelist:  # check if energy list is not empty
-                    res['EtotRyd_prec1'] = enelist
+            with self._span('structure'):
+                # get output AiiDA structure
+                output_fname = 'case.struct'
+                # generate a file-like object
+                wien2k_structfile_flo = io.StringIO(files.get_object_content(output_fname))
+                # need *.struct file name for ASE to recognize WIEN2k
+                wien2k_structfile_flo.filename = output_fname
+                if 'aiida_structure' in self.node.inputs and same_struct(
+                    wien2k_structfile_flo.getvalue(),
+                    aiida_struct2wien2k(self.node.inputs.aiida_structure).get_content(),
+                ):
+                    # a process cannot create its own input, the input structure stands for the output structure
+                    self.logger.info('The output structure is identical to the input structure')
+                    aiida_structure_out = None
                 else:
-                    raise  # prec1: Etot not found
-                # get number of core electrons
-                numcoreellist = _grep_all_instances(key=':CINT', pip=file_content)
-                if numcoreellist:
-                    res['num_core_el_prec1'] = numcoreellist
-                else:
-                    raise  # prec1: number of core electrons not found
-
-                # :ITE
-                output_fname = 'prec1.scf0'
-                self.logger.info(f"Parsing '{output_fname}'")
-                file_content = self.retrieved.get_object_content(output_fname)
-                iterlist = _grep(key=':ITE', pip=file_content)  # get all iteration in SCF run
-                if iterlist:
-                    res['Iter'].append(iterlist)
-
-                # :WAR
-                res['Warning_last_prec1'] = []  # allocate list
-                for output_fname in [
-                    'prec1.scf0',
-                    'prec1.scf1',
-                    'prec1.scf2',
-                    'prec1.scfm',
-                    'prec1.scfc',
-                ]:
-                    self.logger.info(f"Parsing '{output_fname}'")
-                    file_content = self.retrieved.get_object_content(output_fname)
-                    warngmsg = _grep(key=':WAR', pip=file_content)  # get all warnings
-                    if warngmsg:  # check if warnings list is not empty
-                        res['Warning_last_prec1'].append(warngmsg)  # get last message if there are multiple lines
-
-                # Check if calculation is converged
-                output_fname = 'prec1.dayfile'
-                self.logger.info(f"Parsing '{output_fname}'")
-                file_content = self.retrieved.get_object_content(output_fname)
-                converged = _grep(
-                    key='ec cc and fc_conv 1 1 1', pip=file_content
-                )  # check if the line present in log file
-                if not converged:  # if line not found
-                    res['Warning_last_prec1'].append('Warning: SCF prec1 not converged')
-
-        # Assign results
-        self.out('scf_grep', res)
-        self.out('aiida_structure_out', aiida_structure_out)
-
-        # Check if calculation is converged
-        # prec 3k
-        output_fname = 'prec3k.dayfile'
-        self.logger.info(f"Parsing '{output_fname}'")
-        file_content = self.retrieved.get_object_content(output_fname)
-        converged = _grep(
-            key='ec cc fc and str_conv 1 1 1 1', pip=file_content
-        )  # check if the line present in log file
-        if not converged:  # if line not found
-            res['Warning_last'].append('Warning: SCF not converged')
-            return self.exit_codes.WARNING_CONVERG
-
-        # Check warnings (if any) and assign the exit code accordingly
-        # prec 3k
-        if res['Warning_last']:  # check if warnings list is not empty
-            warn_qtlb = 'QTL-B value eq. in Band of energy ATOM= L='
-            warn_vccoul = 'VK-COUL not well converged: Increase GMAX or decrease NCON'
-            warn_int = 'RESULT OF INTEGRATION SHOULD BE'
-            for msg in res['Warning_last']:
-                # handle warnings using fuzzy matching
-                if fuzz.ratio(msg, warn_qtlb) > 50:  # QRT-B warning
-                    return self.exit_codes.WARNING_QTL_B
-                elif fuzz.ratio(msg, warn_vccoul) > 50:  # VK-COUL warning
-                    return self.exit_codes.WARNING_VK_COUL
-                elif fuzz.ratio(msg, warn_int) > 50:  # RESULT OF INTEGRATION warning
-                    return self.exit_codes.WARNING_INT
-            # in case of no known warnings
-            return self.exit_codes.WARNING_OTHER
+                    ase_struct_out = read_struct(wien2k_structfile_flo)  # WIEN2k struct -> ASE
+                    aiida_structure_out = StructureData(ase=ase_struct_out)  # ASE struct -> AiiDA
+                    aiida_structure_out.store()  # save structure in the AiiDA database
+
+        with self._span('outputs'):
+            # merge the results of all stages in a fixed order
+            res = {'Iter': []}
+            history = ArrayData()
+            timings = ArrayData()
+            timings_summary = {}
+            converged = {}
+            for stage, stage_output in zip(_STAGES, stage_outputs):
+                if stage_output is None:  # stage was skipped
+                    converged[stage.prec] = None
+                    continue
+                converged[stage.prec] = stage_output.converged
+                res['Iter'].extend(stage_output.res.pop('Iter'))
+                res.update(stage_output.res)
+                for name, array in stage_output.history.items():
+                    history.set_array(name, array)
+                for name, array in stage_output.timings.items():
+                    timings.set_array(name, array)
+                timings_summary[stage.prec] = stage_output.timings_summary
+
+            # Assign results
+            if aiida_structure_out is not None:
+                self.out('aiida_structure_out', aiida_structure_out)
+            self.out('scf_history', history)
+            self.out('dayfile_timings', timings)
+            self.out('dayfile_timings_summary', Dict(timings_summary))
+
+            # Check if calculation is converged
+            # prec 3k
+            if not converged[_STAGES[0].prec]:
+                res['Warning_last'].append('Warning: SCF not converged')
+
+            self.out('scf_grep', Dict(res))
+
+        if not converged[_STAGES[0].prec] and WALLTIME_STOP_FILE in files_retrieved:
+            return self.exit_codes.ERROR_SCF_STOPPED_WALLTIME  # the next cycle would not have fit into the wall time
+
+        # Check warnings (if any) and assign the exit code accordingly. Only the warnings of the final stage fail the
+        # calculation, the warnings of the intermediate stages are only reported in `scf_grep`.
+        if res.get(_STAGES[0].warnings):
+            return getattr(self.exit_codes, f'WARNING_{_classify_warnings(res[_STAGES[0].warnings])}')
 
         return ExitCode(0)  # finished OK
+
+    def _salvage(self, files):
+        """
+        Salvage the results of an interrupted run (e.g. killed at the walltime) from its truncated `*.scf` file.
+
+        The SCF history of the file is stored in `scf_history` and the results of its last complete iteration, closed
+        by the mixer, in `scf_grep`.
+
+        Return:
+        exit_code (ExitCode): the exit code of a run stopped on purpose (see `_stop_exit_code`) or set by the scheduler
+        output parser (e.g. out of walltime) if any, otherwise `ERROR_SCF_INCOMPLETE`; `None` if there is no `*.scf`
+        file
+        """
+        files_retrieved = files.list_object_names()
+        output_fname = next((fname for fname in _SALVAGE_FILES if fname in files_retrieved), None)
+        if output_fname is None:
+            return None
+        self.logger.warning(f"SCF cycle interrupted, salvaging the last complete iteration from '{output_fname}'")
+
+        with self._span('salvage'):
+            history = _history_arrays(files.iter_lines(output_fname))
+        res = {'Iter': [], 'Warning_last': ['Warning: SCF interrupted']}
+        complete = np.flatnonzero(np.isfinite(history['DisCharge']))
+        if complete.size:
+            last = complete[-1]
+            res['Iter'].append(int(history['Iter'][last]))
+            res.update((key, float(history[key][last])) for key in _HISTORY_KEYS if np.isfinite(history[key][last]))
+
+        scf_history = ArrayData()
+        for name, array in history.items():
+            scf_history.set_array(name, array)
+        self.out('scf_history', scf_history)
+        self.out('scf_grep', Dict(res))
+
+        exit_code = self._stop_exit_code(files_retrieved)
+        if exit_code is not None:
+            return exit_code
+        if self.node.exit_status:  # set by the scheduler output parser
+            return ExitCode(self.node.exit_status, self.node.exit_message)
+        return self.exit_codes.ERROR_SCF_INCOMPLETE
+
+    def _stop_exit_code(self, files_retrieved):
+        """Return the exit code of a run stopped on purpose, `None` otherwise: the exit code requested by the
+        `wien2k.scf` monitor, or `ERROR_SCF_STOPPED_WALLTIME` if the job script stopped it before the wall time
+        limit."""
+        stopped = self.node.base.extras.get(MONITOR_EXTRA, {}).get('stopped')
+        if stopped is not None:
+            return getattr(self.exit_codes, stopped)
+        if WALLTIME_STOP_FILE in files_retrieved:
+            return self.exit_codes.ERROR_SCF_STOPPED_WALLTIME
+        return None
+
+    def _parse_stage(self, stage, files):
+        """
+        Parse the output files of a precision `stage`.
+
+        Every file is read and scanned once for all keys of the stage. Only the last iteration of the SCF files and
+        the last cycle of the `*.dayfile` are read. Stages do not share any state, such that they can be parsed in
+        separate threads.
+
+        Return:
+        stage_output (_StageOutput): results of the stage, `None` if the stage was skipped
+        """
+        self.logger.info(f'Parsing {stage.prec} files:')
+
+        # check error files and write to logger if any of them are not empty
+        err_files_not_empty = check_error_files(files=files, errending=f'.error_{stage.prec}', logger=self.logger)
+        if err_files_not_empty:
+            if stage.required:
+                raise RuntimeError(f'non-empty error_{stage.prec} file(s) found')
+            return None
+
+        # Check that folder content is as expected
+        output_fnames = [f'{stage.prec}.{ext}' for ext in stage.files]
+        if not set(output_fnames) <= set(files.list_object_names()):
+            return None  # the final stage is checked upfront, earlier stages are optional
+
+        res = {'Iter': [], stage.warnings: []}  # allocate lists
+        converged = False
+        for ext, output_fname in zip(stage.files, output_fnames):
+            keys = [key for fext, key, _, _ in stage.results if fext == ext]
+            if ext == 'scf0':
+                keys.append(':ITE')
+            if ext in _SCF_FILES:
+                keys.append(':WAR')
+            elif ext == 'dayfile':
+                keys.append(stage.converged)
+            if not keys:
+                continue
+
+            self.logger.info(f"Parsing '{output_fname}'")
+            delimiter = _LAST_BLOCK_DELIMITERS.get(ext)
+            with self._span(f'read:{stage.prec}:{ext}'):
+                if delimiter is None:
+                    content = files.get_object_content(output_fname)
+                else:
+                    content = files.get_last_block(output_fname, delimiter)  # only the last iteration
+            with self._span(f'scan:{stage.prec}:{ext}'):
+                found = _scan(content, keys)
+
+            for fext, key, result_key, required in stage.results:
+                if fext != ext:
+                    continue
+                if found[key]:
+                    res[result_key] = found[key]
+                elif required:
+                    raise _IncompleteStageError(f"'{result_key}' not found in '{output_fname}'")
+            if found.get(':ITE'):
+                res['Iter'].append(found[':ITE'])
+            if found.get(':WAR'):
+                res[stage.warnings].append(found[':WAR'])
+            if ext == 'dayfile':
+                converged = bool(found[stage.converged])
+
+        # Convergence of the final stage is checked at the end
+        if not converged and not stage.required:
+            res[stage.warnings].append(f'Warning: SCF {stage.prec} not converged')
+
+        with self._span(f'history:{stage.prec}'):
+            history = self._parse_history(stage, files)
+        with self._span(f'timings:{stage.prec}'):
+            timings, timings_summary = self._parse_timings(stage, files)
+
+        return _StageOutput(res, converged, history, timings, timings_summary)
+
+    def _parse_history(self, stage, files):
+        """
+        Return the per-iteration SCF history of a precision `stage` as a dictionary of arrays.
+
+        The complete history is taken from `*.scf` if retrieved, otherwise the last iteration is assembled from the
+        `*.scf0`, `*.scf1`, `*.scf2`, `*.scfm` and `*.scfc` files. The files are streamed line by line.
+        Array names are the keys of `_HISTORY_KEYS` and 'Iter', with the suffix '_<prec>' for intermediate stages.
+        """
+        output_fname = f'{stage.prec}.scf'
+        if output_fname in files.list_object_names():
+            output_fnames = [output_fname]
+        else:
+            output_fnames = [f'{stage.prec}.{ext}' for ext in _SCF_FILES]
+        self.logger.info(f"Parsing SCF history from '{output_fnames}'")
+
+        lines = itertools.chain.from_iterable(files.iter_lines(fname) for fname in output_fnames)
+        return _history_arrays(lines, suffix='' if stage.required else f'_{stage.prec}')
+
+    def _parse_timings(self, stage, files):
+        """
+        Return the timings of every program and cycle of a precision `stage` as a dictionary of arrays.
+
+        The array of each program is named after the program, with the suffix '_<prec>' for intermediate stages.
+        Columns are the user, system and wall time [s] and the CPU usage [%], rows are the SCF cycles.
+
+        Return:
+        timings (dict): array of each program
+        summary (dict): number of cycles, total wall time of each program [s] and mean wall time per cycle [s]
+        """
+        output_fname = f'{stage.prec}.dayfile'
+        self.logger.info(f"Parsing timings from '{output_fname}'")
+        program_timings = _read_dayfile_timings(files.iter_lines(output_fname))
+
+        suffix = '' if stage.required else f'_{stage.prec}'
+        timings = {}
+        wall_seconds = {}
+        num_cycles = 0
+        for program, timing in program_timings.items():
+            timings[f'{program}{suffix}'] = timing
+            wall_seconds[program] = float(np.nansum(timing[:, 2]))
+            num_cycles = timing.shape[0]
+
+        return timings, {
+            'num_cycles': num_cycles,
+            'wall_seconds': wall_seconds,
+            'wall_seconds_per_cycle': sum(wall_seconds.values()) / num_cycles if num_cycles else 0.0,
+        }
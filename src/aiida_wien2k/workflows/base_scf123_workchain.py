@@ -0,0 +1,95 @@
+from aiida.common import AttributeDict
+from aiida.engine import BaseRestartWorkChain, ProcessHandlerReport, process_handler, while_
+from aiida.orm import Dict
+from aiida_wien2k.calculations.run123_lapw import Wien2kRun123Lapw
+
+# default maximum number of SCF iterations of run123_lapw
+DEFAULT_MAX_ITERATIONS = 100
+
+
+def _stage_exit_codes(*families):
+    """Return the exit codes of the warning `families` of the final and of the intermediate precision stages.
+
+    The code of the stage prec1, prec2 or prec3 is the one of the final stage plus 10, 20 or 30, e.g. `WARNING_CONVERG`
+    (305) and `WARNING_CONVERG1` to `WARNING_CONVERG3` (315 to 335)."""
+    return [Wien2kRun123Lapw.exit_codes[f'{family}{stage}'] for family in families for stage in ('', '1', '2', '3')]
+
+
+class Wien2kBaseScf123WorkChain(BaseRestartWorkChain):
+    """WorkChain to run run123_lapw and restart it automatically on recoverable failures.
+
+    A failed calculation is resumed from its converged density via `parent_folder`, instead of starting the SCF cycle
+    over. Calculations that ran out of walltime (or stopped before it) or were interrupted are resumed as they are.
+    Calculations that did not converge (in the final or in an intermediate precision stage) or that finished with a
+    QTL-B or VK-COUL warning are resumed with twice the number of SCF iterations.
+
+    Limitation: the shipped code config `configs/codes/run123_lapw.yml` runs in a scratch directory and only copies the
+    output files back if the job script reaches its end. The resumed calculation copies the density from the scratch
+    directory, but the SCF files of a calculation killed at the walltime are not retrieved, so its last iterations
+    cannot be salvaged into `scf_history` and `scf_grep`."""
+
+    _process_class = Wien2kRun123Lapw
+
+    @classmethod
+    def define(cls, spec):
+        """Specify inputs, outputs, and the workchain outline."""
+        super().define(spec)
+        spec.expose_inputs(Wien2kRun123Lapw, namespace='wien2k')
+        spec.expose_outputs(Wien2kRun123Lapw)
+        spec.outline(
+            cls.setup,
+            while_(cls.should_run_process)(cls.run_process, cls.inspect_process),
+            cls.results,
+        )
+
+    def setup(self):
+        """Set up the inputs of the first calculation."""
+        super().setup()
+        self.ctx.inputs = AttributeDict(self.exposed_inputs(Wien2kRun123Lapw, 'wien2k'))
+
+    def _resume(self, node, parameters=None):
+        """Set up the next calculation to continue from the density of `node` with updated command line parameters."""
+        self.ctx.inputs.parent_folder = node.outputs.remote_folder
+        if parameters:
+            merged = self.ctx.inputs.parameters.get_dict() if 'parameters' in self.ctx.inputs else {}
+            merged.update(parameters)
+            self.ctx.inputs.parameters = Dict(merged)
+
+    @process_handler(
+        priority=600,
+        exit_codes=[
+            Wien2kRun123Lapw.exit_codes.ERROR_SCHEDULER_OUT_OF_WALLTIME,
+            Wien2kRun123Lapw.exit_codes.ERROR_SCF_INCOMPLETE,
+            Wien2kRun123Lapw.exit_codes.ERROR_SCF_STOPPED_WALLTIME,
+        ],
+    )
+    def handle_interrupted(self, node):
+        """Resume a calculation that ran out of walltime, was stopped before the walltime or was interrupted."""
+        self.report(f'{node.process_label}<{node.pk}> was interrupted, resuming from its last density')
+        self._resume(node)
+        return ProcessHandlerReport(do_break=True)
+
+    def _resume_with_more_iterations(self, node, reason):
+        """Resume `node` with twice the number of SCF iterations of its inputs."""
+        parameters = self.ctx.inputs.parameters.get_dict() if 'parameters' in self.ctx.inputs else {}
+        max_iterations = 2 * int(parameters.get('-i', DEFAULT_MAX_ITERATIONS))
+        self.report(f'{node.process_label}<{node.pk}> {reason}, resuming with {max_iterations} iterations')
+        self._resume(node, {'-i': str(max_iterations)})
+
+    @process_handler(priority=500, exit_codes=_stage_exit_codes('WARNING_CONVERG'))
+    def handle_not_converged(self, node):
+        """Resume an unconverged calculation with twice the number of SCF iterations."""
+        self._resume_with_more_iterations(node, 'did not converge')
+        return ProcessHandlerReport(do_break=True)
+
+    @process_handler(
+        priority=400,
+        exit_codes=_stage_exit_codes('WARNING_QTL_B', 'WARNING_VK_COUL'),
+    )
+    def handle_unstable_iteration(self, node):
+        """Resume a calculation with a QTL-B or VK-COUL warning in its last iteration with twice the SCF iterations.
+
+        These warnings are often transient: the resumed calculation starts from the last density with a fresh mixer
+        history (only `case.clmsum` is copied) and gets more iterations to settle."""
+        self._resume_with_more_iterations(node, f'finished with `{node.exit_message}`')
+        return ProcessHandlerReport(do_break=True)
@@ -0,0 +1,119 @@
+from aiida.engine import ToContext, WorkChain, calcfunction, while_
+from aiida.orm import AbstractCode, Dict, Int, StructureData, load_node
+from aiida_wien2k.calculations.run123_lapw import Wien2kRun123Lapw
+
+
+@calcfunction
+def collect_scf_grep(**scf_grep):
+    """Collect the `scf_grep` outputs of the calculations into one dictionary, keyed by structure label."""
+    return Dict({label: result.get_dict() for label, result in scf_grep.items()})
+
+
+class Wien2kBatchScf123WorkChain(WorkChain):
+    """WorkChain to run the SCF cycle of many structures with a bounded number of calculations in flight.
+
+    At most `max_concurrent` calculations are in flight, the next structure is submitted as soon as one of them is
+    done. The workchain waits for the oldest calculation in flight and then records every calculation that finished
+    in the meantime. The `scf_grep` results of all structures are collected in a single `summary` output."""
+
+    @classmethod
+    def define(cls, spec):
+        """Specify inputs, outputs, and the workchain outline."""
+        super().define(spec)
+        # input parameters
+        spec.input_namespace(
+            'structures',
+            valid_type=StructureData,
+            dynamic=True,
+            help='AiiDA input structures, their labels are the keys of the `summary` output',
+        )
+        spec.input('code', valid_type=AbstractCode, required=True)  # run123_lapw
+        spec.input('inpdict', valid_type=Dict, required=True)  # run123_lapw [param]
+        spec.input('options', valid_type=Dict, required=True)  # parallel options for slurm scheduler
+        spec.input(
+            'max_concurrent',
+            valid_type=Int,
+            default=lambda: Int(50),
+            help='Maximum number of calculations running at the same time',
+        )
+        # calculation steps
+        spec.outline(
+            cls.setup,
+            while_(cls.should_run_next)(cls.submit_next, cls.inspect_next),
+            cls.result,
+            cls.inspect_warn_all_steps,
+        )
+        # output parameters
+        spec.output(
+            'summary',
+            valid_type=Dict,
+            help='`scf_grep` results of every structure that produced them, keyed by structure label',
+        )
+        # exit codes
+        spec.exit_code(300, 'WARNING', 'There were warning messages during calculation steps')
+        spec.exit_code(400, 'ERROR', 'There was a terminal error in one of calculation steps')
+
+    def setup(self):
+        """Queue all structures."""
+        self.ctx.pending = sorted(self.inputs.structures)
+        self.ctx.running = []  # [structure label, pk] of the calculations in flight, in order of submission
+        self.ctx.calcs = {}  # structure label -> pk of its finished calculation
+
+    def should_run_next(self):
+        """Return whether there are structures left to run or calculations in flight."""
+        return bool(self.ctx.pending or self.ctx.running)
+
+    def submit_next(self):
+        """Refill the window of calculations in flight and wait for the oldest one to finish."""
+        max_concurrent = self.inputs.max_concurrent.value
+        submitted = 0
+        while self.ctx.pending and len(self.ctx.running) < max_concurrent:
+            label = self.ctx.pending.pop(0)
+            node = self.submit(
+                Wien2kRun123Lapw,
+                aiida_structure=self.inputs.structures[label],
+                parameters=self.inputs.inpdict,
+                code=self.inputs.code,
+                metadata={'options': self.inputs.options.get_dict(), 'call_link_label': f'run123_lapw_{label}'},
+            )
+            self.ctx.running.append([label, node.pk])
+            submitted += 1
+        if submitted:
+            self.report(f'submitted {submitted} calculations, {len(self.ctx.pending)} structures left')
+
+        return ToContext(finished=load_node(self.ctx.running[0][1]))
+
+    def inspect_next(self):
+        """Record the calculations that finished, which frees their places in the window."""
+        self.ctx.pop('finished')
+        running = []
+        for label, pk in self.ctx.running:
+            node = load_node(pk)
+            if not node.is_terminated:
+                running.append([label, pk])
+                continue
+            self.ctx.calcs[label] = pk
+            if not node.is_finished_ok:
+                self.report(f'calculation<{pk}> of structure `{label}` finished with status {node.exit_status}')
+        self.ctx.running = running
+
+    def result(self):
+        """Collect the results of all calculations."""
+        scf_grep = {}
+        for label, pk in self.ctx.calcs.items():
+            node = load_node(pk)
+            if 'scf_grep' in node.outputs:
+                scf_grep[label] = node.outputs.scf_grep
+        self.out('summary', collect_scf_grep(**scf_grep))
+
+    def inspect_warn_all_steps(self):
+        """Check warnings in all calculations and set the exit code accordingly"""
+        exit_code = None
+        for pk in self.ctx.calcs.values():
+            step = load_node(pk)
+            if not step.is_finished_ok:
+                if step.is_excepted or step.is_killed or step.exit_status >= 400:
+                    return self.exit_codes.ERROR  # error during calc. steps
+                exit_code = self.exit_codes.WARNING  # warnings during calc. steps
+
+        return exit_code
@@ -0,0 +1,273 @@
+import numpy as np
+from aiida.engine import ToContext, WorkChain, calcfunction, if_
+from aiida.orm import AbstractCode, Bool, Dict, Float, List, StructureData
+from aiida_wien2k.calculations.run123_lapw import Wien2kRun123Lapw
+
+# exit statuses of calculations whose SCF cycle did not converge, in the final or in an intermediate precision stage:
+# their total energy would skew the fit
+NOT_CONVERGED_STATUSES = tuple(
+    Wien2kRun123Lapw.exit_codes[f'WARNING_CONVERG{stage}'].status for stage in ('', '1', '2', '3')
+)
+
+# bulk modulus conversion Ry/bohr^3 -> GPa
+RY_BOHR3_TO_GPA = 14710.507727
+
+# volume scale factors of the equation of state, relative to the input structure
+DEFAULT_SCALE_FACTORS = (0.94, 0.96, 0.98, 1.00, 1.02, 1.04, 1.06)
+
+
+def _eos_derivatives(coefficients, volumes, order):
+    """Return the `order`-th derivative d^n E / dV^n of E(V) = sum_k c_k V^(-2k/3) at `volumes`.
+
+    `coefficients` has shape (4, ...), the trailing dimensions broadcast with `volumes`."""
+    exponents = -2.0 * np.arange(4) / 3.0
+    factors = np.ones(4)
+    for n in range(order):
+        factors = factors * (exponents - n)
+    exponents = exponents - order
+    return np.einsum('k...,k...->...', coefficients, (factors * volumes[..., np.newaxis] ** exponents).T)
+
+
+def _eos_parameters(coefficients):
+    """Return V0, E0, B0 and B' of the Birch-Murnaghan polynomials with `coefficients` of shape (4, ...).
+
+    E(x) = sum_k c_k x^k with x = V^(-2/3) has its minimum at the root of dE/dx = c_1 + 2 c_2 x + 3 c_3 x^2 with a
+    positive curvature, computed in the numerically stable form x0 = -c_1 / (c_2 + sqrt(c_2^2 - 3 c_1 c_3))."""
+    c1, c2, c3 = coefficients[1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x0 = -c1 / (c2 + np.sqrt(c2**2 - 3.0 * c1 * c3))
+        v0 = x0**-1.5
+        e0 = _eos_derivatives(coefficients, v0, 0)
+        d2 = _eos_derivatives(coefficients, v0, 2)
+        d3 = _eos_derivatives(coefficients, v0, 3)
+        return np.stack([v0, e0, v0 * d2, -1.0 - v0 * d3 / d2])
+
+
+def birch_murnaghan_fit(volumes, energies):
+    """Fit the third-order Birch-Murnaghan equation of state to `energies` [Ry] at `volumes` [bohr^3].
+
+    The equation of state is a cubic polynomial in V^(-2/3), such that the fit is a linear least-squares problem.
+    `energies` of shape (n, m) are fitted as m independent equations of state at the same n volumes in one go.
+    The uncertainties are the standard errors propagated from the covariance of the polynomial coefficients,
+    they are `nan` without redundant points (n <= 4).
+
+    Return:
+    parameters (dict): 'V0' [bohr^3], 'E0' [Ry], 'B0' [GPa], 'B0_prime' and the uncertainties '<name>_error',
+    each of shape (m,), or scalars for `energies` of shape (n,)
+    residuals (np.ndarray): fit residuals [Ry] of the shape of `energies`
+    """
+    volumes = np.asarray(volumes, dtype=np.float64)
+    energies = np.asarray(energies, dtype=np.float64)
+    if volumes.size < 4:
+        raise ValueError(f'at least 4 volumes are needed to fit the equation of state, got {volumes.size}')
+
+    # fit in the scaled variable x / x_ref for a well-conditioned Vandermonde matrix
+    x = volumes ** (-2.0 / 3.0)
+    x_ref = x.mean()
+    design = np.vander(x / x_ref, 4, increasing=True)
+    scaled, *_ = np.linalg.lstsq(design, energies.reshape(len(volumes), -1), rcond=None)
+    residuals = energies - (design @ scaled).reshape(energies.shape)
+
+    # covariance of the scaled coefficients: s^2 (A^T A)^-1, per equation of state
+    dof = len(volumes) - 4
+    variance = (residuals.reshape(len(volumes), -1) ** 2).sum(axis=0) / dof if dof else np.full(scaled.shape[1], np.nan)
+    covariance = np.linalg.inv(design.T @ design)[..., np.newaxis] * variance
+
+    scale = x_ref ** -np.arange(4.0)[:, np.newaxis]
+    parameters = _eos_parameters(scaled * scale)
+
+    # propagate the uncertainties with the Jacobian of the parameters from central finite differences
+    step = 1e-6 * np.maximum(np.abs(scaled), 1e-12)
+    jacobian = np.empty((4, 4, scaled.shape[1]))  # parameter, coefficient, equation of state
+    for k in range(4):
+        delta = np.zeros_like(scaled)
+        delta[k] = step[k]
+        jacobian[:, k] = (_eos_parameters((scaled + delta) * scale) - _eos_parameters((scaled - delta) * scale)) / (
+            2.0 * step[k]
+        )
+    errors = np.sqrt(np.einsum('pkm,klm,plm->pm', jacobian, covariance, jacobian))
+
+    units = np.array([1.0, 1.0, RY_BOHR3_TO_GPA, 1.0])[:, np.newaxis]
+    parameters, errors = parameters * units, errors * units
+    if energies.ndim == 1:
+        parameters, errors = parameters[:, 0], errors[:, 0]
+
+    result = {}
+    for name, value, error in zip(('V0', 'E0', 'B0', 'B0_prime'), parameters, errors):
+        result[name] = value
+        result[f'{name}_error'] = error
+
+    return result, residuals
+
+
+@calcfunction
+def scale_structure(structure, scale_factor):
+    """Return a copy of the `structure` with the volume scaled by `scale_factor`, in fractional coordinates."""
+    linear = scale_factor.value ** (1.0 / 3.0)
+    scaled = structure.clone()
+    scaled.reset_cell((np.array(structure.cell) * linear).tolist())
+    scaled.reset_sites_positions([(np.array(site.position) * linear).tolist() for site in structure.sites])
+    return scaled
+
+
+@calcfunction
+def fit_eos(**scf_grep):
+    """Fit the Birch-Murnaghan equation of state to the `VolBohr3` and `EtotRyd` of the `scf_grep` outputs."""
+    points = sorted((result['VolBohr3'], result['EtotRyd']) for result in scf_grep.values())
+    volumes, energies = np.array(points).T
+    parameters, residuals = birch_murnaghan_fit(volumes, energies)
+
+    eos = {name: float(value) for name, value in parameters.items()}
+    eos.update(
+        {
+            'volumes': volumes.tolist(),
+            'energies': energies.tolist(),
+            'residuals': residuals.tolist(),
+            'units': {'V0': 'bohr^3', 'E0': 'Ry', 'B0': 'GPa', 'volumes': 'bohr^3', 'energies': 'Ry'},
+        }
+    )
+    return Dict(eos)
+
+
+class Wien2kEosWorkChain(WorkChain):
+    """WorkChain to compute the equation of state of a structure.
+
+    The SCF cycles of all volumes run concurrently. With `warm_start`, the volume closest to the input structure
+    runs first and the other volumes start from its converged density. The third-order Birch-Murnaghan equation of
+    state is fitted to the total energies."""
+
+    @classmethod
+    def define(cls, spec):
+        """Specify inputs, outputs, and the workchain outline."""
+        super().define(spec)
+        # input parameters
+        spec.input('aiida_structure', valid_type=StructureData, required=True)
+        spec.input('code', valid_type=AbstractCode, required=True)  # run123_lapw
+        spec.input('inpdict', valid_type=Dict, required=True)  # run123_lapw [param]
+        spec.input('options', valid_type=Dict, required=True)  # parallel options for slurm scheduler
+        spec.input(
+            'scale_factors',
+            valid_type=List,
+            default=lambda: List(list(DEFAULT_SCALE_FACTORS)),
+            validator=cls.validate_scale_factors,
+            help='Volume scale factors relative to the input structure',
+        )
+        spec.input(
+            'warm_start',
+            valid_type=Bool,
+            default=lambda: Bool(True),
+            help='Start all volumes from the converged density of the volume closest to the input structure',
+        )
+        # calculation steps
+        spec.outline(
+            cls.setup,
+            if_(cls.should_warm_start)(cls.run_reference, cls.inspect_reference),
+            cls.run_volumes,
+            cls.inspect_volumes,
+            cls.fit,
+            cls.inspect_warn_all_steps,
+        )
+        # output parameters
+        spec.output(
+            'eos',
+            valid_type=Dict,
+            help='Birch-Murnaghan V0, E0, B0, B0_prime with uncertainties and the fitted volumes and energies',
+        )
+        # exit codes
+        spec.exit_code(300, 'WARNING', 'There were warning messages during calculation steps')
+        spec.exit_code(400, 'ERROR', 'There was a terminal error in one of calculation steps')
+        spec.exit_code(401, 'ERROR_NOT_ENOUGH_VOLUMES', 'Less than 4 volumes finished to fit the equation of state')
+
+    @staticmethod
+    def validate_scale_factors(value, _):
+        """Validate that there are enough distinct positive scale factors to fit the equation of state."""
+        if value is None:
+            return None
+        scale_factors = value.get_list()
+        if len(set(scale_factors)) < 4 or min(scale_factors) <= 0:
+            return 'at least 4 distinct positive scale factors are needed to fit the equation of state'
+        return None
+
+    def setup(self):
+        """Scale the input structure to all volumes."""
+        scale_factors = sorted(set(self.inputs.scale_factors.get_list()))
+        self.ctx.structures = {
+            f'volume_{index}': scale_structure(self.inputs.aiida_structure, Float(scale_factor))
+            for index, scale_factor in enumerate(scale_factors)
+        }
+        # the volume closest to the input structure is the reference of the warm start
+        reference = min(range(len(scale_factors)), key=lambda index: abs(scale_factors[index] - 1.0))
+        self.ctx.reference = f'volume_{reference}'
+        self.ctx.parent_folder = None
+
+    def should_warm_start(self):
+        """Return whether the volumes start from the density of the reference volume."""
+        return self.inputs.warm_start.value
+
+    def _submit(self, label, **kwargs):
+        """Submit the SCF cycle of the volume `label`."""
+        return self.submit(
+            Wien2kRun123Lapw,
+            aiida_structure=self.ctx.structures[label],
+            parameters=self.inputs.inpdict,
+            code=self.inputs.code,
+            metadata={'options': self.inputs.options.get_dict(), 'call_link_label': f'run123_lapw_{label}'},
+            **kwargs,
+        )
+
+    def run_reference(self):
+        """Run the SCF cycle of the reference volume."""
+        return ToContext(**{f'volumes.{self.ctx.reference}': self._submit(self.ctx.reference)})
+
+    def inspect_reference(self):
+        """Use the density of the reference volume for the other volumes if its SCF cycle finished."""
+        node = self.ctx.volumes[self.ctx.reference]
+        if node.is_finished_ok:
+            self.ctx.parent_folder = node.outputs.remote_folder
+        else:
+            self.report(f'reference calculation<{node.pk}> finished with status {node.exit_status}, cold start')
+
+    def run_volumes(self):
+        """Run the SCF cycles of the remaining volumes concurrently."""
+        kwargs = {} if self.ctx.parent_folder is None else {'parent_folder': self.ctx.parent_folder}
+        calcs = {
+            f'volumes.{label}': self._submit(label, **kwargs)
+            for label in self.ctx.structures
+            if label not in self.ctx.get('volumes', {})
+        }
+        self.report(f'submitted {len(calcs)} calculations')
+
+        return ToContext(**calcs)
+
+    def inspect_volumes(self):
+        """Check that enough volumes finished to fit the equation of state, unconverged volumes are left out."""
+        for label, node in self.ctx.volumes.items():
+            if node.is_excepted or node.is_killed:
+                return self.exit_codes.ERROR  # error during calc. steps, a killed calculation has no exit status
+            if not node.is_finished_ok:
+                self.report(f'calculation<{node.pk}> of `{label}` finished with status {node.exit_status}')
+
+        self.ctx.scf_grep = {
+            label: node.outputs.scf_grep
+            for label, node in self.ctx.volumes.items()
+            if node.is_finished_ok or (300 <= node.exit_status < 400 and node.exit_status not in NOT_CONVERGED_STATUSES)
+        }
+        if len(self.ctx.scf_grep) < 4:
+            return self.exit_codes.ERROR_NOT_ENOUGH_VOLUMES
+
+        return None
+
+    def fit(self):
+        """Fit the equation of state."""
+        self.out('eos', fit_eos(**self.ctx.scf_grep))
+
+    def inspect_warn_all_steps(self):
+        """Check warnings in all calculations and set the exit code accordingly"""
+        exit_code = None
+        for step in self.ctx.volumes.values():
+            if not step.is_finished_ok:
+                if step.is_excepted or step.is_killed or step.exit_status >= 400:
+                    return self.exit_codes.ERROR  # error during calc. steps
+                exit_code = self.exit_codes.WARNING  # warnings during calc. steps
+
+        return exit_code
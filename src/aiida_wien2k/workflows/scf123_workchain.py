@@ -1,8 +1,27 @@
 from aiida.engine import ToContext, WorkChain
 from aiida.orm import AbstractCode, Dict, StructureData
-from aiida.plugins.factories import CalculationFactory
+from aiida_wien2k.calculations.resources import calibrate, estimate_options
+from aiida_wien2k.calculations.run123_lapw import Wien2kRun123Lapw
 
-Wien2kRun123Lapw = CalculationFactory('wien2k-run123_lapw')  # plugin entry point
+# machine description needed by the resource estimate
+RESOURCE_LIMITS_REQUIRED = ('cores_per_machine', 'memory_mb_per_machine')
+
+# limits and basis set parameters of the resource estimate that have a default
+RESOURCE_LIMITS_OPTIONAL = ('max_machines', 'max_wallclock_seconds', 'max_cycles', 'rkmax', 'kpoint_density')
+
+
+def validate_resource_limits(value, _):
+    """Validate the machine description of the resource estimate."""
+    if value is None:
+        return None
+    limits = value.get_dict()
+    missing = [key for key in RESOURCE_LIMITS_REQUIRED if key not in limits]
+    if missing:
+        return f'the resource limits miss the keys {missing}'
+    unknown = sorted(set(limits) - set(RESOURCE_LIMITS_REQUIRED) - set(RESOURCE_LIMITS_OPTIONAL))
+    if unknown:
+        return f'the resource limits have unknown keys {unknown}'
+    return None
 
 
 class Wien2kScf123WorkChain(WorkChain):
@@ -17,6 +36,15 @@ class Wien2kScf123WorkChain(WorkChain):
         spec.input('code', valid_type=AbstractCode, required=True)  # run123_lapw
         spec.input('inpdict', valid_type=Dict, required=True)  # run123_lapw [param]
         spec.input('options', valid_type=Dict, required=True)  # parallel options for slurm scheduler
+        spec.input(
+            'resource_limits',
+            valid_type=Dict,
+            required=False,
+            validator=validate_resource_limits,
+            help='Machine description and limits to estimate `resources`, `max_wallclock_seconds`, `max_memory_kb` and '
+            'the parallel layout of the options from the structure: `cores_per_machine`, `memory_mb_per_machine` and '
+            'optionally `max_machines`, `max_wallclock_seconds`, `max_cycles`, `rkmax`, `kpoint_density`',
+        )
         # calculation steps
         spec.outline(cls.run123_lapw, cls.inspect_run123_lapw, cls.result, cls.inspect_warn_all_steps)
         # output parameters
@@ -34,16 +62,33 @@ class Wien2kScf123WorkChain(WorkChain):
     def run123_lapw(self):
         """Run SCF calculation."""
 
+        options = self.inputs.options.get_dict()
+        if 'resource_limits' in self.inputs:
+            options.update(self.estimate_options())
+
         result = self.submit(
             Wien2kRun123Lapw,
             aiida_structure=self.inputs.aiida_structure,
             parameters=self.inputs.inpdict,
             code=self.inputs.code,
-            metadata={'options': self.inputs.options.get_dict()},
+            metadata={'options': options},
         )
 
         return ToContext(node=result)
 
+    def estimate_options(self):
+        """Estimate the resources of the calculation, calibrated on the timings of the calculations on its computer."""
+        limits = self.inputs.resource_limits.get_dict()
+        basis = {key: limits[key] for key in ('rkmax', 'kpoint_density') if key in limits}
+        coefficients = calibrate(self.inputs.code.computer, **basis)
+        options, estimate = estimate_options(self.inputs.aiida_structure, coefficients=coefficients, **limits)
+        self.report(
+            f'estimated matrix size {estimate.matrix_size}, {estimate.memory_mb:.0f} MB per k-point, '
+            f'{estimate.num_kpoints} k-points, {sum(estimate.cycle_seconds.values()):.0f} s per cycle on one core: '
+            f'{options}'
+        )
+        return options
+
     def inspect_run123_lapw(self):
         """Inspect results of run123_lapw"""
 
@@ -57,7 +102,11 @@ class Wien2kScf123WorkChain(WorkChain):
 
         # Declaring the output
         self.out('workchain_result', self.ctx.node.outputs.scf_grep)
-        self.out('aiida_structure_out', self.ctx.node.outputs.aiida_structure_out)
+        # the calculation only has an output structure if it differs from the input structure
+        if 'aiida_structure_out' in self.ctx.node.outputs:
+            self.out('aiida_structure_out', self.ctx.node.outputs.aiida_structure_out)
+        else:
+            self.out('aiida_structure_out', self.inputs.aiida_structure)
 
     def inspect_warn_all_steps(self):
         """Check warnings in all calculations and set the exit code accordingly"""
@@ -0,0 +1,139 @@
+"""Benchmarks of the parser, the struct file I/O and ``prepare_for_submission`` on synthetic inputs.
+
+Every benchmark records the best wall time of a few repetitions and the peak memory allocated by Python (tracemalloc)
+and compares them to the baselines stored in ``baselines.json``: it fails if it is slower than
+``AIIDA_WIEN2K_BENCHMARK_TOLERANCE`` (default 5) times its baseline or if its peak memory grew by more than half.
+The benchmarks are deselected by default, run them with ``pytest -m benchmark`` and store new baselines with
+``AIIDA_WIEN2K_BENCHMARK_SAVE=1 pytest -m benchmark tests/benchmarks``.
+"""
+import io
+import json
+import logging
+import os
+import pathlib
+import timeit
+import tracemalloc
+
+import pytest
+from aiida.common.folders import Folder
+from aiida.orm import Dict
+from aiida_wien2k.calculations.run123_lapw import Wien2kRun123Lapw, aiida_struct2wien2k, write_struct
+from aiida_wien2k.parsers.scf123 import Wien2kScf123Parser, read_struct
+
+pytestmark = pytest.mark.benchmark
+
+LOGGER = logging.getLogger(__name__)
+
+BASELINES = pathlib.Path(__file__).resolve().parent / 'baselines.json'
+
+# peak memory of a benchmark may exceed its baseline by this factor plus 1 MB
+MEMORY_TOLERANCE = 1.5
+
+
+@pytest.fixture(scope='module')
+def baselines():
+    """Return the stored baselines, the baselines of this run are written back with ``AIIDA_WIEN2K_BENCHMARK_SAVE``."""
+    baselines = json.loads(BASELINES.read_text()) if BASELINES.exists() else {}
+    yield baselines
+    if os.environ.get('AIIDA_WIEN2K_BENCHMARK_SAVE'):
+        BASELINES.write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+
+
+@pytest.fixture
+def run_benchmark(request, baselines):
+    """Return a function that benchmarks a function without arguments against the baseline of the test."""
+    tolerance = float(os.environ.get('AIIDA_WIEN2K_BENCHMARK_TOLERANCE', 5.0))
+
+    def run(function, repeat=3):
+        name = request.node.name
+        seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+        tracemalloc.start()
+        try:
+            function()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+        LOGGER.info(f'{name}: {seconds * 1e3:.2f} ms, peak memory {peak_mb:.2f} MB')
+
+        if os.environ.get('AIIDA_WIEN2K_BENCHMARK_SAVE'):
+            baselines[name] = {'seconds': round(seconds, 6), 'peak_mb': round(peak_mb, 3)}
+        elif name in baselines:
+            baseline = baselines[name]
+            assert seconds <= tolerance * baseline['seconds'], f'slower than {tolerance} x {baseline["seconds"]} s'
+            assert peak_mb <= MEMORY_TOLERANCE * baseline['peak_mb'] + 1.0, f'more memory than {baseline["peak_mb"]} MB'
+        return seconds, peak_mb
+
+    return run
+
+
+@pytest.mark.parametrize(
+    'num_iterations, num_atoms, num_warnings', ((15, 1, 0), (100, 16, 0), (100, 16, 20), (40, 128, 0))
+)
+def test_parse(  # noqa: PLR0913
+    generate_scf123_outputs, generate_calc_job_node, run_benchmark, num_iterations, num_atoms, num_warnings
+):
+    """Benchmark ``Wien2kScf123Parser.parse`` of a converged run."""
+    directory, structure = generate_scf123_outputs(num_iterations, num_atoms, num_warnings)
+    node = generate_calc_job_node(
+        'wien2k-run123_lapw', None, None, inputs={'aiida_structure': structure}, filepath_retrieved=directory
+    )
+
+    def parse():
+        parser = Wien2kScf123Parser(node)
+        return parser.parse(), parser.outputs
+
+    run_benchmark(parse)
+
+    exit_code, outputs = parse()
+    assert exit_code.status == (Wien2kRun123Lapw.exit_codes.WARNING_QTL_B.status if num_warnings else 0)
+    assert outputs['scf_history'].get_array('Iter').tolist() == list(range(1, num_iterations + 1))
+    assert outputs['dayfile_timings'].get_array('lapw1').shape == (num_iterations, 4)
+
+
+@pytest.mark.parametrize('num_atoms', (16, 128))
+def test_read_struct(generate_scf123_outputs, run_benchmark, num_atoms):
+    """Benchmark ``read_struct`` of the struct file of a structure without symmetry."""
+    directory, _ = generate_scf123_outputs(1, num_atoms)
+    content = (directory / 'case.struct').read_text()
+
+    run_benchmark(lambda: read_struct(io.StringIO(content)))
+
+    assert len(read_struct(io.StringIO(content))) == num_atoms
+
+
+@pytest.mark.parametrize('num_atoms', (16, 128))
+def test_write_struct(generate_scf123_outputs, run_benchmark, num_atoms):
+    """Benchmark ``write_struct`` of a structure without symmetry."""
+    _, structure = generate_scf123_outputs(1, num_atoms)
+
+    run_benchmark(lambda: write_struct(io.StringIO(), structure))
+
+
+@pytest.mark.parametrize('num_atoms', (16, 128))
+def test_aiida_struct2wien2k(generate_scf123_outputs, run_benchmark, num_atoms):
+    """Benchmark ``aiida_struct2wien2k``, including the symmetry analysis, of a structure without symmetry."""
+    _, structure = generate_scf123_outputs(1, num_atoms)
+
+    run_benchmark(lambda: aiida_struct2wien2k(structure))
+
+
+@pytest.mark.parametrize('num_atoms', (16, 128))
+def test_prepare_for_submission(  # noqa: PLR0913
+    generate_scf123_outputs, generate_calc_job, aiida_local_code_factory, tmp_path, run_benchmark, num_atoms
+):
+    """Benchmark ``Wien2kRun123Lapw.prepare_for_submission`` of a parallel run of a structure without symmetry."""
+    _, structure = generate_scf123_outputs(1, num_atoms)
+    inputs = {
+        'code': aiida_local_code_factory('wien2k-run123_lapw', '/bin/true'),
+        'aiida_structure': structure,
+        'parameters': Dict({'-i': '100'}),
+        'metadata': {
+            'options': {
+                'resources': {'num_machines': 2, 'num_mpiprocs_per_machine': 16},
+                'max_wallclock_seconds': 3600,
+            }
+        },
+    }
+    process = generate_calc_job(Wien2kRun123Lapw, inputs=inputs, return_process=True)
+
+    run_benchmark(lambda: process.prepare_for_submission(Folder(tmp_path)))
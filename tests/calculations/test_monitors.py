@@ -0,0 +1,107 @@
+"""Tests for the :mod:`aiida_wien2k.calculations.monitors` module."""
+import pytest
+from aiida.orm import CalcJobNode
+from aiida_wien2k.calculations.monitors import SCF_FILES, monitor_scf
+from aiida_wien2k.calculations.run123_lapw import MONITOR_EXTRA
+
+
+def scf_iterations(charge_distances, first=1):
+    """Return the text of WIEN2k SCF iterations with the given charge distances, starting at iteration `first`."""
+    return ''.join(
+        f'            ---------\n:ITE{iteration:03d}: {iteration:2d}. ITERATION\n            ---------\n'
+        f':DIS  :  CHARGE DISTANCE       ( 0.0000007 for atom    1 spin 1)      {dis:.7f}\n'
+        f':ENE  : ********** TOTAL ENERGY IN Ry =       -14238.10360712\n'
+        for iteration, dis in enumerate(charge_distances, start=first)
+    )
+
+
+@pytest.fixture
+def monitor(aiida_localhost, tmp_path):
+    """Return a function that appends SCF iterations to the remote SCF file of a running calculation and polls it."""
+    node = CalcJobNode(computer=aiida_localhost, process_type='aiida.calculations:wien2k-run123_lapw')
+    node.set_remote_workdir(str(tmp_path))
+    node.store()
+    scf_file = tmp_path / SCF_FILES[1]
+    scf_file.parent.mkdir()
+    scf_file.write_text(' LAPW0 header\n')
+
+    def poll(text, **kwargs):
+        with scf_file.open('a') as handle:
+            handle.write(text)
+        with aiida_localhost.get_transport() as transport:
+            return monitor_scf(node, transport, **kwargs)
+
+    poll.node = node
+    poll.scf_file = scf_file
+    return poll
+
+
+def test_monitor_incremental(monitor):
+    """Test that only the complete iterations appended since the last poll are read."""
+    assert monitor(scf_iterations([0.5, 0.2, 0.1])) is None
+    state = monitor.node.base.extras.get(MONITOR_EXTRA)
+    # the last iteration is not closed by the next ':ITE' line yet
+    assert state['iteration'] == 2
+    assert state['offset'] == monitor.scf_file.read_text().index(':ITE003')
+
+    assert monitor(scf_iterations([0.05, 0.01], first=4)) is None
+    state = monitor.node.base.extras.get(MONITOR_EXTRA)
+    assert state['iteration'] == 4
+    assert state['recent_dis'] == [0.5, 0.2, 0.1, 0.05]
+    assert 'stopped' not in state
+
+
+def test_monitor_large_iteration(monitor):
+    """Test that the window is grown until it contains the next iteration if one iteration exceeds `max_bytes`."""
+    text = scf_iterations([0.5]) + ':QTL  : ' * 100 + '\n' + scf_iterations([0.2, 0.1], first=2)
+    # the first window ends with the header, the next window starts at the ':ITE001' line
+    assert monitor(text, max_bytes=256) is None
+    assert monitor.node.base.extras.get(MONITOR_EXTRA)['offset'] == monitor.scf_file.read_text().index(':ITE001')
+
+    assert monitor('', max_bytes=256) is None
+    state = monitor.node.base.extras.get(MONITOR_EXTRA)
+    assert state['offset'] > monitor.scf_file.read_text().index(':ITE002')
+    assert state['recent_dis'][0] == 0.5
+
+
+def test_monitor_scratch(monitor, tmp_path):
+    """Test that the SCF file of the scratch directory linked as `case/case` takes precedence."""
+    scratch = tmp_path / 'scratch'
+    scratch.mkdir()
+    (scratch / 'case.scf').write_text(scf_iterations([0.3, 0.2, 0.1]))
+    (tmp_path / 'case' / 'case').symlink_to(scratch)
+
+    assert monitor(scf_iterations([0.5, 0.4])) is None
+    assert monitor.node.base.extras.get(MONITOR_EXTRA)['recent_dis'] == [0.3, 0.2]
+
+    assert monitor('', scf_file=SCF_FILES[1]) is None
+    assert monitor.node.base.extras.get(MONITOR_EXTRA)['recent_dis'] == [0.5]
+
+
+def test_monitor_next_stage(monitor):
+    """Test that a new SCF file of the next precision stage restarts the monitor."""
+    monitor(scf_iterations([0.5, 0.2, 0.1, 0.05]))
+    monitor.scf_file.unlink()
+
+    assert monitor(scf_iterations([0.3, 0.2])) is None
+    state = monitor.node.base.extras.get(MONITOR_EXTRA)
+    assert state['iteration'] == 1
+    assert state['recent_dis'] == [0.3]
+
+
+def test_monitor_diverged(monitor):
+    """Test that a growing charge distance stops the SCF cycle."""
+    result = monitor(scf_iterations([0.1, 0.01, 0.2, 0.5, 1.0, 2.0, 4.0, 8.0]), divergence_window=5)
+
+    assert 'diverged' in result.message
+    assert not result.override_exit_code
+    assert monitor.node.base.extras.get(MONITOR_EXTRA)['stopped'] == 'ERROR_SCF_DIVERGED'
+
+
+def test_monitor_stalled(monitor):
+    """Test that a charge distance that does not drop any more stops the SCF cycle."""
+    assert monitor(scf_iterations([0.1, 0.05, 0.06, 0.048, 0.07])) is None
+    result = monitor(scf_iterations([0.05, 0.049, 0.06], first=6), stagnation_cycles=5)
+
+    assert 'stalled' in result.message
+    assert monitor.node.base.extras.get(MONITOR_EXTRA)['stopped'] == 'ERROR_SCF_STALLED'
@@ -0,0 +1,115 @@
+"""Tests for the :mod:`aiida_wien2k.calculations.resources` module."""
+import uuid
+
+import numpy as np
+import pytest
+from aiida.common.links import LinkType
+from aiida.orm import Computer, Dict, StructureData
+from aiida_wien2k.calculations.resources import (
+    MIN_WALLCLOCK_SECONDS,
+    _default_coefficients,
+    calibrate,
+    estimate,
+    estimate_options,
+)
+from aiida_wien2k.calculations.run123_lapw import Wien2kRun123LapwNode
+from ase.units import Bohr
+
+
+@pytest.fixture
+def reference_structure():
+    """Return the bcc iodine structure of the ``default`` parser fixture, in its conventional cell."""
+    lattice = 7.754003 * Bohr
+    structure = StructureData(cell=(np.eye(3) * lattice).tolist())
+    structure.append_atom(position=(0.0, 0.0, 0.0), symbols='I')
+    structure.append_atom(position=(lattice / 2, lattice / 2, lattice / 2), symbols='I')
+    return structure
+
+
+def test_estimate_reference(reference_structure):
+    """Test the estimate of the reference run: 1330 k-points, matrix size 339 and its timings."""
+    result = estimate(reference_structure)
+
+    assert result.num_atoms == 1  # primitive cell
+    assert result.num_kpoints == 1330
+    assert result.matrix_size == pytest.approx(339, rel=0.1)
+    assert sum(result.cycle_seconds.values()) == pytest.approx(60.628)
+
+
+def test_estimate_scaling(generate_structure):
+    """Test that supercells cost the same as the primitive cell and that the matrix grows with RKmax."""
+    structure = generate_structure('Si')
+    supercell = StructureData(ase=structure.get_ase().repeat(2))
+
+    assert estimate(supercell) == estimate(structure)
+    assert estimate(structure, rkmax=8.0).matrix_size < estimate(structure).matrix_size
+    assert estimate(structure, kpoint_density=1e6).num_kpoints < estimate(structure).num_kpoints
+
+
+def test_estimate_options_layout(generate_structure):
+    """Test the parallel layout: k-point parallel if lapw1 fits into memory, MPI ranks per k-point group otherwise."""
+    structure = generate_structure('Si')
+    options, result = estimate_options(structure, cores_per_machine=32, memory_mb_per_machine=128000, max_cycles=1000)
+
+    assert options['resources'] == {'num_machines': 1, 'num_mpiprocs_per_machine': 32}
+    assert options['mpiprocs_per_kgroup'] == 1
+    assert options['max_memory_kb'] <= 128000 * 1024
+
+    # lapw1 of a large matrix needs the memory of several cores
+    options, _ = estimate_options(structure, 32, 128000, rkmax=60.0)
+    assert options['mpiprocs_per_kgroup'] > 1
+    assert 32 % options['mpiprocs_per_kgroup'] == 0
+
+    # fewer k-points than cores
+    options, result = estimate_options(structure, 32, 128000, max_cycles=1000, kpoint_density=1e4)
+    assert result.num_kpoints * options['mpiprocs_per_kgroup'] >= 32 // 2
+
+
+def test_estimate_options_small(generate_structure):
+    """Test that a small calculation only gets the cores that finish it within the minimum wall time."""
+    structure = generate_structure('Si')
+    options, _ = estimate_options(structure, 32, 128000)
+    assert 1 < options['resources']['num_mpiprocs_per_machine'] < 32
+    assert options['max_wallclock_seconds'] == MIN_WALLCLOCK_SECONDS
+
+    # never more k-point groups than k-points
+    options, result = estimate_options(structure, 32, 128000, kpoint_density=1e4)
+    assert options['resources']['num_mpiprocs_per_machine'] <= result.num_kpoints
+
+
+def test_estimate_options_walltime(generate_structure):
+    """Test that the fewest machines finishing within the wall time limit are requested."""
+    structure = generate_structure('Si')
+    options, _ = estimate_options(structure, 4, 16000, max_machines=8, max_wallclock_seconds=10**6)
+    assert options['resources']['num_machines'] == 1
+    assert options['max_wallclock_seconds'] >= 1800
+
+    options, _ = estimate_options(structure, 4, 16000, max_machines=8, max_wallclock_seconds=1800, max_cycles=200)
+    assert options['resources']['num_machines'] > 1
+    assert options['max_wallclock_seconds'] <= 1800
+
+
+def test_calibrate(reference_structure):
+    """Test that the timings of a run of the reference structure calibrate the default coefficients."""
+    computer = Computer(
+        label=f'calibration-{uuid.uuid4()}',
+        hostname='localhost',
+        transport_type='core.local',
+        scheduler_type='core.direct',
+    ).store()
+    assert calibrate(computer) == _default_coefficients()
+
+    node = Wien2kRun123LapwNode(computer=computer, process_type='aiida.calculations:wien2k-run123_lapw')
+    node.base.links.add_incoming(
+        reference_structure.store(), link_type=LinkType.INPUT_CALC, link_label='aiida_structure'
+    )
+    node.set_option('resources', {'num_machines': 1, 'num_mpiprocs_per_machine': 2})
+    node.set_exit_status(0)
+    node.store()
+    wall_seconds = {'lapw0': 58.82, 'lapw1': 190.56, 'lapw2': 51.55, 'lcore': 1.02, 'mixer': 1.19}
+    summary = Dict({'prec3k': {'num_cycles': 5, 'wall_seconds': wall_seconds}})
+    summary.base.links.add_incoming(node, link_type=LinkType.CREATE, link_label='dayfile_timings_summary')
+    summary.store()
+
+    coefficients = calibrate(computer)
+    assert coefficients == pytest.approx({program: 2 * value for program, value in _default_coefficients().items()})
@@ -2,11 +2,45 @@
 from __future__ import annotations
 
 import io
+import logging
+import math
+import os
+import pathlib
+import shutil
+import socket
+import subprocess
+import timeit
 import typing as t
 
+import aiida_wien2k
+import numpy as np
 import pytest
-from aiida.orm import Dict, SinglefileData
-from aiida_wien2k.calculations.run123_lapw import Wien2kRun123Lapw
+import yaml
+from aiida.common.folders import Folder
+from aiida.common.links import LinkType
+from aiida.orm import (
+    CalcJobNode,
+    Dict,
+    InstalledCode,
+    QueryBuilder,
+    RemoteData,
+    SinglefileData,
+    StructureData,
+    load_node,
+)
+from aiida_wien2k.calculations.run123_lapw import (
+    WALLTIME_STOP_FILE,
+    WATCHDOG_POLL_SECONDS,
+    Wien2kRun123Lapw,
+    Wien2kRun123LapwNode,
+    aiida_struct2wien2k,
+    machines_prepend_text,
+    write_struct,
+    write_symmetric_struct,
+)
+from aiida_wien2k.parsers.scf123 import _read_dayfile_timings, read_struct
+
+LOGGER = logging.getLogger(__name__)
 
 
 def recursive_merge(left: dict[t.Any, t.Any], right: dict[t.Any, t.Any]) -> None:
@@ -60,8 +94,10 @@ def test_default_structure(generate_calc_job, generate_inputs):
             ('case/*.klist'),
             ('case/*.in0'),
             ('case/case.struct'),
+            ('case/walltime.stop'),
         ]
     )
+    assert calc_info.retrieve_temporary_list == ['case/*.scf']
 
     assert len(calc_info.local_copy_list) == 1
     assert calc_info.local_copy_list[0][-1] == 'case/case.struct'
@@ -88,6 +124,7 @@ def test_default_singlefile(generate_calc_job, generate_inputs):
             ('case/*.klist'),
             ('case/*.in0'),
             ('case/case.struct'),
+            ('case/walltime.stop'),
         ]
     )
 
@@ -95,6 +132,66 @@ def test_default_singlefile(generate_calc_job, generate_inputs):
     assert calc_info.local_copy_list[0] == (structure.uuid, 'structure.wien2k', 'case/case.struct')
 
 
+def test_minimal_retrieval(generate_calc_job, generate_inputs):
+    """Test that ``minimal_retrieval`` only retrieves the SCF output files temporarily."""
+    inputs = generate_inputs()
+    inputs['metadata']['options']['minimal_retrieval'] = True
+    _, calc_info = generate_calc_job(Wien2kRun123Lapw, inputs=inputs)
+
+    assert sorted(calc_info.retrieve_list) == ['case/*.error*', 'case/case.struct', 'case/walltime.stop']
+    assert sorted(calc_info.retrieve_temporary_list) == sorted(
+        [
+            ('case/*.scf'),
+            ('case/*.scf0'),
+            ('case/*.scf1'),
+            ('case/*.scf2'),
+            ('case/*.scfm'),
+            ('case/*.scfc'),
+            ('case/*.dayfile'),
+            ('case/*.klist'),
+            ('case/*.in0'),
+        ]
+    )
+
+
+def test_compress_outputs(generate_calc_job, generate_inputs):
+    """Test that ``compress_outputs`` compresses the SCF output files on the remote and retrieves them compressed."""
+    inputs = generate_inputs()
+    inputs['metadata']['options']['compress_outputs'] = True
+    _, calc_info = generate_calc_job(Wien2kRun123Lapw, inputs=inputs)
+
+    assert calc_info.append_text.startswith('gzip -f *.scf *.scf0 ')
+    assert calc_info.retrieve_temporary_list == ['case/*.scf.gz']
+    assert sorted(calc_info.retrieve_list) == sorted(
+        [
+            ('case/*.scf0.gz'),
+            ('case/*.scf1.gz'),
+            ('case/*.scf2.gz'),
+            ('case/*.scfm.gz'),
+            ('case/*.scfc.gz'),
+            ('case/*.error*'),
+            ('case/*.dayfile.gz'),
+            ('case/*.klist.gz'),
+            ('case/*.in0.gz'),
+            ('case/case.struct'),
+            ('case/walltime.stop'),
+        ]
+    )
+
+
+def test_parent_folder(generate_calc_job, generate_inputs, aiida_localhost):
+    """Test that a ``parent_folder`` copies the density of the parent, also from its scratch directory."""
+    parent_folder = RemoteData(computer=aiida_localhost, remote_path='/scratch/parent').store()
+    inputs = generate_inputs(parameters={'-i': '100'}, parent_folder=parent_folder)
+    _, calc_info = generate_calc_job(Wien2kRun123Lapw, inputs=inputs)
+
+    assert calc_info.remote_copy_list == [
+        (aiida_localhost.uuid, '/scratch/parent/case/case.clmsum', 'case/'),
+        (aiida_localhost.uuid, '/scratch/parent/case/case/case.clmsum', 'case/'),
+    ]
+    assert calc_info.codes_info[0].cmdline_params == ['-i', '100']
+
+
 def test_parameters(generate_calc_job, generate_inputs):
     """Test the ``parameters`` input."""
     parameters = {'-i': '100', '-p': True}
@@ -102,3 +199,313 @@ def test_parameters(generate_calc_job, generate_inputs):
     _, calc_info = generate_calc_job(Wien2kRun123Lapw, inputs=inputs)
 
     assert calc_info.codes_info[0].cmdline_params == ['-i', '100', '-p']
+
+
+def test_machines(generate_calc_job, generate_inputs, tmp_path):
+    """Test that a parallel run writes ``.machines`` with the host of the job and runs ``run123_lapw -p``."""
+    options = {
+        'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 4},
+        'mpiprocs_per_kgroup': 2,
+        'omp_threads': 2,
+        'kpoint_granularity': 3,
+    }
+    inputs = generate_inputs(parameters={'-i': '100'}, metadata={'options': options})
+    _, calc_info = generate_calc_job(Wien2kRun123Lapw, inputs=inputs)
+
+    assert calc_info.codes_info[0].cmdline_params == ['-i', '100', '-p']
+    subprocess.run(['bash', '-c', calc_info.prepend_text], cwd=tmp_path, env={'PATH': os.environ['PATH']}, check=True)
+    host = socket.gethostname()
+    assert (tmp_path / '.machines').read_text().splitlines() == [
+        f'1:{host}:2',
+        f'1:{host}:2',
+        f'lapw0:{host}:4 ',
+        'granularity:3',
+        'extrafine:1',
+        'omp_global:2',
+    ]
+
+
+def test_machines_serial(generate_calc_job, generate_inputs):
+    """Test that a serial run has no ``.machines``."""
+    _, calc_info = generate_calc_job(Wien2kRun123Lapw, inputs=generate_inputs())
+
+    assert calc_info.prepend_text is None
+    assert not calc_info.codes_info[0].cmdline_params
+
+
+def test_machines_kpoint_parallel():
+    """Test the ``.machines`` of a k-point parallel run on several machines from the node list of SLURM."""
+    text = machines_prepend_text(2, 2, lapw0_parallel=False)
+    scontrol = 'scontrol() { printf "node1\\nnode2\\nnode3\\n"; }'
+    content = subprocess.run(
+        ['bash', '-c', f'{scontrol}\ncd "$(mktemp -d)"\n{text}\ncat .machines'],
+        env={'PATH': os.environ['PATH'], 'SLURM_JOB_NODELIST': 'node[1-3]'},
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+    assert content.splitlines() == ['1:node1', '1:node1', '1:node2', '1:node2', 'granularity:1', 'extrafine:1']
+
+
+def test_machines_validation(generate_calc_job, generate_inputs):
+    """Test that the k-point groups have to fill the machines."""
+    options = {'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 4}, 'mpiprocs_per_kgroup': 3}
+    with pytest.raises(ValueError, match='not a multiple of `mpiprocs_per_kgroup`'):
+        generate_calc_job(Wien2kRun123Lapw, inputs=generate_inputs(metadata={'options': options}))
+
+
+@pytest.fixture
+def generate_sge_code(aiida_computer, aiida_local_code_factory):
+    """Return a code on a computer with the SGE scheduler, which allocates a parallel environment."""
+    computer = aiida_computer(
+        label='sge', scheduler_type='core.sge', transport_type='core.local', configuration_kwargs={}
+    )
+    return aiida_local_code_factory('wien2k-run123_lapw', '/bin/true', computer=computer, label='run123_lapw_sge')
+
+
+def test_machines_parallel_environment_serial(generate_calc_job, generate_inputs, generate_sge_code):
+    """Test that a serial run on a scheduler with a parallel environment has no ``.machines``."""
+    options = {'resources': {'parallel_env': 'smp', 'tot_num_mpiprocs': 1}}
+    inputs = generate_inputs(code=generate_sge_code, metadata={'options': options})
+    _, calc_info = generate_calc_job(Wien2kRun123Lapw, inputs=inputs)
+
+    assert calc_info.prepend_text is None
+    assert not calc_info.codes_info[0].cmdline_params
+
+
+def test_machines_parallel_environment_validation(generate_calc_job, generate_inputs, generate_sge_code):
+    """Test that a parallel run on a scheduler with a parallel environment fails the validation."""
+    options = {'resources': {'parallel_env': 'mpi', 'tot_num_mpiprocs': 4}}
+    inputs = generate_inputs(code=generate_sge_code, metadata={'options': options})
+    with pytest.raises(ValueError, match='needs `num_machines` and `num_mpiprocs_per_machine`'):
+        generate_calc_job(Wien2kRun123Lapw, inputs=inputs)
+
+
+@pytest.mark.parametrize('max_wallclock_seconds, stopped', ((100, True), (1000, False)))
+def test_walltime_stop(  # noqa: PLR0913
+    generate_calc_job, generate_inputs, filepath_tests, tmp_path, max_wallclock_seconds, stopped
+):
+    """Test that the job script stops run123_lapw if the longest cycle of the dayfile would not fit once more."""
+    inputs = generate_inputs()
+    inputs['metadata']['options'].update(max_wallclock_seconds=max_wallclock_seconds, walltime_stop_margin=10)
+    _, calc_info = generate_calc_job(Wien2kRun123Lapw, inputs=inputs)
+    assert WALLTIME_STOP_FILE in calc_info.prepend_text
+
+    dayfile = filepath_tests / 'parsers' / 'fixtures' / 'scf123' / 'default' / 'prec3k.dayfile'
+    shutil.copy(dayfile, tmp_path / 'case.dayfile')
+    prepend_text = calc_info.prepend_text.replace(f'sleep {WATCHDOG_POLL_SECONDS}', 'sleep 0.1')
+    script = f'{prepend_text}\nsleep 1\nls -a > files.txt\n{calc_info.append_text}'
+    subprocess.run(['bash', '-c', script], cwd=tmp_path, env={'PATH': os.environ['PATH']}, check=True)
+
+    assert ('.stop' in (tmp_path / 'files.txt').read_text().split()) == stopped
+    assert (tmp_path / WALLTIME_STOP_FILE).exists() == stopped
+    assert not (tmp_path / '.stop').exists()
+    if stopped:
+        with dayfile.open() as handle:
+            cycle_seconds = np.nansum([timing[:-1, 2] for timing in _read_dayfile_timings(handle).values()], axis=0)
+        assert (tmp_path / WALLTIME_STOP_FILE).read_text().split()[1] == str(math.ceil(cycle_seconds.max()))
+
+
+def test_walltime_stop_job_script(
+    generate_calc_job, generate_inputs, aiida_localhost, filepath_tests, tmp_path_factory
+):
+    """Test that the walltime stop marker reaches the case directory in the job script of the shipped code."""
+    config = yaml.safe_load(
+        (pathlib.Path(aiida_wien2k.__file__).parent / 'configs' / 'codes' / 'run123_lapw.yml').read_text()
+    )
+    scratch = tmp_path_factory.mktemp('scratch')
+    executable = tmp_path_factory.mktemp('bin') / 'run123_lapw'
+    executable.write_text('#!/bin/bash\nsleep 1\nls -a > files.txt\n')
+    executable.chmod(0o755)
+    code = InstalledCode(
+        computer=aiida_localhost,
+        filepath_executable=str(executable),
+        prepend_text=config['prepend_text'].replace('/${HOSTNAME}/scratch', str(scratch)),
+        append_text=config['append_text'],
+    ).store()
+
+    inputs = generate_inputs(code=code)
+    inputs['metadata']['options'].update(max_wallclock_seconds=100, walltime_stop_margin=10)
+    process = generate_calc_job(Wien2kRun123Lapw, inputs=inputs, return_process=True)
+    workdir = tmp_path_factory.mktemp('workdir')
+    process.presubmit(Folder(workdir))
+    # the engine uploads the files of the `local_copy_list` to the case directory
+    (workdir / 'case').mkdir()
+    shutil.copy(
+        filepath_tests / 'parsers' / 'fixtures' / 'scf123' / 'default' / 'prec3k.dayfile',
+        workdir / 'case' / 'case.dayfile',
+    )
+    script = workdir / '_aiidasubmit.sh'
+    script.write_text(script.read_text().replace(f'sleep {WATCHDOG_POLL_SECONDS}', 'sleep 0.1'))
+    subprocess.run(['bash', script.name], cwd=workdir, env={'PATH': os.environ['PATH']}, check=False)
+
+    assert '.stop' in (workdir / 'case' / 'case' / 'files.txt').read_text().split()
+    assert (workdir / 'case' / WALLTIME_STOP_FILE).exists()
+
+
+def test_walltime_stop_disabled(generate_calc_job, generate_inputs):
+    """Test that there is no watchdog without a wall time limit or with ``walltime_stop`` disabled."""
+    _, calc_info = generate_calc_job(Wien2kRun123Lapw, inputs=generate_inputs())
+    assert calc_info.prepend_text is None
+    assert calc_info.append_text is None
+
+    inputs = generate_inputs()
+    inputs['metadata']['options'].update(max_wallclock_seconds=3600, walltime_stop=False)
+    _, calc_info = generate_calc_job(Wien2kRun123Lapw, inputs=inputs)
+    assert calc_info.prepend_text is None
+
+
+def test_write_struct(generate_structure):
+    """Test that ``write_struct`` wraps the sites into the cell and is read back by ``read_struct``."""
+    structure = generate_structure()
+    ase_structure = structure.get_ase()
+    ase_structure.positions += [[0.0, 0.0, 0.0], [-1.0, 7.5, 3.0]]
+    structure = StructureData(ase=ase_structure)
+
+    content = write_struct(io.StringIO(), structure).getvalue()
+    assert content.splitlines()[1] == 'P   LATTICE,NONEQUIV.ATOMS:  2'
+    assert content.endswith('   0\n')
+
+    atoms = read_struct(io.StringIO(content))
+    assert atoms.get_chemical_symbols() == ['Si', 'Si']
+    assert np.allclose(atoms.cell.cellpar(), ase_structure.cell.cellpar())
+    scaled = ase_structure.get_scaled_positions()
+    assert np.allclose(atoms.get_scaled_positions(), scaled)
+    assert np.all((scaled >= 0) & (scaled < 1))
+
+
+@pytest.mark.benchmark
+def test_write_struct_benchmark(generate_structure):
+    """Benchmark ``write_struct`` for large supercells, its cost should be linear in the number of atoms."""
+    times = {}
+    for repeat in (4, 7):
+        structure = StructureData(ase=generate_structure().get_ase() * (repeat, repeat, repeat))
+        num_atoms = len(structure.sites)
+        assert len(read_struct(io.StringIO(write_struct(io.StringIO(), structure).getvalue()))) == num_atoms
+        times[num_atoms] = min(timeit.repeat(lambda: write_struct(io.StringIO(), structure), number=1, repeat=3))
+        LOGGER.info(f'write_struct: {num_atoms} atoms in {times[num_atoms] * 1e3:.2f} ms')
+
+    (small, time_small), (large, time_large) = sorted(times.items())
+    assert time_large < 2 * large / small * time_small
+
+
+@pytest.mark.parametrize(
+    'formula, kwargs, lattice, mult',
+    (
+        ('Si', {}, 'F   LATTICE,NONEQUIV.ATOMS:  1 227 Fd-3m', [2]),
+        ('Cu', {'a': 3.6, 'cubic': True}, 'F   LATTICE,NONEQUIV.ATOMS:  1 225 Fm-3m', [1]),
+        ('Fe', {}, 'B   LATTICE,NONEQUIV.ATOMS:  1 229 Im-3m', [1]),
+        ('Mg', {}, 'H   LATTICE,NONEQUIV.ATOMS:  1 194 P6_3/mmc', [2]),
+        ('CsCl', {'crystalstructure': 'cesiumchloride', 'a': 4.1}, 'P   LATTICE,NONEQUIV.ATOMS:  2 221 Pm-3m', [1, 1]),
+        (
+            'Bi',
+            {'crystalstructure': 'rhombohedral', 'a': 4.75, 'alpha': 57.2},
+            'R   LATTICE,NONEQUIV.ATOMS:  1 166 R-3m',
+            [2],
+        ),
+    ),
+)
+def test_write_symmetric_struct(formula, kwargs, lattice, mult):
+    """Test that ``write_symmetric_struct`` groups the equivalent atoms in the cell of the right lattice type."""
+    spglib = pytest.importorskip('spglib')
+    from ase.build import bulk
+
+    ase_structure = bulk(formula, **kwargs) * (2, 1, 1)
+    content = write_symmetric_struct(io.StringIO(), StructureData(ase=ase_structure)).getvalue()
+    assert content.splitlines()[1] == lattice
+
+    *_, mult_read = read_struct(io.StringIO(content), ase=False)
+    assert mult_read.tolist() == mult
+
+    atoms = read_struct(io.StringIO(content))
+    assert len(atoms) == sum(mult)
+    assert np.isclose(atoms.get_volume() / len(atoms), ase_structure.get_volume() / len(ase_structure))
+    dataset = spglib.get_symmetry_dataset((atoms.cell[:], atoms.get_scaled_positions(), atoms.numbers), symprec=1e-4)
+    assert dataset.international == lattice.split()[-1]
+
+
+def test_write_symmetric_struct_rotloc():
+    """Test the local rotation matrices and that sites of different kinds are not grouped."""
+    pytest.importorskip('spglib')
+    from ase.spacegroup import crystal
+
+    rutile = crystal(['Ti', 'O'], [(0, 0, 0), (0.3, 0.3, 0)], spacegroup=136, cellpar=[4.59, 4.59, 2.96, 90, 90, 90])
+    content = write_symmetric_struct(io.StringIO(), StructureData(ase=rutile)).getvalue().splitlines()
+    rotloc = [line[20:] for line in content if line.startswith('LOCAL ROT MATRIX:')]
+    assert rotloc == [' 0.7071068 0.7071068 0.0000000'] * 2
+
+    structure = StructureData(cell=np.eye(3) * 3.0)
+    structure.append_atom(position=(0.0, 0.0, 0.0), symbols='Fe', name='Fe1')
+    structure.append_atom(position=(1.5, 1.5, 1.5), symbols='Fe', name='Fe2')
+    content = write_symmetric_struct(io.StringIO(), structure).getvalue()
+    assert content.splitlines()[1] == 'P   LATTICE,NONEQUIV.ATOMS:  2 221 Pm-3m'
+
+
+def test_struct_file_deduplication(generate_calc_job, generate_inputs, generate_structure):
+    """Test that the struct file of a structure is stored once and reused by later calculations."""
+    _, calc_info = generate_calc_job(Wien2kRun123Lapw, inputs=generate_inputs())
+    _, calc_info_same = generate_calc_job(Wien2kRun123Lapw, inputs=generate_inputs())
+    _, calc_info_other = generate_calc_job(
+        Wien2kRun123Lapw, inputs=generate_inputs(aiida_structure=generate_structure('Ge'))
+    )
+
+    assert calc_info_same.local_copy_list == calc_info.local_copy_list
+    assert calc_info_other.local_copy_list[0][0] != calc_info.local_copy_list[0][0]
+
+
+@pytest.fixture
+def compute_hash(aiida_localhost, aiida_local_code_factory):
+    """Return a factory of the process hash of a ``Wien2kRun123Lapw`` calculation with the given inputs and options."""
+    code = aiida_local_code_factory('wien2k-run123_lapw', '/bin/true')
+
+    def factory(options=None, **inputs):
+        node = Wien2kRun123LapwNode(computer=aiida_localhost, process_type='aiida.calculations:wien2k-run123_lapw')
+        for link_label, value in {'code': code, **inputs}.items():
+            node.base.links.add_incoming(value.store(), link_type=LinkType.INPUT_CALC, link_label=link_label)
+        for name, value in {
+            'resources': {'num_machines': 1},
+            'parser_name': 'wien2k-scf123-parser',
+            **(options or {}),
+        }.items():
+            node.set_option(name, value)
+        return node.base.caching._compute_hash()  # the hash of the node when it is stored
+
+    return factory
+
+
+def test_hash_canonical_structure(compute_hash, generate_structure):
+    """Test that equal structures share the process hash, whatever their site order, wrapping and input port."""
+    structure = generate_structure('Si')
+    reference = compute_hash(aiida_structure=structure)
+
+    ase_structure = structure.get_ase()[::-1]
+    ase_structure.positions += ase_structure.cell[0] + 1e-9
+    assert compute_hash(aiida_structure=StructureData(ase=ase_structure)) == reference
+    assert compute_hash(wien2k_structure=aiida_struct2wien2k(structure)) == reference
+
+    ase_structure.set_cell(ase_structure.cell * 1.01, scale_atoms=True)
+    assert compute_hash(aiida_structure=StructureData(ase=ase_structure)) != reference
+
+
+def test_hash_parameters_options(compute_hash, generate_structure):
+    """Test that the process hash ignores the order of the parameters and the options that do not change results."""
+    structure = generate_structure('Si')
+    reference = compute_hash(aiida_structure=structure, parameters=Dict({'-i': '100', '-p': True}))
+
+    parameters = Dict({'-p': True, '-ec': False, '-i': '100'})
+    options = {'resources': {'num_machines': 2}, 'parser_max_workers': 4, 'walltime_stop': False}
+    assert compute_hash(aiida_structure=structure, parameters=parameters, options=options) == reference
+    for option in ('minimal_retrieval', 'compress_outputs'):
+        assert compute_hash(aiida_structure=structure, parameters=parameters, options={option: True}) != reference
+    assert compute_hash(aiida_structure=structure, parameters=Dict({'-i': '50', '-p': True})) != reference
+    assert compute_hash(aiida_structure=structure, options={'parser_name': 'other'}) != reference
+
+
+def test_node_class(generate_calc_job_node):
+    """Test that the calculation node is loaded as ``Wien2kRun123LapwNode`` and found as ``CalcJobNode``."""
+    node = Wien2kRun123LapwNode(process_type='aiida.calculations:wien2k-run123_lapw').store()
+
+    assert Wien2kRun123Lapw._node_class is Wien2kRun123LapwNode
+    assert isinstance(load_node(node.pk), Wien2kRun123LapwNode)
+    assert node.pk in QueryBuilder().append(CalcJobNode, project='id').all(flat=True)
@@ -3,6 +3,7 @@ from __future__ import annotations
 
 import collections
 import pathlib
+import re
 
 import pytest
 from aiida.common.folders import Folder
@@ -11,6 +12,8 @@ from aiida.engine.utils import instantiate_process
 from aiida.manage.manager import get_manager
 from aiida.orm import CalcJobNode, FolderData, StructureData, TrajectoryData
 from aiida.plugins import ParserFactory
+from aiida_wien2k.calculations.run123_lapw import aiida_struct2wien2k
+from aiida_wien2k.parsers.scf123 import _SCF_FILES
 from ase.build import bulk
 
 pytest_plugins = ['aiida.manage.tests.pytest_fixtures']
@@ -59,16 +62,23 @@ def generate_calc_job_node(filepath_tests, aiida_localhost, tmp_path):
                 flat_inputs.append((prefix + key, value))
         return flat_inputs
 
-    def factory(
+    def factory(  # noqa: PLR0913
         entry_point: str,
-        directory: str,
-        test_name: str,
+        directory: str | None,
+        test_name: str | None,
         inputs: dict | None = None,
         retrieve_temporary_list: list[str] | None = None,
+        options: dict | None = None,
+        filepath_retrieved: pathlib.Path | None = None,
     ):
-        """Create and return a :class:`aiida.orm.CalcJobNode` instance."""
+        """Create and return a :class:`aiida.orm.CalcJobNode` instance.
+
+        The retrieved files are taken from the parser fixture `directory/test_name`, or from `filepath_retrieved`."""
         node = CalcJobNode(computer=aiida_localhost, process_type=f'aiida.calculations:{entry_point}')
 
+        for name, value in (options or {}).items():
+            node.set_option(name, value)
+
         if inputs:
             for link_label, input_node in flatten_inputs(inputs):
                 input_node.store()
@@ -76,10 +86,14 @@ def generate_calc_job_node(filepath_tests, aiida_localhost, tmp_path):
 
         node.store()
 
-        filepath_retrieved = filepath_tests / 'parsers' / 'fixtures' / directory / test_name
+        if filepath_retrieved is None:
+            filepath_retrieved = filepath_tests / 'parsers' / 'fixtures' / directory / test_name
 
         retrieved = FolderData()
         retrieved.put_object_from_tree(filepath_retrieved)
+        for pattern in retrieve_temporary_list or []:  # temporary files are not in the retrieved folder
+            for filename in filepath_retrieved.glob(pattern):
+                retrieved.base.repository.delete_object(str(filename.relative_to(filepath_retrieved)))
         retrieved.base.links.add_incoming(node, link_type=LinkType.CREATE, link_label='retrieved')
         retrieved.store()
 
@@ -96,6 +110,17 @@ def generate_calc_job_node(filepath_tests, aiida_localhost, tmp_path):
     return factory
 
 
+@pytest.fixture
+def pack_repository():
+    """Return a function that packs the loose objects of the file repository, like `verdi storage maintain`."""
+
+    def factory():
+        repository = get_manager().get_profile_storage().get_repository()
+        repository.maintain(live=True, pack_loose=True, do_repack=False, clean_storage=False, do_vacuum=False)
+
+    return factory
+
+
 @pytest.fixture(scope='session')
 def generate_parser():
     """Fixture to load a parser class for testing parsers."""
@@ -123,6 +148,87 @@ def generate_structure():
     return factory
 
 
+# lines of the atom 001 in the WIEN2k SCF files, e.g. ':CHA001:' or ':1S 001:', without the bands ':BAN00001:'
+_SCF_ATOM_LINE = re.compile(r'^(:(?!BAN|EIG).*?)(0+1)(:.*)$', re.DOTALL)
+
+
+@pytest.fixture
+def generate_scf123_outputs(filepath_tests, tmp_path_factory):
+    """Return a factory writing the synthetic output files of a converged run123_lapw run of a configurable size.
+
+    The files are built from the ``default`` parser fixture: the lines of the atom ``001`` are repeated for every
+    atom, ``prec3k.scf`` and ``prec3k.dayfile`` have ``num_iterations`` iterations with a decaying charge distance and
+    ``num_warnings`` QTL-B warnings are added to the last iteration. ``case.struct`` is the struct file of a rattled
+    supercell without symmetry, such that all atoms are inequivalent.
+    """
+    template = filepath_tests / 'parsers' / 'fixtures' / 'scf123' / 'default'
+
+    def repeat_atoms(text, num_atoms):
+        """Repeat the lines of the atom 001 of the SCF file `text` for `num_atoms` atoms."""
+        lines = []
+        for line in text.splitlines(keepends=True):
+            match = _SCF_ATOM_LINE.match(line)
+            if match is None:
+                lines.append(line)
+                continue
+            width = len(match.group(2))
+            lines.extend(f'{match.group(1)}{atom:0{width}d}{match.group(3)}' for atom in range(1, num_atoms + 1))
+        return ''.join(lines)
+
+    def factory(
+        num_iterations: int = 15, num_atoms: int = 1, num_warnings: int = 0
+    ) -> tuple[pathlib.Path, StructureData]:
+        """Write the output files and return their folder and the input structure of the run."""
+        directory = tmp_path_factory.mktemp('scf123')
+        atoms = bulk('I', 'sc', a=4.1) * (num_atoms, 1, 1)
+        if num_atoms > 1:
+            atoms.rattle(0.05, seed=0)
+        structure = StructureData(ase=atoms)
+        (directory / 'case.struct').write_bytes(aiida_struct2wien2k(structure).get_content(mode='rb'))
+        for fname in ('prec3k.in0', 'prec3k.klist', '_scheduler-stdout.txt', '_scheduler-stderr.txt'):
+            (directory / fname).write_bytes((template / fname).read_bytes())
+
+        # the last iteration, the header of scf0 precedes the first iteration
+        files = {ext: repeat_atoms((template / f'prec3k.{ext}').read_text(), num_atoms) for ext in _SCF_FILES}
+        files['scf2'] += ''.join(
+            f':WARN : QTL-B value eq.   2.17 in Band of energy   0.84994  ATOM= {atom:4d}  L=  3\n'
+            for atom in range(1, num_warnings + 1)
+        )
+        header, _, files['scf0'] = files['scf0'].partition(':ITE015: 15. ITERATION\n')
+        iteration = ''.join(files[ext] for ext in _SCF_FILES)
+        for ext in _SCF_FILES:
+            prefix = f'{header}:ITE{num_iterations:03d}: {num_iterations:2d}. ITERATION\n' if ext == 'scf0' else ''
+            (directory / f'prec3k.{ext}').write_text(prefix + files[ext])
+
+        with (directory / 'prec3k.scf').open('w') as handle:
+            handle.write(header)
+            for index in range(1, num_iterations + 1):
+                handle.write(f':ITE{index:03d}: {index:2d}. ITERATION\n')
+                handle.write(
+                    iteration.replace('      0.0000007\n', f'      {0.5 * 0.7**index:.7f}\n').replace(
+                        '-14238.10360884', f'{-14238.10360884 + 0.1 * 0.7**index:.8f}'
+                    )
+                )
+
+        dayfile = (template / 'prec3k.dayfile').read_text()
+        dayfile_header, _, rest = dayfile.partition('    cycle 1 ')
+        cycle = '    cycle 1 ' + rest.partition('    cycle 2 ')[0]
+        with (directory / 'prec3k.dayfile').open('w') as handle:
+            handle.write(dayfile_header)
+            for index in range(1, num_iterations):
+                handle.write(cycle.replace('cycle 1 ', f'cycle {index} '))
+            handle.write(
+                cycle.replace('cycle 1 ', f'cycle {num_iterations} ').replace(
+                    'ec cc and fc_conv 0 0 1', 'ec cc fc and str_conv 1 1 1 1'
+                )
+            )
+            handle.write('>   stop\n')
+
+        return directory, structure
+
+    return factory
+
+
 @pytest.fixture
 def generate_trajectory(generate_structure):
     """Return factory to generate a ``TrajectoryData`` instance."""
@@ -1,5 +1,29 @@
 """Tests for the :mod:`aiida_wien2k.parsers.scf123` module."""
-from aiida_wien2k.calculations.run123_lapw import Wien2kRun123Lapw
+import gzip
+import io
+import logging
+import shutil
+import timeit
+
+import numpy as np
+import pytest
+from aiida.orm import FolderData, StructureData
+from aiida_wien2k.calculations.run123_lapw import MONITOR_EXTRA, Wien2kRun123Lapw
+from aiida_wien2k.parsers.scf123 import (
+    PROFILE_ENV,
+    PROFILE_EXTRA,
+    SPANS_EXTRA,
+    _classify_warnings,
+    _iter_scf_history,
+    _read_dayfile_timings,
+    _read_last_block,
+    _RetrievedFiles,
+    _scan,
+    read_struct,
+    same_struct,
+)
+
+LOGGER = logging.getLogger(__name__)
 
 
 def test_default(generate_calc_job_node, generate_parser, data_regression):
@@ -12,6 +36,91 @@ def test_default(generate_calc_job_node, generate_parser, data_regression):
     assert calcfunction.is_finished_ok, calcfunction.exit_message
     data_regression.check({'scf_grep': results['scf_grep'].get_dict()})
 
+    history = results['scf_history']
+    assert history.get_array('Iter').tolist() == [15]
+    assert history.get_array('EtotRyd').tolist() == [-14238.10360884]
+    assert history.get_array('DisCharge').tolist() == [0.0000007]
+    assert np.isnan(history.get_array('GapEv')).all()
+
+
+def test_warm_start(generate_calc_job_node, generate_parser, data_regression):
+    """Test parsing of a calculation warm started from the density of a parent calculation.
+
+    The ``warm_start`` fixture is synthetic, not a measurement: it is the ``default`` calculation with only its last two
+    prec3k cycles, as if it had been restarted from its own converged density.
+    """
+    parser = generate_parser('wien2k-scf123-parser')
+    node = generate_calc_job_node('wien2k-run123_lapw', 'scf123', 'warm_start')
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_message
+    assert results['dayfile_timings_summary']['prec3k']['num_cycles'] == 2
+    data_regression.check({'scf_grep': results['scf_grep'].get_dict()})
+
+
+def test_minimal_retrieval(generate_calc_job_node, generate_parser, data_regression):
+    """Test parsing of the SCF output files from the temporary folder of ``minimal_retrieval``."""
+    node, retrieved_temporary_folder = generate_calc_job_node(
+        'wien2k-run123_lapw', 'scf123', 'default', retrieve_temporary_list=['*.scf*', '*.dayfile', '*.klist', '*.in0']
+    )
+    assert 'prec3k.scf0' not in node.outputs.retrieved.base.repository.list_object_names()
+    parser = generate_parser('wien2k-scf123-parser')
+    results, calcfunction = parser.parse_from_node(
+        node, store_provenance=False, retrieved_temporary_folder=str(retrieved_temporary_folder)
+    )
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_message
+    data_regression.check({'scf_grep': results['scf_grep'].get_dict()}, basename='test_default')
+    assert results['scf_history'].get_array('Iter').tolist() == [15]
+
+
+@pytest.mark.parametrize('lattice_constant, same', ((7.754003, True), (7.8, False)))
+def test_output_structure(generate_calc_job_node, generate_parser, lattice_constant, same):
+    """Test that ``aiida_structure_out`` is only created if the structure differs from the input structure."""
+    from ase.build import bulk
+    from ase.units import Bohr
+
+    structure = StructureData(ase=bulk('I', 'bcc', a=lattice_constant * Bohr))
+    node = generate_calc_job_node('wien2k-run123_lapw', 'scf123', 'default', inputs={'aiida_structure': structure})
+    parser = generate_parser('wien2k-scf123-parser')
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_message
+    assert ('aiida_structure_out' not in results) is same
+
+
+def test_same_struct():
+    """Test the comparison of struct files within a tolerance, regardless of the order of the atoms."""
+    content = (
+        'ASE generated\n'
+        'P   LATTICE,NONEQUIV.ATOMS:  2\n'
+        'MODE OF CALC=RELA\n'
+        '  7.754003  7.754003  7.754003 90.000000 90.000000 90.000000\n'
+        'ATOM   1: X=0.00000000 Y=0.00000000 Z=0.00000000\n'
+        '          MULT= 2          ISPLIT= 2\n'
+        '          X=0.50000000 Y=0.50000000 Z=0.50000000\n'
+        'Cs         NPT=  781  R0=0.00001000 RMT= 2.35000     Z:  55.\n'
+        'LOCAL ROT MATRIX:    1.0000000 0.0000000 0.0000000\n'
+        '                     0.0000000 1.0000000 0.0000000\n'
+        '                     0.0000000 0.0000000 1.0000000\n'
+        'ATOM   2: X=0.25000000 Y=0.25000000 Z=0.25000000\n'
+        '          MULT= 1          ISPLIT= 2\n'
+        'Cl         NPT=  781  R0=0.00010000 RMT= 2.35000     Z:  17.\n'
+        'LOCAL ROT MATRIX:    1.0000000 0.0000000 0.0000000\n'
+        '                     0.0000000 1.0000000 0.0000000\n'
+        '                     0.0000000 0.0000000 1.0000000\n'
+    )
+    assert same_struct(content, content)
+    reordered = content.replace('X=0.00000000 Y=0.00000000 Z=0.00000000', 'X=0.50000000 Y=0.50000000 Z=0.50000000', 1)
+    reordered = reordered.replace('          X=0.50000000', '          X=0.00000000').replace(
+        'Y=0.50000000 Z=0.50000000\nCs', 'Y=0.00000000 Z=0.99999999\nCs'
+    )
+    assert same_struct(content, reordered)
+    assert not same_struct(content, content.replace('X=0.25000000', 'X=0.25010000'))
+    assert not same_struct(content, content.replace('7.754003  7.754003  7.754003', '7.754003  7.754003  7.755003'))
+    assert not same_struct(content, content.replace('Cl ', 'Br '))
+    assert not same_struct(content, content.replace('P   LATTICE', 'B   LATTICE'))
+
 
 def test_failed_warning_converg(generate_calc_job_node, generate_parser, data_regression):
     """Test parsing of exit code ``WARNING_CONVERG``."""
@@ -25,6 +134,16 @@ def test_failed_warning_converg(generate_calc_job_node, generate_parser, data_re
     data_regression.check({'scf_grep': results['scf_grep'].get_dict()})
 
 
+def test_failed_stopped_walltime(generate_calc_job_node, generate_parser):
+    """Test that an unconverged run stopped before the wall time limit returns ``ERROR_SCF_STOPPED_WALLTIME``."""
+    node = generate_calc_job_node('wien2k-run123_lapw', 'scf123', 'failed_stopped_walltime')
+    parser = generate_parser('wien2k-scf123-parser')
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.exit_status == Wien2kRun123Lapw.exit_codes.ERROR_SCF_STOPPED_WALLTIME.status
+    assert 'Warning: SCF not converged' in results['scf_grep']['Warning_last']
+
+
 def test_failed_warning_other(generate_calc_job_node, generate_parser, data_regression):
     """Test parsing of exit code ``WARNING_OTHER``."""
     node = generate_calc_job_node('wien2k-run123_lapw', 'scf123', 'failed_warning_other')
@@ -47,3 +166,358 @@ def test_failed_warning_qtl_b(generate_calc_job_node, generate_parser, data_regr
     assert calcfunction.is_failed, calcfunction.exit_status
     assert calcfunction.exit_status == Wien2kRun123Lapw.exit_codes.WARNING_QTL_B.status
     data_regression.check({'scf_grep': results['scf_grep'].get_dict()})
+
+
+def test_warning_intermediate_stage(generate_calc_job_node, generate_parser, data_regression):
+    """Test that a warning of the intermediate prec3 stage is reported in ``scf_grep`` if prec3k has no warnings."""
+    node = generate_calc_job_node('wien2k-run123_lapw', 'scf123', 'failed_warning_qtl_b3')
+    parser = generate_parser('wien2k-scf123-parser')
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_status
+    assert results['scf_history'].get_array('Iter_prec3').tolist() == [15]
+    data_regression.check({'scf_grep': results['scf_grep'].get_dict()})
+
+
+@pytest.mark.parametrize(('final_converged', 'exit_code'), ((True, None), (False, 'WARNING_CONVERG')))
+def test_not_converged_intermediate_stage(  # noqa: PLR0913
+    generate_calc_job_node, generate_parser, filepath_tests, tmp_path, final_converged, exit_code
+):
+    """Test the exit code of a run whose prec3 stage did not converge, it fails only if prec3k did not converge."""
+    directory = tmp_path / 'retrieved'
+    shutil.copytree(filepath_tests / 'parsers' / 'fixtures' / 'scf123' / 'failed_warning_qtl_b3', directory)
+    replacements = {'prec3.dayfile': ('fc_conv 1 1 1', 'fc_conv 1 0 1')}
+    if not final_converged:
+        replacements['prec3k.dayfile'] = ('str_conv 1 1 1 1', 'str_conv 1 0 1 1')
+    for fname, (old, new) in replacements.items():
+        (directory / fname).write_text((directory / fname).read_text().replace(old, new))
+    node = generate_calc_job_node('wien2k-run123_lapw', None, None, filepath_retrieved=directory)
+    parser = generate_parser('wien2k-scf123-parser')
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    expected = 0 if exit_code is None else Wien2kRun123Lapw.exit_codes[exit_code].status
+    assert calcfunction.exit_status == expected
+    assert 'Warning: SCF prec3 not converged' in results['scf_grep']['Warning_last_prec3']
+    assert ('Warning: SCF not converged' in results['scf_grep']['Warning_last']) != final_converged
+
+
+def test_failed_interrupted(generate_calc_job_node, generate_parser, data_regression):
+    """Test salvaging the last complete iteration of a run interrupted in the middle of an SCF iteration."""
+    node = generate_calc_job_node('wien2k-run123_lapw', 'scf123', 'failed_interrupted')
+    parser = generate_parser('wien2k-scf123-parser')
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished, calcfunction.exception
+    assert calcfunction.is_failed, calcfunction.exit_status
+    assert calcfunction.exit_status == Wien2kRun123Lapw.exit_codes.ERROR_SCF_INCOMPLETE.status
+    assert 'aiida_structure_out' not in results
+    assert results['scf_history'].get_array('Iter').tolist() == [14, 15]
+    data_regression.check({'scf_grep': results['scf_grep'].get_dict()})
+
+
+def test_failed_stopped_by_monitor(generate_calc_job_node, generate_parser):
+    """Test that the exit code requested by the ``wien2k.scf`` monitor is returned after salvaging."""
+    node = generate_calc_job_node('wien2k-run123_lapw', 'scf123', 'failed_interrupted')
+    node.base.extras.set(MONITOR_EXTRA, {'stopped': 'ERROR_SCF_STALLED'})
+    parser = generate_parser('wien2k-scf123-parser')
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.exit_status == Wien2kRun123Lapw.exit_codes.ERROR_SCF_STALLED.status
+    assert results['scf_grep']['Iter'] == [14]
+
+
+def test_scan():
+    """Test that ``_scan`` extracts all requested keys in a single pass."""
+    content = '\n'.join(
+        [
+            ':ITE002:  2. ITERATION',
+            ':CHA001: TOTAL VALENCE CHARGE INSIDE SPHERE   1 =   6.7577    (RMT=  1.5800 )',
+            ':FER  : F E R M I - ENERGY(FERMI-SM.)=   0.3347787693',
+            ':CHA002: TOTAL VALENCE CHARGE INSIDE SPHERE   2 =   6.7577    (RMT=  2.3500 )',
+            ':FER  : F E R M I - ENERGY(FERMI-SM.)=   0.5',
+        ]
+    )
+    found = _scan(content, [':ITE', ':FER', ':CHA', ':ENE'])
+
+    assert found == {':ITE': 2, ':FER': 0.3347787693, ':CHA': [1.58, 2.35], ':ENE': None}
+
+
+@pytest.mark.parametrize('blocksize', (3, 16, 65536))
+def test_read_last_block(blocksize):
+    """Test that ``_read_last_block`` returns only the last iteration of a SCF file."""
+    content = b'preamble\n:ITE001:  1. ITERATION\n:ENE  : = -1.0\n:ITE002:  2. ITERATION\n:ENE  : = -2.0\n'
+    last_block = _read_last_block(io.BytesIO(content), b':ITE', blocksize=blocksize)
+
+    assert last_block == ':ITE002:  2. ITERATION\n:ENE  : = -2.0\n'
+    assert _scan(last_block, [':ITE', ':ENE']) == {':ITE': 2, ':ENE': -2.0}
+    assert _read_last_block(io.BytesIO(b'no delimiter\n'), b':ITE', blocksize=blocksize) == 'no delimiter\n'
+
+
+def test_iter_scf_history():
+    """Test that ``_iter_scf_history`` yields one record per iteration."""
+    lines = io.StringIO(
+        'preamble\n'
+        ':ITE001:  1. ITERATION\n'
+        ':FER  : F E R M I - ENERGY(FERMI-SM.)=   0.30\n'
+        ':DIS  :  CHARGE DISTANCE       ( 0.0100000 for atom    1 spin 1)      0.0100000\n'
+        ':ENE  : ********** TOTAL ENERGY IN Ry =       -10.5\n'
+        ':ITE002:  2. ITERATION\n'
+        ':FER  : F E R M I - ENERGY(FERMI-SM.)=   0.31\n'
+        '          -(T*S)            =  -0.00166648\n'
+        ':ENE  : ********** TOTAL ENERGY IN Ry =       -10.6\n'
+    )
+    records = list(_iter_scf_history(lines))
+
+    assert [record['Iter'] for record in records] == [1, 2]
+    assert [record['EtotRyd'] for record in records] == [-10.5, -10.6]
+    assert [record['EfermiRyd'] for record in records] == [0.30, 0.31]
+    assert records[0]['DisCharge'] == 0.01
+    assert np.isnan(records[1]['DisCharge'])
+    assert np.isnan(records[0]['mTSRyd'])
+    assert records[1]['mTSRyd'] == -0.00166648
+
+
+def test_dayfile_timings(generate_calc_job_node, generate_parser, data_regression):
+    """Test parsing of the program timings of the ``*.dayfile``."""
+    node = generate_calc_job_node('wien2k-run123_lapw', 'scf123', 'default')
+    parser = generate_parser('wien2k-scf123-parser')
+    results, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_message
+    timings = results['dayfile_timings']
+    assert sorted(timings.get_arraynames()) == ['lapw0', 'lapw1', 'lapw2', 'lcore', 'mixer']
+    assert timings.get_array('lapw1').shape == (5, 4)
+    assert timings.get_array('lapw1')[0].tolist() == [31.846, 6.707, 38.69, 99.6]
+    data_regression.check({'dayfile_timings_summary': results['dayfile_timings_summary'].get_dict()})
+
+
+def test_read_dayfile_timings():
+    """Test that ``_read_dayfile_timings`` accumulates programs that run several times in a cycle."""
+    lines = io.StringIO(
+        '>   lapw0 (23:21:04) 1.0u 0.0s 0:01.00 100.0%\n'
+        '    cycle 1 (Wed Mar  9 23:21:04 CET 2022) (100/99 to go)\n'
+        '>   lapw1  -up (23:21:16) 3.0u 1.0s 0:08.00 50.0%\n'
+        '>   lapw1  -dn (23:21:24) 3.0u 1.0s 1:00:08.00 50.0%\n'
+        '    cycle 2 (Wed Mar  9 23:22:05 CET 2022) (99/98 to go)\n'
+        '>   lapw0 (23:22:05) 1.0u 0.0s 0:02.00 50.0%\n'
+    )
+    timings = _read_dayfile_timings(lines)
+
+    assert list(timings) == ['lapw1', 'lapw0']
+    assert timings['lapw1'][0].tolist() == [6.0, 2.0, 3616.0, 100.0 * 8.0 / 3616.0]
+    assert np.isnan(timings['lapw1'][1]).all()
+    assert timings['lapw0'][1].tolist() == [1.0, 0.0, 2.0, 50.0]
+
+
+@pytest.mark.parametrize('packed', (False, True))
+def test_retrieved_files(packed, pack_repository):
+    """Test that ``_RetrievedFiles`` serves memory mapped loose files as well as objects of a packed repository."""
+    folder = FolderData()
+    folder.put_object_from_filelike(io.BytesIO(b':ITE001: 1.\n:ENE = -1.0\n:ITE002: 2.\n:ENE = -2.0'), 'case.scfm')
+    folder.put_object_from_filelike(io.BytesIO(b''), 'case.error')
+    folder.store()
+    if packed:
+        pack_repository()
+
+    with _RetrievedFiles(folder) as files:
+        assert sorted(files.list_object_names()) == ['case.error', 'case.scfm']
+        assert files.get_object_content('case.error') == ''
+        assert files.get_last_block('case.scfm', b':ITE') == ':ITE002: 2.\n:ENE = -2.0'
+        assert list(files.iter_lines('case.scfm')) == [':ITE001: 1.\n', ':ENE = -1.0\n', ':ITE002: 2.\n', ':ENE = -2.0']
+        assert list(files.iter_lines('case.error')) == []
+
+
+def test_parse_packed(generate_calc_job_node, generate_parser, pack_repository):
+    """Test that a calculation is parsed the same once its retrieved files are packed."""
+    parser = generate_parser('wien2k-scf123-parser')
+    node = generate_calc_job_node('wien2k-run123_lapw', 'scf123', 'default')
+    results, _ = parser.parse_from_node(node, store_provenance=False)
+
+    pack_repository()
+    results_packed, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_status
+    assert results_packed['scf_grep'].get_dict() == results['scf_grep'].get_dict()
+    assert results_packed['dayfile_timings_summary'].get_dict() == results['dayfile_timings_summary'].get_dict()
+    assert results_packed['scf_history'].get_array('Iter').tolist() == results['scf_history'].get_array('Iter').tolist()
+
+
+def test_retrieved_files_packed_last_block(pack_repository):
+    """Test that ``_RetrievedFiles`` reads the last block of an object of a packed repository."""
+    folder = FolderData()
+    folder.put_object_from_filelike(io.BytesIO(b':ITE001: 1.\n:ENE = -1.0\n:ITE002: 2.\n:ENE = -2.0'), 'case.scfm')
+    folder.store()
+    pack_repository()
+
+    with _RetrievedFiles(folder) as files:
+        assert files.get_last_block('case.scfm', b':ITE') == ':ITE002: 2.\n:ENE = -2.0'
+
+
+def test_retrieved_files_compressed():
+    """Test that ``_RetrievedFiles`` serves compressed files under their uncompressed name, decompressed on the fly."""
+    content = b':ITE001: 1.\n:ENE = -1.0\n:ITE002: 2.\n:ENE = -2.0'
+    folder = FolderData()
+    folder.put_object_from_filelike(io.BytesIO(gzip.compress(content)), 'case.scfm.gz')
+    folder.put_object_from_filelike(io.BytesIO(gzip.compress(b'compressed')), 'case.klist.gz')
+    folder.put_object_from_filelike(io.BytesIO(b'plain'), 'case.klist')
+
+    with _RetrievedFiles(folder) as files:
+        assert sorted(files.list_object_names()) == ['case.klist', 'case.scfm']
+        assert files.get_object_content('case.scfm') == content.decode()
+        assert files.get_object_content('case.klist') == 'plain'
+        assert files.get_last_block('case.scfm', b':ITE') == ':ITE002: 2.\n:ENE = -2.0'
+        assert files.get_last_block('case.scfm', b':NOT') == content.decode()
+        assert list(files.iter_lines('case.scfm')) == [':ITE001: 1.\n', ':ENE = -1.0\n', ':ITE002: 2.\n', ':ENE = -2.0']
+
+
+def test_compressed_outputs(generate_calc_job_node, generate_parser, data_regression):
+    """Test parsing of the SCF output files compressed with ``compress_outputs``."""
+    node, retrieved_temporary_folder = generate_calc_job_node(
+        'wien2k-run123_lapw', 'scf123', 'default', retrieve_temporary_list=['*.scf*', '*.dayfile', '*.klist', '*.in0']
+    )
+    for filepath in retrieved_temporary_folder.iterdir():
+        filepath.with_name(filepath.name + '.gz').write_bytes(gzip.compress(filepath.read_bytes()))
+        filepath.unlink()
+    parser = generate_parser('wien2k-scf123-parser')
+    results, calcfunction = parser.parse_from_node(
+        node, store_provenance=False, retrieved_temporary_folder=str(retrieved_temporary_folder)
+    )
+
+    assert calcfunction.is_finished_ok, calcfunction.exit_message
+    data_regression.check({'scf_grep': results['scf_grep'].get_dict()}, basename='test_default')
+    assert results['scf_history'].get_array('EtotRyd').tolist() == [-14238.10360884]
+
+
+def test_parser_max_workers(generate_calc_job_node, generate_parser):
+    """Test that parsing the stages concurrently gives the same results as the sequential parsing."""
+    parser = generate_parser('wien2k-scf123-parser')
+    node = generate_calc_job_node('wien2k-run123_lapw', 'scf123', 'failed_warning_qtl_b')
+    results, _ = parser.parse_from_node(node, store_provenance=False)
+
+    node = generate_calc_job_node(
+        'wien2k-run123_lapw', 'scf123', 'failed_warning_qtl_b', options={'parser_max_workers': 4}
+    )
+    results_concurrent, calcfunction = parser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.exit_status == Wien2kRun123Lapw.exit_codes.WARNING_QTL_B.status
+    assert results_concurrent['scf_grep'].get_dict() == results['scf_grep'].get_dict()
+    assert results_concurrent['dayfile_timings_summary'].get_dict() == results['dayfile_timings_summary'].get_dict()
+
+
+def test_parser_spans(generate_calc_job_node, generate_parser):
+    """Test that the wall time of every phase of the parser is stored in the extras of the calculation."""
+    node = generate_calc_job_node('wien2k-run123_lapw', 'scf123', 'default')
+    parser = generate_parser('wien2k-scf123-parser')
+    parser.parse_from_node(node, store_provenance=False)
+
+    spans = node.base.extras.get(SPANS_EXTRA)
+    for name in ('list_files', 'stage:prec3k', 'read:prec3k:scfm', 'scan:prec3k:scfm', 'history:prec3k', 'outputs'):
+        assert 0.0 <= spans[name] <= spans['parse'], name
+    assert spans['stage:prec3k'] >= spans['read:prec3k:scfm'] + spans['scan:prec3k:scfm']
+    assert PROFILE_EXTRA not in node.base.extras.all
+
+
+def test_parser_profile(generate_calc_job_node, generate_parser, monkeypatch):
+    """Test the opt-in profiling of the parser with cProfile and tracemalloc."""
+    monkeypatch.setenv(PROFILE_ENV, 'cprofile, tracemalloc')
+    node = generate_calc_job_node('wien2k-run123_lapw', 'scf123', 'default')
+    parser = generate_parser('wien2k-scf123-parser')
+    parser.parse_from_node(node, store_provenance=False)
+
+    profile = node.base.extras.get(PROFILE_EXTRA)
+    assert '_parse_stage' in profile['cprofile']
+    assert profile['tracemalloc']['peak_mb'] > 0.0
+    assert profile['tracemalloc']['top']
+
+
+WARNINGS = {
+    ':WARN : QTL-B value eq.   2.17 in Band of energy   0.84994  ATOM=    1  L=  3': 'QTL_B',
+    ':WARN : VK-COUL not well converged: Increase GMAX or decrease NCON': 'VK_COUL',
+    ':WARN : RESULT OF INTEGRATION SHOULD BE    17.00000 NOT    16.99000': 'INT',
+    ':WARN : Some other warning that I just made up': 'OTHER',
+}
+
+
+@pytest.mark.parametrize(
+    'messages, family',
+    (
+        *(([message], family) for message, family in WARNINGS.items()),
+        ([':WARN : Some other warning', *WARNINGS], 'QTL_B'),
+        ([*WARNINGS, 'Warning: SCF prec3 not converged'], 'CONVERG'),
+    ),
+)
+def test_classify_warnings(messages, family):
+    """Test the classification of warnings into the families of the exit codes."""
+    assert _classify_warnings(messages) == family
+
+
+@pytest.mark.benchmark
+def test_classify_warnings_benchmark():
+    """Micro-benchmark of ``_classify_warnings`` against the fuzzy matching it replaces."""
+    fuzz = pytest.importorskip('fuzzywuzzy.fuzz')
+
+    def classify_fuzzy(messages):
+        references = {
+            'QTL_B': 'QTL-B value eq. in Band of energy ATOM= L=',
+            'VK_COUL': 'VK-COUL not well converged: Increase GMAX or decrease NCON',
+            'INT': 'RESULT OF INTEGRATION SHOULD BE',
+        }
+        for msg in messages:
+            for family, reference in references.items():
+                if fuzz.ratio(msg, reference) > 50:
+                    return family
+        return 'OTHER'
+
+    for message, family in WARNINGS.items():
+        assert classify_fuzzy([message]) == _classify_warnings([message]) == family
+
+    messages = list(WARNINGS)[::-1]
+    time_fuzzy = min(timeit.repeat(lambda: classify_fuzzy(messages), number=100, repeat=3))
+    time_compiled = min(timeit.repeat(lambda: _classify_warnings(messages), number=100, repeat=3))
+    LOGGER.info(f'fuzzy: {time_fuzzy * 1e4:.1f} us, compiled: {time_compiled * 1e4:.1f} us per classification')
+    assert time_compiled < time_fuzzy
+
+
+def generate_struct(num_inequivalent: int, mult: int = 1) -> str:
+    """Return the content of a synthetic WIEN2k struct file with ``num_inequivalent * mult`` atoms."""
+    lines = ['synthetic', f'P   LATTICE,NONEQUIV.ATOMS:{num_inequivalent:3d}', 'MODE OF CALC=RELA']
+    lines.append(('%10.6f' * 6) % (20.0, 20.0, 20.0, 90.0, 90.0, 90.0))
+    for iat in range(num_inequivalent):
+        for ieq in range(mult):
+            x, y, z = ((iat * mult + ieq) * np.array([0.001, 0.002, 0.003])) % 1.0
+            prefix = f'ATOM{-(iat % 999) - 1:4d}:' if ieq == 0 else '         '
+            lines.append(f'{prefix} X={x:10.8f} Y={y:10.8f} Z={z:10.8f}')
+            if ieq == 0:
+                lines.append(f'          MULT={mult:2d}          ISPLIT= 8')
+        element = ('Si', 'O ')[iat % 2]
+        lines.append(f'{element}{iat % 10:<8d} NPT=  781  R0=0.00010000 RMT={1.5 + iat % 2:10.4f}   Z: 14.00000')
+        lines.append('LOCAL ROT MATRIX:    1.0000000 0.0000000 0.0000000')
+        lines.append('                     0.0000000 1.0000000 0.0000000')
+        lines.append('                     0.0000000 0.0000000 1.0000000')
+    lines.append('   0')
+    return '\n'.join(lines) + '\n'
+
+
+def test_read_struct_mult():
+    """Test that ``read_struct`` expands the equivalent positions of each inequivalent atom."""
+    _, lattice, pos, atomtype, rmt, mult = read_struct(io.StringIO(generate_struct(3, mult=2)), ase=False)
+
+    assert lattice == 'P'
+    assert mult.tolist() == [2, 2, 2]
+    assert pos.shape == (6, 3)
+    assert np.allclose(pos[:, 0], np.arange(6) * 0.001)
+    assert atomtype.tolist() == ['Si', 'Si', 'O', 'O', 'Si', 'Si']
+    assert rmt.tolist() == [1.5, 1.5, 2.5, 2.5, 1.5, 1.5]
+
+
+@pytest.mark.benchmark
+def test_read_struct_benchmark():
+    """Benchmark of ``read_struct`` on synthetic large supercells, its cost should be linear in the number of atoms."""
+    times = {}
+    for mult in (1, 4):
+        content = generate_struct(500, mult)
+        assert len(read_struct(io.StringIO(content))) == 500 * mult
+        times[mult] = min(timeit.repeat(lambda: read_struct(io.StringIO(content), ase=False), number=5, repeat=3))
+        LOGGER.info(f'read_struct: {500 * mult} atoms in {times[mult] / 5 * 1e3:.1f} ms')
+
+    assert times[4] < 2 * 4 * times[1]
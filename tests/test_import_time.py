@@ -0,0 +1,73 @@
+"""Tests for the import cost of the entry points of the plugin."""
+from __future__ import annotations
+
+import importlib.metadata
+import subprocess
+import sys
+
+import pytest
+
+ENTRY_POINTS = [
+    entry_point
+    for entry_point in importlib.metadata.distribution('aiida-wien2k').entry_points
+    if entry_point.group.startswith('aiida.')
+]
+
+# modules of `aiida-core` that are loaded anyway when an entry point is used
+AIIDA_MODULES = ('aiida.engine', 'aiida.orm', 'aiida.parsers', 'aiida.plugins')
+
+# modules that are only imported on first use
+LAZY_MODULES = ('ase', 'fuzzywuzzy', 'spglib')
+
+# module of `AIIDA_MODULES` whose cumulative import time is the reference of the import time of the entry points
+REFERENCE_MODULE = 'aiida.engine'
+
+# maximum cumulative import time of an entry point module on top of `AIIDA_MODULES`, relative to `REFERENCE_MODULE`
+IMPORT_TIME_RATIO = 0.1
+
+
+def import_times(*modules: str) -> dict[str, float]:
+    """Return the cumulative import time [s] of every module imported when importing ``modules``.
+
+    The imports are measured with ``python -X importtime`` in a fresh interpreter.
+    """
+    code = f'import {", ".join(modules)}'
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True
+    ).stderr
+
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('| imported package'):
+            _, cumulative, name = line.split('|')
+            times[name.strip()] = int(cumulative) * 1e-6
+
+    return times
+
+
+def entry_point_import_times(entry_point) -> tuple[dict[str, float], dict[str, float]]:
+    """Return the import times of `AIIDA_MODULES` and of the modules imported on top of them by ``entry_point``."""
+    baseline = import_times(*AIIDA_MODULES)
+    module = entry_point.value.split(':')[0]
+    times = {name: time for name, time in import_times(*AIIDA_MODULES, module).items() if name not in baseline}
+    return baseline, times
+
+
+@pytest.mark.parametrize('entry_point', ENTRY_POINTS, ids=lambda entry_point: entry_point.name)
+def test_lazy_imports(entry_point):
+    """Test that loading an entry point does not import heavy dependencies."""
+    _, times = entry_point_import_times(entry_point)
+
+    assert not [name for name in times if name.split('.')[0] in LAZY_MODULES]
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('entry_point', ENTRY_POINTS, ids=lambda entry_point: entry_point.name)
+def test_import_time(entry_point):
+    """Test that the import time of an entry point stays small compared to the one of `REFERENCE_MODULE`."""
+    baseline, times = entry_point_import_times(entry_point)
+    module = entry_point.value.split(':')[0]
+
+    assert (
+        times[module] < IMPORT_TIME_RATIO * baseline[REFERENCE_MODULE]
+    ), f'{module}: {times[module] * 1e3:.1f} ms, {REFERENCE_MODULE}: {baseline[REFERENCE_MODULE] * 1e3:.1f} ms'
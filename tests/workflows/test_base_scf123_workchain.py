@@ -0,0 +1,93 @@
+"""Tests for the :mod:`aiida_wien2k.workflows.base_scf123_workchain` module."""
+import pytest
+from aiida.common import LinkType
+from aiida.engine import ProcessHandlerReport
+from aiida.engine.utils import instantiate_process
+from aiida.manage import get_manager
+from aiida.orm import CalcJobNode, Dict, RemoteData
+from aiida_wien2k.calculations.run123_lapw import Wien2kRun123Lapw
+from aiida_wien2k.workflows.base_scf123_workchain import Wien2kBaseScf123WorkChain
+
+
+@pytest.fixture
+def generate_workchain(aiida_localhost, aiida_local_code_factory, generate_structure):
+    """Return a factory of a set up restart workchain and of a failed calculation with the given exit code."""
+
+    def factory(exit_code, parameters=None):
+        inputs = {
+            'wien2k': {
+                'aiida_structure': generate_structure('Si'),
+                'code': aiida_local_code_factory('wien2k-run123_lapw', '/bin/true'),
+                'metadata': {'options': {'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 1}}},
+            }
+        }
+        if parameters is not None:
+            inputs['wien2k']['parameters'] = Dict(parameters)
+        process = instantiate_process(get_manager().get_runner(), Wien2kBaseScf123WorkChain, **inputs)
+        process.setup()
+
+        node = CalcJobNode(computer=aiida_localhost, process_type='aiida.calculations:wien2k-run123_lapw')
+        node.set_process_state('finished')
+        node.set_exit_status(exit_code.status)
+        node.set_exit_message(exit_code.message)
+        node.store()
+        remote_folder = RemoteData(computer=aiida_localhost, remote_path='/tmp')
+        remote_folder.base.links.add_incoming(node, link_type=LinkType.CREATE, link_label='remote_folder')
+        remote_folder.store()
+
+        return process, node
+
+    return factory
+
+
+@pytest.mark.parametrize(
+    'exit_code', ('ERROR_SCHEDULER_OUT_OF_WALLTIME', 'ERROR_SCF_INCOMPLETE', 'ERROR_SCF_STOPPED_WALLTIME')
+)
+def test_handle_resume(generate_workchain, exit_code):
+    """Test that an interrupted calculation is resumed from its density with unchanged parameters."""
+    process, node = generate_workchain(Wien2kRun123Lapw.exit_codes[exit_code], parameters={'-i': '40'})
+
+    report = process.handle_interrupted(node)
+
+    assert isinstance(report, ProcessHandlerReport)
+    assert report.do_break
+    assert process.ctx.inputs.parent_folder.uuid == node.outputs.remote_folder.uuid
+    assert process.ctx.inputs.parameters.get_dict() == {'-i': '40'}
+
+
+@pytest.mark.parametrize(('parameters', 'expected'), ((None, '200'), ({'-i': '40', '-p': True}, '80')))
+def test_handle_not_converged(generate_workchain, parameters, expected):
+    """Test that an unconverged calculation is resumed with twice the number of SCF iterations."""
+    process, node = generate_workchain(Wien2kRun123Lapw.exit_codes.WARNING_CONVERG, parameters=parameters)
+
+    report = process.handle_not_converged(node)
+
+    assert report.do_break
+    assert process.ctx.inputs.parent_folder.uuid == node.outputs.remote_folder.uuid
+    assert process.ctx.inputs.parameters['-i'] == expected
+    assert process.ctx.inputs.parameters.get_dict().get('-p') == (parameters or {}).get('-p')
+
+
+@pytest.mark.parametrize('exit_code', ('WARNING_CONVERG1', 'WARNING_CONVERG3'))
+def test_handle_not_converged_stage(generate_workchain, exit_code):
+    """Test that a calculation that did not converge in an intermediate precision stage is resumed as well."""
+    process, node = generate_workchain(Wien2kRun123Lapw.exit_codes[exit_code], parameters={'-i': '40'})
+
+    assert process.handle_unstable_iteration(node) is None
+    report = process.handle_not_converged(node)
+
+    assert report.do_break
+    assert process.ctx.inputs.parameters['-i'] == '80'
+
+
+@pytest.mark.parametrize('exit_code', ('WARNING_QTL_B', 'WARNING_QTL_B1', 'WARNING_VK_COUL', 'WARNING_VK_COUL3'))
+def test_handle_unstable_iteration(generate_workchain, exit_code):
+    """Test that a calculation with a QTL-B or VK-COUL warning is resumed with twice the number of SCF iterations."""
+    process, node = generate_workchain(Wien2kRun123Lapw.exit_codes[exit_code], parameters={'-i': '40', '-p': True})
+
+    assert process.handle_not_converged(node) is None
+    report = process.handle_unstable_iteration(node)
+
+    assert report.do_break
+    assert process.ctx.inputs.parent_folder.uuid == node.outputs.remote_folder.uuid
+    assert process.ctx.inputs.parameters.get_dict() == {'-i': '80', '-p': True}
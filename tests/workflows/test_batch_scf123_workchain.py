@@ -0,0 +1,65 @@
+"""Tests for the :mod:`aiida_wien2k.workflows.batch_scf123_workchain` module."""
+import stat
+
+import pytest
+from aiida.common.links import LinkType
+from aiida.engine import run_get_node
+from aiida.engine.utils import instantiate_process
+from aiida.manage import get_manager
+from aiida.orm import CalcJobNode, Dict, Int
+from aiida_wien2k.workflows.batch_scf123_workchain import Wien2kBatchScf123WorkChain
+
+
+@pytest.fixture
+def fake_run123_lapw(tmp_path, filepath_tests, aiida_local_code_factory):
+    """Return a code that writes the output files of a converged `run123_lapw` run into `case/`."""
+    filepath_outputs = filepath_tests / 'parsers' / 'fixtures' / 'scf123' / 'default'
+    executable = tmp_path / 'run123_lapw'
+    # the calculation of Ge takes longer than the others
+    executable.write_text(
+        f'#!/bin/bash\ngrep -q Ge case/case.struct && sleep 5\ncp {filepath_outputs}/prec3k.* case/\n'
+    )
+    executable.chmod(executable.stat().st_mode | stat.S_IEXEC)
+    return aiida_local_code_factory('wien2k-run123_lapw', str(executable))
+
+
+def test_batch(fake_run123_lapw, generate_structure):
+    """Test that at most ``max_concurrent`` calculations run at once and that a finished one is replaced at once."""
+    inputs = {
+        'structures': {formula: generate_structure(formula) for formula in ('Si', 'Ge', 'C')},
+        'code': fake_run123_lapw,
+        'inpdict': Dict(),
+        'options': Dict({'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 1}}),
+        'max_concurrent': Int(2),
+    }
+    results, node = run_get_node(Wien2kBatchScf123WorkChain, **inputs)
+
+    assert node.is_finished_ok, node.exit_status
+    assert sorted(results['summary'].get_dict()) == ['C', 'Ge', 'Si']
+    assert results['summary']['Si']['EtotRyd'] == -14238.10360884
+
+    calcs = {
+        link.link_label: link.node
+        for link in node.base.links.get_outgoing(link_type=LinkType.CALL_CALC)
+        if link.node.process_label == 'Wien2kRun123Lapw'
+    }
+    assert sorted(calcs) == ['run123_lapw_C', 'run123_lapw_Ge', 'run123_lapw_Si']
+    # Si is submitted once C is done, while Ge is still running
+    assert calcs['run123_lapw_C'].outputs.retrieved.ctime < calcs['run123_lapw_Si'].ctime
+    assert calcs['run123_lapw_Si'].ctime < calcs['run123_lapw_Ge'].outputs.retrieved.ctime
+
+
+def test_killed_calculation(aiida_localhost, aiida_local_code_factory, generate_structure):
+    """Test that a killed calculation, which has no exit status, is counted as an error."""
+    inputs = {
+        'structures': {'Si': generate_structure('Si')},
+        'code': aiida_local_code_factory('wien2k-run123_lapw', '/bin/true'),
+        'inpdict': Dict(),
+        'options': Dict({'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 1}}),
+    }
+    process = instantiate_process(get_manager().get_runner(), Wien2kBatchScf123WorkChain, **inputs)
+    node = CalcJobNode(computer=aiida_localhost, process_type='aiida.calculations:wien2k-run123_lapw')
+    node.set_process_state('killed')
+    process.ctx.calcs = {'Si': node.store().pk}
+
+    assert process.inspect_warn_all_steps() == Wien2kBatchScf123WorkChain.exit_codes.ERROR
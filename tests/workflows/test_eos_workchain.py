@@ -0,0 +1,190 @@
+"""Tests for the :mod:`aiida_wien2k.workflows.eos_workchain` module."""
+import stat
+
+import numpy as np
+import pytest
+from aiida.common import LinkType
+from aiida.engine import run_get_node
+from aiida.engine.utils import instantiate_process
+from aiida.manage import get_manager
+from aiida.orm import Bool, CalcJobNode, Dict, Float, List
+from aiida_wien2k.workflows.eos_workchain import (
+    RY_BOHR3_TO_GPA,
+    Wien2kEosWorkChain,
+    birch_murnaghan_fit,
+    fit_eos,
+    scale_structure,
+)
+
+# Birch-Murnaghan parameters of the synthetic equation of state: V0 [bohr^3], E0 [Ry], B0 [Ry/bohr^3], B0_prime
+EOS = (265.0, -100.0, 0.006, 4.3)
+
+
+def birch_murnaghan(volumes, v0, e0, b0, b0_prime):
+    """Return the energies of the third-order Birch-Murnaghan equation of state at ``volumes``."""
+    eta = (v0 / volumes) ** (2.0 / 3.0)
+    return e0 + 9.0 * v0 * b0 / 16.0 * ((eta - 1.0) ** 3 * b0_prime + (eta - 1.0) ** 2 * (6.0 - 4.0 * eta))
+
+
+def test_birch_murnaghan_fit():
+    """Test that the fit recovers the parameters of an exact equation of state."""
+    volumes = EOS[0] * np.linspace(0.94, 1.06, 7)
+    parameters, residuals = birch_murnaghan_fit(volumes, birch_murnaghan(volumes, *EOS))
+
+    assert parameters['V0'] == pytest.approx(EOS[0])
+    assert parameters['E0'] == pytest.approx(EOS[1])
+    assert parameters['B0'] == pytest.approx(EOS[2] * RY_BOHR3_TO_GPA)
+    assert parameters['B0_prime'] == pytest.approx(EOS[3])
+    assert parameters['B0_error'] < 1e-6
+    assert np.abs(residuals).max() < 1e-9
+
+
+def test_birch_murnaghan_fit_vectorized():
+    """Test that several noisy equations of state are fitted at once with the same result as one by one."""
+    volumes = EOS[0] * np.linspace(0.94, 1.06, 7)
+    rng = np.random.default_rng(0)
+    energies = birch_murnaghan(volumes, *EOS)[:, np.newaxis] + rng.normal(0.0, 1e-5, (7, 5))
+
+    parameters, residuals = birch_murnaghan_fit(volumes, energies)
+
+    assert residuals.shape == energies.shape
+    for name in ('V0', 'B0', 'B0_prime'):
+        assert parameters[name].shape == (5,)
+        # the exact values are within a few standard errors
+        exact = {'V0': EOS[0], 'B0': EOS[2] * RY_BOHR3_TO_GPA, 'B0_prime': EOS[3]}[name]
+        assert (np.abs(parameters[name] - exact) < 4 * parameters[f'{name}_error']).all()
+    single, _ = birch_murnaghan_fit(volumes, energies[:, 2])
+    assert {name: value[2] for name, value in parameters.items()} == pytest.approx(single, rel=1e-4)
+
+
+def test_birch_murnaghan_fit_minimum_points():
+    """Test that 4 volumes are fitted exactly without uncertainties and that fewer are rejected."""
+    volumes = EOS[0] * np.linspace(0.94, 1.06, 4)
+    parameters, _ = birch_murnaghan_fit(volumes, birch_murnaghan(volumes, *EOS))
+
+    assert parameters['V0'] == pytest.approx(EOS[0])
+    assert np.isnan(parameters['V0_error'])
+    with pytest.raises(ValueError, match='at least 4 volumes'):
+        birch_murnaghan_fit(volumes[:3], birch_murnaghan(volumes[:3], *EOS))
+
+
+def test_scale_structure(generate_structure):
+    """Test that the volume is scaled and the fractional coordinates are kept."""
+    structure = generate_structure('Si')
+    scaled = scale_structure(structure, Float(1.06))
+
+    assert scaled.get_cell_volume() == pytest.approx(1.06 * structure.get_cell_volume())
+    assert scaled.get_ase().get_scaled_positions() == pytest.approx(structure.get_ase().get_scaled_positions())
+
+
+def test_fit_eos():
+    """Test the fit of the equation of state to the ``scf_grep`` outputs of the volumes."""
+    volumes = EOS[0] * np.linspace(0.94, 1.06, 5)
+    scf_grep = {
+        f'volume_{index}': Dict({'VolBohr3': volume, 'EtotRyd': energy})
+        for index, (volume, energy) in enumerate(zip(volumes, birch_murnaghan(volumes, *EOS)))
+    }
+    eos = fit_eos(**scf_grep)
+
+    assert eos['V0'] == pytest.approx(EOS[0])
+    assert eos['volumes'] == pytest.approx(volumes.tolist())
+    assert eos['units']['B0'] == 'GPa'
+
+
+@pytest.fixture
+def fake_run123_lapw(tmp_path, filepath_tests, aiida_local_code_factory):
+    """Return a code that writes the output files of a `run123_lapw` run into `case/`.
+
+    The volume of the fcc `case.struct` and its total energy on the synthetic equation of state are written into the
+    output files of a converged run."""
+    filepath_outputs = filepath_tests / 'parsers' / 'fixtures' / 'scf123' / 'default'
+    executable = tmp_path / 'run123_lapw'
+    v0, e0, b0, b0_prime = EOS
+    executable.write_text(
+        '#!/bin/bash\n'
+        f'cp {filepath_outputs}/prec3k.* case/\n'
+        "read -r volume energy <<< $(awk 'NR == 4 {v = $1 ^ 3 / 4; "
+        f'eta = ({v0} / v) ^ (2 / 3); '
+        f'e = {e0} + 9 * {v0} * {b0} / 16 * ((eta - 1) ^ 3 * {b0_prime} + (eta - 1) ^ 2 * (6 - 4 * eta)); '
+        'printf "%.5f %.8f", v, e}\' case/case.struct)\n'
+        'sed -i "s/UNIT CELL VOLUME = .*/UNIT CELL VOLUME =     $volume/" case/prec3k.scf0\n'
+        'sed -i "s/TOTAL ENERGY IN Ry = .*/TOTAL ENERGY IN Ry =       $energy/" case/prec3k.scfm\n'
+    )
+    executable.chmod(executable.stat().st_mode | stat.S_IEXEC)
+    return aiida_local_code_factory('wien2k-run123_lapw', str(executable))
+
+
+def test_eos(fake_run123_lapw, generate_structure):
+    """Test that all volumes are run, warm started from the reference volume, and the equation of state is fitted."""
+    inputs = {
+        'aiida_structure': generate_structure('Si'),
+        'code': fake_run123_lapw,
+        'inpdict': Dict(),
+        'options': Dict({'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 1}}),
+        'scale_factors': List([0.94, 0.97, 1.0, 1.03, 1.06]),
+        'warm_start': Bool(True),
+    }
+    results, node = run_get_node(Wien2kEosWorkChain, **inputs)
+
+    assert node.is_finished_ok, node.exit_status
+    eos = results['eos']
+    assert eos['V0'] == pytest.approx(EOS[0], rel=1e-5)
+    assert eos['B0'] == pytest.approx(EOS[2] * RY_BOHR3_TO_GPA, rel=1e-3)
+    assert eos['B0_prime'] == pytest.approx(EOS[3], rel=1e-2)
+
+    calcs = {
+        link.link_label: link.node
+        for link in node.base.links.get_outgoing(link_type=LinkType.CALL_CALC).all()
+        if link.node.process_label == 'Wien2kRun123Lapw'
+    }
+    assert sorted(calcs) == [f'run123_lapw_volume_{index}' for index in range(5)]
+    reference = calcs.pop('run123_lapw_volume_2')
+    assert 'parent_folder' not in reference.inputs
+    for calc in calcs.values():
+        assert calc.inputs.parent_folder.uuid == reference.outputs.remote_folder.uuid
+
+
+@pytest.fixture
+def generate_workchain(aiida_local_code_factory, generate_structure):
+    """Return a factory of an equation of state workchain, to test its steps on hand-made calculations."""
+
+    def factory():
+        inputs = {
+            'aiida_structure': generate_structure('Si'),
+            'code': aiida_local_code_factory('wien2k-run123_lapw', '/bin/true'),
+            'inpdict': Dict(),
+            'options': Dict({'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 1}}),
+        }
+        return instantiate_process(get_manager().get_runner(), Wien2kEosWorkChain, **inputs)
+
+    return factory
+
+
+def test_killed_volume(aiida_localhost, generate_workchain):
+    """Test that a killed calculation, which has no exit status, is counted as an error."""
+    process = generate_workchain()
+    node = CalcJobNode(computer=aiida_localhost, process_type='aiida.calculations:wien2k-run123_lapw')
+    node.set_process_state('killed')
+    process.ctx.volumes = {'volume_0': node.store()}
+
+    assert process.inspect_volumes() == Wien2kEosWorkChain.exit_codes.ERROR
+    assert process.inspect_warn_all_steps() == Wien2kEosWorkChain.exit_codes.ERROR
+
+
+@pytest.mark.parametrize(('unconverged_status', 'fitted'), ((305, False), (335, False), (302, True)))
+def test_unconverged_volume(aiida_localhost, generate_workchain, unconverged_status, fitted):
+    """Test that a volume whose SCF cycle did not converge is left out of the fit, other warnings are kept."""
+    process = generate_workchain()
+    process.ctx.volumes = {}
+    for index, status in enumerate((0, 0, 0, 0, unconverged_status)):
+        node = CalcJobNode(computer=aiida_localhost, process_type='aiida.calculations:wien2k-run123_lapw')
+        node.set_process_state('finished')
+        node.set_exit_status(status)
+        node.store()
+        scf_grep = Dict({'VolBohr3': 250.0 + index, 'EtotRyd': -100.0})
+        scf_grep.base.links.add_incoming(node, link_type=LinkType.CREATE, link_label='scf_grep')
+        scf_grep.store()
+        process.ctx.volumes[f'volume_{index}'] = node
+
+    assert process.inspect_volumes() is None
+    assert ('volume_4' in process.ctx.scf_grep) == fitted
@@ -0,0 +1,47 @@
+"""Tests for the :mod:`aiida_wien2k.workflows.scf123_workchain` module."""
+import pytest
+from aiida.engine.utils import instantiate_process
+from aiida.manage import get_manager
+from aiida.orm import Dict
+from aiida_wien2k.workflows.scf123_workchain import Wien2kScf123WorkChain
+
+
+@pytest.fixture
+def generate_inputs(aiida_local_code_factory, generate_structure):
+    """Return the inputs of a ``Wien2kScf123WorkChain`` with the given resource limits."""
+
+    def factory(resource_limits):
+        return {
+            'aiida_structure': generate_structure('Si'),
+            'code': aiida_local_code_factory('wien2k-run123_lapw', '/bin/true'),
+            'inpdict': Dict(),
+            'options': Dict({'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 1}, 'queue_name': 'debug'}),
+            'resource_limits': Dict(resource_limits),
+        }
+
+    return factory
+
+
+def test_estimate_options(generate_inputs):
+    """Test that the resource limits fill in the resources and the parallel layout of the options."""
+    inputs = generate_inputs({'cores_per_machine': 16, 'memory_mb_per_machine': 64000, 'max_machines': 2})
+    process = instantiate_process(get_manager().get_runner(), Wien2kScf123WorkChain, **inputs)
+
+    options = process.estimate_options()
+
+    assert options['resources']['num_mpiprocs_per_machine'] <= 16
+    assert options['resources']['num_machines'] in (1, 2)
+    assert set(options) == {'resources', 'max_wallclock_seconds', 'max_memory_kb', 'mpiprocs_per_kgroup'}
+
+
+@pytest.mark.parametrize(
+    ('resource_limits', 'match'),
+    (
+        ({'cores_per_machine': 16}, 'miss the keys'),
+        ({'cores_per_machine': 16, 'memory_mb_per_machine': 64000, 'max_nodes': 2}, r"unknown keys \['max_nodes'\]"),
+    ),
+)
+def test_resource_limits_validation(generate_inputs, resource_limits, match):
+    """Test that the resource limits have to describe the machines and only have known keys."""
+    with pytest.raises(ValueError, match=match):
+        instantiate_process(get_manager().get_runner(), Wien2kScf123WorkChain, **generate_inputs(resource_limits))